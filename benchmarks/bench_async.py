@@ -0,0 +1,100 @@
+"""Concurrent coroutines querying the async service against the
+same coroutines calling the synchronous service.
+
+Every coroutine looks the chats up by id. Besides the throughput
+the largest delay of a ticker task is reported, which is how long
+the event loop was blocked by the queries.
+
+Usage:
+    python benchmarks/bench_async.py [--rows N] [--coroutines N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqller  # noqa: E402
+
+
+class Chat(metaclass=sqller.ModelMeta):
+    NAME = 'chats'
+    FIELDS = [
+        sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+        sqller.Field(name="type", dtype="text"),
+        sqller.Field(name="username", dtype="text"),
+        sqller.Field(name="chat_id", dtype="integer")
+    ]
+
+
+class ChatDAO(metaclass=sqller.DAOMeta):
+    MODEL = Chat
+
+
+async def ticker(delays, interval=0.001):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        delays.append(time.perf_counter() - start - interval)
+
+
+async def measure(lookup, rows, coroutines):
+    async def client(offset):
+        for i in range(offset, rows, coroutines):
+            await lookup(i % rows + 1)
+
+    delays = []
+    tick = asyncio.create_task(ticker(delays))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(coroutines)])
+    elapsed = time.perf_counter() - start
+    tick.cancel()
+    return rows / elapsed, max(delays, default=elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--coroutines', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'db.sqlite3')
+        Service = sqller.ServiceMeta(
+            'Service', (), dict(DB_PATH=db_path, MODELS=[Chat]))
+        Service.execute_many(ChatDAO.save_many([
+            Chat(type='usual', username=f'user{i}', chat_id=i)
+            for i in range(args.rows)
+        ]))
+
+        async def sync_lookup(id):
+            Service.execute(ChatDAO.get_one(id))
+
+        results = [('sync', asyncio.run(
+            measure(sync_lookup, args.rows, args.coroutines)))]
+        for workers in (1, 4):
+            # A connection for every worker and one for a transaction
+            AsyncService = sqller.AsyncServiceMeta('AsyncService', (), dict(
+                DB_PATH=db_path, MODELS=[Chat],
+                WORKERS=workers, POOL_SIZE=workers + 1))
+
+            async def run():
+                async def lookup(id):
+                    await AsyncService.execute(ChatDAO.get_one(id))
+                result = await measure(lookup, args.rows, args.coroutines)
+                await AsyncService.close()
+                return result
+            results.append((f'async, {workers} workers', asyncio.run(run())))
+        Service.close()
+
+    print(f"{'':20} {'lookups/s':>12} {'max loop lag, ms':>18}")
+    for title, (lookups, lag) in results:
+        print(f"{title:20} {lookups:12.0f} {lag * 1000:18.2f}")
+
+
+if __name__ == '__main__':
+    main()
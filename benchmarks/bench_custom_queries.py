@@ -0,0 +1,80 @@
+"""Cost of calling custom DAO queries.
+
+Compares the name-derived (`sql_find_all_by_type_and_username`) and
+user provided (`CustomQuery(query)`) queries compiled at class
+creation against the way they used to be built on every call.
+
+Usage:
+    python benchmarks/bench_custom_queries.py [--calls N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqller  # noqa: E402
+
+
+class Chat(metaclass=sqller.ModelMeta):
+    NAME = 'chats'
+    FIELDS = [
+        sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+        sqller.Field(name="type", dtype="text"),
+        sqller.Field(name="username", dtype="text")
+    ]
+
+
+POSITIONAL_QUERY = "SELECT * FROM chats WHERE type = '{}' AND id > {{}} AND id < {{{{}}}}"
+
+
+class ChatDAO(metaclass=sqller.DAOMeta):
+    MODEL = Chat
+    sql_find_all_by_type_and_username = sqller.CustomQuery()
+    custom_find = sqller.CustomQuery(POSITIONAL_QUERY)
+
+
+NAMED_TEMPLATE = "SELECT * FROM chats WHERE type = '{type}' AND username = '{username}'"
+
+
+def named_per_call(**kwargs):
+    sql_query = NAMED_TEMPLATE
+    return sql_query.format(**kwargs)
+
+
+def positional_per_call(*args):
+    sql_query = POSITIONAL_QUERY
+    for arg in args:
+        sql_query = sql_query.format(arg)
+    return sql_query
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+
+    scenarios = [
+        ('named, formatted per call',
+         lambda: named_per_call(type='private', username='voilalex')),
+        ('named, sql_ text',
+         lambda: ChatDAO.sql_find_all_by_type_and_username(
+             type='private', username='voilalex')),
+        ('named, statement',
+         lambda: ChatDAO.find_all_by_type_and_username(
+             type='private', username='voilalex')),
+        ('positional, formatted per call',
+         lambda: positional_per_call('private', 1, 100)),
+        ('positional, text',
+         lambda: ChatDAO.custom_find('private', 1, 100)),
+        ('positional, statement',
+         lambda: ChatDAO.prepared_custom_find('private', 1, 100)),
+    ]
+    for title, call in scenarios:
+        seconds = timeit.timeit(call, number=args.calls)
+        print(f"{title:32} {seconds / args.calls * 1e9:8.0f} ns/call")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Time and memory of loading rows into model objects.
+
+Compares building objects the way it used to be done, with the
+generic keyword constructor setting attributes into `__dict__`,
+against the generated `from_row` of the slotted models.
+
+Usage:
+    python benchmarks/bench_hydration.py [--rows N]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqller  # noqa: E402
+
+FIELDS = [
+    sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+    sqller.Field(name="type", dtype="text"),
+    sqller.Field(name="last_name", dtype="text"),
+    sqller.Field(name="first_name", dtype="text"),
+    sqller.Field(name="username", dtype="text"),
+    sqller.Field(name="chat_id", dtype="integer")
+]
+
+
+class Chat(metaclass=sqller.ModelMeta):
+    NAME = 'chats'
+    FIELDS = FIELDS
+
+
+class DictChat:
+    def __init__(self, *args, **kwargs):
+        for field in FIELDS:
+            value = kwargs.get(field.name, None)
+            setattr(self, field.name, value)
+
+
+def load_with_constructor(rows):
+    names = [field.name for field in FIELDS]
+    return [DictChat(**dict(zip(names, row))) for row in rows]
+
+
+def load_with_row_factory(rows):
+    return list(map(Chat.from_row, rows))
+
+
+def measure(load, rows):
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = load(rows)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objs
+    return elapsed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+
+    rows = [
+        (i, 'private', 'Vouk', 'Ilya', f'user{i}', i * 10)
+        for i in range(args.rows)
+    ]
+    print(f"{'':24} {'seconds':>10} {'MiB':>10}")
+    for title, load in (('keyword constructor', load_with_constructor),
+                        ('slots + from_row', load_with_row_factory)):
+        elapsed, memory = measure(load, rows)
+        print(f"{title:24} {elapsed:10.3f} {memory / 2 ** 20:10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Cold start: importing sqller and defining models, DAOs and services.
+
+Defines a module of `--models` models with their DAOs and a service
+and imports it in a fresh interpreter, so that the time includes the
+class construction the way an application pays for it at startup.
+The time of the first use of the generated methods, which are built
+lazily, is reported separately.
+
+Usage:
+    python benchmarks/bench_import.py [--models N] [--repeat N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODEL = '''
+class Chat{i}(metaclass=sqller.ModelMeta):
+    NAME = 'chats{i}'
+    FIELDS = [
+        sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+        sqller.Field(name="type", dtype="text"),
+        sqller.Field(name="last_name", dtype="text"),
+        sqller.Field(name="first_name", dtype="text"),
+        sqller.Field(name="username", dtype="text", index=True),
+        sqller.Field(name="chat_id", dtype="integer")
+    ]
+
+
+class ChatDAO{i}(metaclass=sqller.DAOMeta):
+    MODEL = Chat{i}
+    sql_find_all_by_username = sqller.CustomQuery()
+    sql_find_all_by_type_and_chat_id = sqller.CustomQuery()
+    sql_count_by_type = sqller.CustomQuery()
+'''
+
+SERVICE = '''
+class Service(metaclass=sqller.ServiceMeta):
+    DB_PATH = ':memory:'
+    MODELS = [{models}]
+'''
+
+# Imports the module and uses every model once, printing the times
+SCRIPT = '''
+import time
+start = time.perf_counter()
+import sqller
+imported = time.perf_counter()
+import models
+defined = time.perf_counter()
+for i in range({count}):
+    model = getattr(models, f'Chat{{i}}')
+    dao = getattr(models, f'ChatDAO{{i}}')
+    model(id=1, type='usual')
+    model.from_row((1,) * 6)
+    dao.sql_get_one(1)
+used = time.perf_counter()
+print(imported - start, defined - imported, used - defined)
+'''
+
+
+def write_module(directory, count):
+    source = "import sqller\n"
+    source += "".join(MODEL.format(i=i) for i in range(count))
+    source += SERVICE.format(models=', '.join(f"Chat{i}" for i in range(count)))
+    with open(os.path.join(directory, 'models.py'), 'w') as f:
+        f.write(source)
+
+
+def run(directory, count):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([directory, ROOT]),
+               PYTHONDONTWRITEBYTECODE='1')
+    output = subprocess.run(
+        [sys.executable, '-c', textwrap.dedent(SCRIPT.format(count=count))],
+        env=env, cwd=directory, capture_output=True, text=True, check=True
+    ).stdout
+    return [float(value) for value in output.split()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_module(directory, args.models)
+        runs = [run(directory, args.models) for _ in range(args.repeat)]
+
+    print(f"{args.models} models with DAOs, median of {args.repeat} runs")
+    imported, defined, used = [statistics.median(times) for times in zip(*runs)]
+    print(f"{'import sqller':16} {imported * 1000:10.2f} ms")
+    for title, median in [('define classes', defined), ('first use', used)]:
+        print(f"{title:16} {median * 1000:10.2f} ms "
+              f"{median / args.models * 1e6:10.1f} us/model")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Overhead of the query hooks: point lookups of a service without
+hooks against the same service with `QueryStats` installed.
+
+Usage:
+    python benchmarks/bench_instrumentation.py [--rows N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqller  # noqa: E402
+
+
+class Chat(metaclass=sqller.ModelMeta):
+    NAME = 'chats'
+    FIELDS = [
+        sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+        sqller.Field(name="type", dtype="text"),
+        sqller.Field(name="username", dtype="text"),
+        sqller.Field(name="chat_id", dtype="integer")
+    ]
+
+
+class ChatDAO(metaclass=sqller.DAOMeta):
+    MODEL = Chat
+
+
+def measure(Service, rows, repeat=3):
+    best = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(rows):
+            Service.execute(ChatDAO.get_one(i + 1))
+        best = max(best, rows / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    Service = sqller.ServiceMeta(
+        'Service', (), dict(DB_PATH=':memory:', MODELS=[Chat]))
+    Service.execute_many(ChatDAO.save_many([
+        Chat(type='usual', username=f'user{i}', chat_id=i)
+        for i in range(args.rows)
+    ]))
+
+    plain = measure(Service, args.rows)
+    stats = sqller.QueryStats(slow_threshold=0.1)
+    Service.add_hook(stats)
+    instrumented = measure(Service, args.rows)
+
+    print(f"{'':20} {'lookups/s':>12}")
+    print(f"{'no hooks':20} {plain:12.0f}")
+    print(f"{'QueryStats':20} {instrumented:12.0f}")
+    print(f"overhead per query: {(1 / instrumented - 1 / plain) * 1e6:.2f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Queries per second of `ServiceMeta.execute` with and without
+the connection pool.
+
+The `connect per query` scenario reproduces the way `execute()`
+used to work: open the database, create the tables, run the query,
+commit and drop the connection.
+
+Usage:
+    python benchmarks/bench_pool.py [--queries N]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqller  # noqa: E402
+
+
+class Chat(metaclass=sqller.ModelMeta):
+    NAME = 'chats'
+    FIELDS = [
+        sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+        sqller.Field(name="type", dtype="text"),
+        sqller.Field(name="username", dtype="text")
+    ]
+
+
+def execute_connect_per_query(db_path, sql_query):
+    connection = sqlite3.connect(db_path)
+    cursor = connection.cursor()
+    cursor.execute(Chat.sql_create_table_if_not_exists())
+    cursor.execute(sql_query)
+    result = cursor.fetchall()
+    connection.commit()
+    return result
+
+
+def measure(execute, queries):
+    start = time.perf_counter()
+    for i in range(queries):
+        execute(f"SELECT * FROM chats WHERE id = {i % 100}")
+    return queries / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queries', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'bench.sqlite3')
+        Service = sqller.ServiceMeta(
+            'Service', (), dict(DB_PATH=db_path, MODELS=[Chat]))
+        for i in range(100):
+            Service.execute(
+                f"INSERT INTO chats(type, username) VALUES ('usual', 'user{i}')")
+
+        before = measure(
+            lambda sql: execute_connect_per_query(db_path, sql), args.queries)
+        after = measure(Service.execute, args.queries)
+        Service.close()
+
+    print(f"connect per query: {before:10.0f} queries/sec")
+    print(f"connection pool:   {after:10.0f} queries/sec")
+    print(f"speedup:           {after / before:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
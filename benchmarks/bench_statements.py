@@ -0,0 +1,73 @@
+"""Throughput of DAO queries with the values written into SQL text
+(`sql_save`, `sql_get_one`) against the prepared statements with
+`?` placeholders (`save`, `get_one`).
+
+Usage:
+    python benchmarks/bench_statements.py [--rows N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqller  # noqa: E402
+
+
+class Chat(metaclass=sqller.ModelMeta):
+    NAME = 'chats'
+    FIELDS = [
+        sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+        sqller.Field(name="type", dtype="text"),
+        sqller.Field(name="username", dtype="text"),
+        sqller.Field(name="chat_id", dtype="integer")
+    ]
+
+
+class ChatDAO(metaclass=sqller.DAOMeta):
+    MODEL = Chat
+
+
+def measure(function, count):
+    start = time.perf_counter()
+    for i in range(count):
+        function(i)
+    return count / (time.perf_counter() - start)
+
+
+def run(db_path, rows, save, get_one):
+    Service = sqller.ServiceMeta('Service', (), dict(
+        DB_PATH=db_path, MODELS=[Chat], PRAGMAS={'synchronous': 'OFF'}))
+
+    def insert(i):
+        Service.execute(save(Chat(type='usual', username=f'user{i}', chat_id=i)))
+
+    def lookup(i):
+        Service.execute(get_one(i % rows + 1))
+
+    inserts = measure(insert, rows)
+    lookups = measure(lookup, rows)
+    Service.close()
+    return inserts, lookups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        text = run(os.path.join(directory, 'text.sqlite3'),
+                   args.rows, ChatDAO.sql_save, ChatDAO.sql_get_one)
+        prepared = run(os.path.join(directory, 'prepared.sqlite3'),
+                       args.rows, ChatDAO.save, ChatDAO.get_one)
+
+    print(f"{'':10} {'sql text':>12} {'prepared':>12}")
+    print(f"{'inserts/s':10} {text[0]:12.0f} {prepared[0]:12.0f}")
+    print(f"{'lookups/s':10} {text[1]:12.0f} {prepared[1]:12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+"""Benchmark suite of model construction, SQL generation and queries.
+
+The code scenarios measure the generated model constructors and the
+DAO query builders, the database scenarios measure the service on an
+in-memory and an on-disk database.
+
+The scenarios of `SQL_TEXT_SCENARIOS` use only the `sql_` queries of
+DAOs and `execute()` of SQL text, the API sqller had from the start.
+They are the only ones run with a version without statements, so the
+same queries can be compared before and after. Such a version opens
+a new connection for every query and loses an in-memory database
+between them, so only the disk database is measured there.
+
+Every scenario is repeated and the best and median times are
+reported. The results may be saved as JSON and compared with the
+results of another version:
+
+Usage:
+    python benchmarks/suite.py [--rows N] [--repeat N] [--only NAME ...]
+                               [--databases memory disk]
+                               [--output results.json] [--compare old.json]
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqller  # noqa: E402
+
+
+class Chat(metaclass=sqller.ModelMeta):
+    NAME = 'chats'
+    FIELDS = [
+        sqller.Field(name="id", dtype="integer", postfix="PRIMARY KEY"),
+        sqller.Field(name="type", dtype="text"),
+        sqller.Field(name="last_name", dtype="text"),
+        sqller.Field(name="first_name", dtype="text"),
+        sqller.Field(name="username", dtype="text"),
+        sqller.Field(name="chat_id", dtype="integer")
+    ]
+
+
+class ChatDAO(metaclass=sqller.DAOMeta):
+    MODEL = Chat
+    sql_find_all_by_username = sqller.CustomQuery()
+    sql_find_all_by_type_and_chat_id = sqller.CustomQuery()
+
+
+# Whether the DAOs make statements, which the first versions did not
+STATEMENTS = hasattr(sqller, 'Statement')
+
+
+def make_chat(i):
+    return Chat(type='private', last_name='Vouk', first_name='Ilya',
+                username=f'user{i}', chat_id=i)
+
+
+# Code scenarios take the number of operations and return nothing
+
+def model_init(count):
+    for i in range(count):
+        Chat(type='private', last_name='Vouk', first_name='Ilya',
+             username='user', chat_id=i)
+
+
+def model_from_row(count):
+    row = (1, 'private', 'Vouk', 'Ilya', 'user', 10)
+    from_row = Chat.from_row
+    for _ in range(count):
+        from_row(row)
+
+
+def sql_save(count):
+    chat = make_chat(1)
+    for _ in range(count):
+        ChatDAO.sql_save(chat)
+
+
+def statement_save(count):
+    chat = make_chat(1)
+    for _ in range(count):
+        ChatDAO.save(chat)
+
+
+def sql_custom_query(count):
+    for i in range(count):
+        ChatDAO.sql_find_all_by_type_and_chat_id(type='private', chat_id=i)
+
+
+def statement_custom_query(count):
+    for i in range(count):
+        ChatDAO.find_all_by_type_and_chat_id(type='private', chat_id=i)
+
+
+CODE_SCENARIOS = {
+    'model_init': model_init,
+    'model_from_row': model_from_row,
+    'sql_save': sql_save,
+    'statement_save': statement_save,
+    'sql_custom_query': sql_custom_query,
+    'statement_custom_query': statement_custom_query,
+}
+
+
+# Database scenarios take the service and the number of rows in the
+# table and return the number of operations. The reading scenarios
+# go first, so that they run on the table of the same size.
+
+def point_lookup(Service, rows):
+    for i in range(rows):
+        Service.fetch_one(ChatDAO.get_one(i + 1))
+    return rows
+
+
+def exists(Service, rows):
+    for i in range(rows):
+        Service.execute(ChatDAO.exists(Chat(username=f'user{i}')))
+    return rows
+
+
+def custom_query(Service, rows):
+    for i in range(rows):
+        Service.fetch_all(ChatDAO.find_all_by_username(username=f'user{i}'))
+    return rows
+
+
+def scan(Service, rows):
+    count = 0
+    for _ in Service.iterate(ChatDAO.find_all()):
+        count += 1
+    return count
+
+
+def scan_models(Service, rows):
+    return len(Service.fetch_all(ChatDAO.find_all()))
+
+
+def single_insert(Service, rows):
+    for i in range(rows):
+        Service.execute(ChatDAO.save(make_chat(i)))
+    return rows
+
+
+def bulk_insert(Service, rows):
+    return Service.execute_many(
+        ChatDAO.save_many([make_chat(i) for i in range(rows)]))
+
+
+def text_point_lookup(Service, rows):
+    for i in range(rows):
+        Service.execute(ChatDAO.sql_get_one(i + 1))
+    return rows
+
+
+def text_exists(Service, rows):
+    for i in range(rows):
+        Service.execute(ChatDAO.sql_exists(Chat(username=f'user{i}')))
+    return rows
+
+
+def text_custom_query(Service, rows):
+    for i in range(rows):
+        Service.execute(ChatDAO.sql_find_all_by_username(username=f'user{i}'))
+    return rows
+
+
+def text_scan(Service, rows):
+    return len(Service.execute(ChatDAO.sql_find_all()))
+
+
+def text_single_insert(Service, rows):
+    for i in range(rows):
+        Service.execute(ChatDAO.sql_save(make_chat(i)))
+    return rows
+
+
+DATABASE_SCENARIOS = {
+    'point_lookup': point_lookup,
+    'exists': exists,
+    'custom_query': custom_query,
+    'scan': scan,
+    'scan_models': scan_models,
+    'single_insert': single_insert,
+    'bulk_insert': bulk_insert,
+    'text_point_lookup': text_point_lookup,
+    'text_exists': text_exists,
+    'text_custom_query': text_custom_query,
+    'text_scan': text_scan,
+    'text_single_insert': text_single_insert,
+}
+
+# Scenarios which also run with the versions without statements
+SQL_TEXT_SCENARIOS = {
+    'model_init', 'sql_save', 'sql_custom_query', 'text_point_lookup',
+    'text_exists', 'text_custom_query', 'text_scan', 'text_single_insert',
+}
+
+
+def measure(function, repeat):
+    """Operations and times of the repeated runs of the function."""
+    times = []
+    operations = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operations = function()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        'operations': operations,
+        'best': best,
+        'median': statistics.median(times),
+        'ops_per_sec': operations / best if best else float('inf'),
+    }
+
+
+def run_code_scenarios(names, rows, repeat):
+    results = {}
+    for name, scenario in CODE_SCENARIOS.items():
+        if name in names and (STATEMENTS or name in SQL_TEXT_SCENARIOS):
+            def run():
+                scenario(rows)
+                return rows
+            results[f"code/{name}"] = measure(run, repeat)
+    return results
+
+
+def run_database_scenarios(names, database, rows, repeat, pragmas):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        if database == 'memory':
+            db_path = ':memory:'
+        else:
+            db_path = os.path.join(directory, 'bench.sqlite3')
+        Service = sqller.ServiceMeta('Service', (), dict(
+            DB_PATH=db_path, MODELS=[Chat], PRAGMAS=pragmas))
+        if STATEMENTS:
+            Service.execute_many(ChatDAO.save_many([make_chat(i) for i in range(rows)]))
+        else:
+            for i in range(rows):
+                Service.execute(ChatDAO.sql_save(make_chat(i)))
+        # Created as SQL text, which every version can run
+        Service.execute("CREATE INDEX IF NOT EXISTS chats_username ON chats(username)")
+
+        for name, scenario in DATABASE_SCENARIOS.items():
+            if name in names and (STATEMENTS or name in SQL_TEXT_SCENARIOS):
+                results[f"{database}/{name}"] = measure(
+                    lambda: scenario(Service, rows), repeat)
+        if STATEMENTS:
+            Service.close()
+    return results
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000,
+                        help="rows in the table and operations per run")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        default=list(CODE_SCENARIOS) + list(DATABASE_SCENARIOS),
+                        choices=list(CODE_SCENARIOS) + list(DATABASE_SCENARIOS))
+    parser.add_argument('--databases', nargs='+', default=['memory', 'disk'],
+                        choices=['memory', 'disk'])
+    parser.add_argument('--pragmas', choices=['default', 'high-throughput'],
+                        default='default', help="PRAGMAS of the service")
+    parser.add_argument('--output', help="file to save the results as JSON")
+    parser.add_argument('--compare', help="JSON results to compare with")
+    args = parser.parse_args()
+
+    pragmas = getattr(sqller, 'HIGH_THROUGHPUT_PRAGMAS', None) \
+        if args.pragmas == 'high-throughput' else None
+    results = run_code_scenarios(args.only, args.rows, args.repeat)
+    for database in args.databases:
+        if database == 'memory' and not STATEMENTS:
+            print("This version does not keep an in-memory database, "
+                  "it is skipped", file=sys.stderr)
+            continue
+        results.update(run_database_scenarios(
+            args.only, database, args.rows, args.repeat, pragmas))
+
+    report = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'rows': args.rows,
+        'repeat': args.repeat,
+        'pragmas': args.pragmas,
+        'results': results,
+    }
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    header = f"{'scenario':30} {'ops/s':>12} {'best, ms':>10} {'median, ms':>11}"
+    print(header + (f" {'vs baseline':>12}" if baseline else ''))
+    for name, result in results.items():
+        line = f"{name:30} {result['ops_per_sec']:12.0f} " \
+               f"{result['best'] * 1000:10.2f} {result['median'] * 1000:11.2f}"
+        if name in baseline and baseline[name]['ops_per_sec']:
+            line += f" {result['ops_per_sec'] / baseline[name]['ops_per_sec']:11.2f}x"
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,27 @@
 from .exceptions import SQLError
 from .exceptions import ConventionViolationError
 from .exceptions import CustomSQLBuildError
+from .exceptions import ConnectionPoolError
 
 from .utils import CustomQuery
 from .utils import Field
+from .utils import Index
 from .utils import is_empty_function
 
 from .metaclasses import ModelMeta
 from .metaclasses import DAOMeta
 from .metaclasses import ServiceMeta
+
+from .analysis import QueryPlanIssue
+from .analysis import check_query_plans
+from .analysis import unindexed_queries
+from .cache import IdentityMap
+from .cache import RowCache
+from .instrumentation import QueryEvent
+from .instrumentation import QueryStats
+from .instrumentation import query_pattern
+from .aio import AsyncServiceMeta
+from .pool import ConnectionPool
+from .pragmas import DURABLE_PRAGMAS
+from .pragmas import HIGH_THROUGHPUT_PRAGMAS
+from .statement import Statement
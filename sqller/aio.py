@@ -0,0 +1,521 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, List, Tuple
+
+from .exceptions import ConventionViolationError
+from .metaclasses import ServiceMeta
+from .pool import TransactionState
+from .statement import Statement
+
+
+class _Call:
+    """Query running in a worker thread, interrupted on cancellation."""
+    __slots__ = ('connection', 'cancelled', 'lock')
+
+    def __init__(self):
+        self.connection = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def start(self, connection) -> bool:
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.connection = connection
+            return True
+
+    def finish(self):
+        with self.lock:
+            self.connection = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.connection is not None:
+                self.connection.interrupt()
+
+
+class _Turns:
+    """Places in the pools of a service for the tasks of one event loop.
+
+    The tasks wait for the connections in the event loop, so the
+    workers which the open transactions need to finish are not
+    blocked. Transactions and `iterate()` hold a connection between
+    the calls; they take a place in the pool first, and transactions
+    also take the turn of the writer. The pool keeps a connection for
+    every worker when it is large enough, and then the single calls
+    take no place. With a smaller pool they take a place as well.
+    """
+    __slots__ = ('writer', 'connections', 'readers')
+
+    def __init__(self, sync, workers: int):
+        self.writer = asyncio.Lock()
+        self.connections = self._places(sync.pool.size, workers)
+        self.readers = None
+        if sync.read_pool is not None:
+            self.readers = self._places(sync.read_pool.size, workers)
+
+    @staticmethod
+    def _places(size: int, workers: int) -> tuple:
+        # Places for holding a connection and for a single call
+        if size > workers:
+            return asyncio.Semaphore(size - workers), None
+        places = asyncio.Semaphore(size)
+        return places, places
+
+    async def take(self, read: bool, hold: bool, write: bool = False) -> asyncio.Semaphore:
+        """Wait for a place in the pool, in the read-only one if
+        `read`, to `hold` a connection or for a single call, and
+        for the turn of the writer if `write`. Returns the place
+        to give back, None if no place was taken.
+        """
+        pool_places = self.readers if read and self.readers is not None else self.connections
+        places = pool_places[0] if hold else pool_places[1]
+        if write:
+            await self.writer.acquire()
+        try:
+            if places is not None:
+                await places.acquire()
+        except BaseException:
+            if write:
+                self.writer.release()
+            raise
+        return places
+
+    def give_back(self, places: asyncio.Semaphore, write: bool = False):
+        if places is not None:
+            places.release()
+        if write:
+            self.writer.release()
+
+
+class AsyncServiceMeta(type):
+    """Metaclass for the services used from asyncio code.
+    Generates coroutines running the queries in worker threads
+    which own the connections, so the event loop is never blocked.
+
+    The class is configured the same way as with `ServiceMeta`,
+    and the synchronous service built from the configuration is
+    available as `sync`. The requests are queued to the workers,
+    and a cancelled request is either dropped from the queue or,
+    if it is running already, interrupted.
+
+    Optionally the class may define:
+        - `WORKERS` - number of worker threads (1).
+
+    Every open transaction and unfinished `iterate()` holds
+    a connection. `POOL_SIZE` minus `WORKERS` of them may be open at
+    once, so that every worker finds a connection, and the others
+    wait in the event loop (with a smaller pool the single queries
+    wait for the connections as well). The transactions take turns,
+    as SQLite has one writer at a time, so a task should not wait
+    inside a transaction for another task opening one.
+    """
+    def __new__(cls, name, bases, dct):
+        c = type.__new__(cls, name, bases, dct)
+
+        generators = AsyncServiceMeta.__get_all_generators()
+        for g in generators:
+            g(c, name, bases, dct)
+        return c
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def __get_all_generators():
+        # The generators are found once, not for every class
+        generators = []
+        for attr_name in AsyncServiceMeta.__dict__:
+            attr = AsyncServiceMeta.__dict__[attr_name]
+            if isinstance(attr, staticmethod):
+                if '__generate' in attr.__func__.__name__ and attr.__func__.__code__.co_argcount == 4:
+                    generators.append(attr.__func__)
+        return tuple(generators)
+
+    @staticmethod
+    def __generate_worker(cls, name, bases, dct):
+        if not 'DB_PATH' in dct or not 'MODELS' in dct:
+            raise ConventionViolationError
+
+        sync = ServiceMeta(name, (), {
+            key: value for key, value in dct.items()
+            if not key.startswith('__')
+        })
+        cls.sync = sync
+        workers = dct.get('WORKERS', 1)
+        cls.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix=f"sqller-{name}"
+        )
+        # Transaction of the task which opened it, the tasks
+        # created inside the block inherit the variable
+        # but run their queries outside of the transaction
+        current = contextvars.ContextVar(f"{name}.transaction", default=None)
+        # Read-only connection held by `iterate()` of the task
+        reading = contextvars.ContextVar(f"{name}.reader", default=None)
+
+        def state_of_task(variable) -> TransactionState:
+            owned = variable.get()
+            if owned is None or owned[0] is not asyncio.current_task():
+                return None
+            return owned[1]
+
+        def transaction_state() -> TransactionState:
+            return state_of_task(current)
+
+        def reader_state() -> TransactionState:
+            return state_of_task(reading)
+        cls._transaction = current
+        cls._reading = reading
+        cls._transaction_state = staticmethod(transaction_state)
+        cls._reader_state = staticmethod(reader_state)
+
+        # Turns of the tasks of every event loop using the service
+        turns_of_loops = weakref.WeakKeyDictionary()
+
+        def turns() -> _Turns:
+            loop = asyncio.get_running_loop()
+            loop_turns = turns_of_loops.get(loop)
+            if loop_turns is None:
+                loop_turns = turns_of_loops[loop] = _Turns(sync, workers)
+            return loop_turns
+        cls._turns = staticmethod(turns)
+
+        def work(call, state, pin, read, function, args):
+            if state is None and pin:
+                pool = sync.pool
+                if read and sync.read_pool is not None:
+                    # Tables are created by a connection which may write
+                    sync.ensure_schema()
+                    pool = sync.read_pool
+                with pool.connection() as connection:
+                    return work(call, TransactionState(connection),
+                                pin, read, function, args)
+            if not call.start(state.connection if state is not None else None):
+                return None
+            try:
+                with sync.bind(state):
+                    return function(*args)
+            finally:
+                call.finish()
+
+        async def run(function, *args, pin: bool = True, read: bool = False):
+            """Call the function in a worker thread with the
+            connection of the current transaction bound to it.
+            Without transaction the call takes a connection from
+            the pool unless `pin` is False, from the read-only pool
+            of `READERS` if `read` is True. The reading calls reuse
+            the read-only connection of `iterate()` of the task.
+            """
+            state = transaction_state()
+            if state is None and read:
+                state = reader_state()
+            if state is None and pin:
+                # Waits for the connection here rather than in a worker
+                loop_turns = turns()
+                places = await loop_turns.take(read, hold=False)
+                if places is not None:
+                    try:
+                        return await run_call(state, pin, read, function, args)
+                    finally:
+                        loop_turns.give_back(places)
+            return await run_call(state, pin, read, function, args)
+
+        async def run_call(state, pin, read, function, args):
+            call = _Call()
+            future = asyncio.get_running_loop().run_in_executor(
+                cls.executor, work, call, state, pin, read, function, args)
+            try:
+                return await future
+            except asyncio.CancelledError:
+                call.cancel()
+                raise
+        cls.run = staticmethod(run)
+
+        async def close():
+            """Wait for the queued requests and close the connections."""
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, cls.executor.shutdown)
+            sync.close()
+        cls.close = staticmethod(close)
+
+    @staticmethod
+    def __generate_schema(cls, name, bases, dct):
+        async def ensure_schema(force: bool = False):
+            """Create the tables of `MODELS`, see `ServiceMeta`."""
+            await cls.run(cls.sync.ensure_schema, force)
+        cls.ensure_schema = staticmethod(ensure_schema)
+
+        async def migrate():
+            """Bring the service database up to date with `MODELS`."""
+            await cls.run(cls.sync.migrate)
+        cls.migrate = staticmethod(migrate)
+
+    @staticmethod
+    def __generate_transaction(cls, name, bases, dct):
+        sync = cls.sync
+        current = cls._transaction
+        transaction_state = cls._transaction_state
+        turns = cls._turns
+
+        def enter(immediate):
+            transaction = sync.transaction(immediate)
+            transaction.__enter__()
+            return transaction, sync.transaction_state()
+
+        def exit(transaction, exc):
+            if exc is None:
+                transaction.__exit__(None, None, None)
+            else:
+                transaction.__exit__(type(exc), exc, exc.__traceback__)
+
+        @asynccontextmanager
+        async def transaction(immediate: bool = False):
+            """Run the queries of the block in one transaction.
+
+            All the queries awaited by the current task inside the
+            block use the same connection and are committed on exit
+            from the block, or rolled back if it raises or the task
+            is cancelled. A nested block is a savepoint inside the
+            outer transaction.
+
+            Arguments:
+                immediate {bool} -- take the write lock of the
+                    database at the start of the transaction.
+            """
+            loop = asyncio.get_running_loop()
+            parent = transaction_state()
+            if parent is None or parent.depth == 0:
+                # The outermost transaction waits for its turn and
+                # a connection before a worker is asked to open it,
+                # unless the task holds one in `iterate()`
+                loop_turns = turns()
+                if parent is None:
+                    places = await loop_turns.take(read=False, hold=True, write=True)
+                else:
+                    places = None
+                    await loop_turns.writer.acquire()
+
+                def give_back(future=None):
+                    loop_turns.give_back(places, write=True)
+            else:
+                def give_back(future=None):
+                    pass
+
+            opening = loop.run_in_executor(
+                cls.executor, _bound, sync, parent, enter, immediate)
+            try:
+                transaction, state = await asyncio.shield(opening)
+            except asyncio.CancelledError:
+                # Roll the transaction back once it is open
+                def close_opened(future):
+                    if not future.cancelled() and future.exception() is None:
+                        transaction, state = future.result()
+                        cls.executor.submit(
+                            _bound, sync, state, exit,
+                            transaction, asyncio.CancelledError()
+                        ).add_done_callback(lambda _: _call_soon(loop, give_back))
+                    else:
+                        give_back()
+                opening.add_done_callback(close_opened)
+                raise
+            except BaseException:
+                give_back()
+                raise
+
+            token = current.set((asyncio.current_task(), state))
+            try:
+                yield
+            except BaseException as e:
+                current.reset(token)
+                closing = loop.run_in_executor(
+                    cls.executor, _bound, sync, state, exit, transaction, e)
+                # The turn is over when the transaction is closed
+                closing.add_done_callback(give_back)
+                await asyncio.shield(closing)
+                raise
+            current.reset(token)
+            closing = loop.run_in_executor(
+                cls.executor, _bound, sync, state, exit, transaction, None)
+            closing.add_done_callback(give_back)
+            await asyncio.shield(closing)
+        cls.transaction = staticmethod(transaction)
+
+        def in_transaction() -> bool:
+            """Whether the current task is inside `transaction()`."""
+            state = transaction_state()
+            return state is not None and state.depth != 0
+        cls.in_transaction = staticmethod(in_transaction)
+
+    @staticmethod
+    def __generate_execute(cls, name, bases, dct):
+        sync = cls.sync
+
+        async def execute(sql_query: str, params: tuple = ()) -> List[Tuple]:
+            """Execute query and fetch all the resulting rows.
+
+            Arguments:
+                sql_query -- SQL text or `Statement` generated by DAO.
+                params -- values bound to `?` placeholders of SQL text.
+            """
+            if not sql_query or isinstance(sql_query, Statement) and not sql_query.sql:
+                # Empty statements are skipped without waiting for a worker
+                return []
+            if isinstance(sql_query, Statement):
+                statement = sql_query
+                if statement.cache is not None and statement.cache_key is not None:
+                    # Cached rows are returned without waiting for a worker
+                    rows = statement.cache.get(statement.cache_key)
+                    if rows is not None:
+                        return list(rows)
+            return await cls.run(sync.execute, sql_query, params,
+                                 read=_is_select(sql_query))
+        cls.execute = staticmethod(execute)
+
+        async def execute_rowcount(sql_query: str, params: tuple = ()) -> int:
+            """Execute query and return the number of the modified rows,
+            see `ServiceMeta.execute_rowcount()`.
+            """
+            if not sql_query or isinstance(sql_query, Statement) and not sql_query.sql:
+                return 0
+            return await cls.run(sync.execute_rowcount, sql_query, params)
+        cls.execute_rowcount = staticmethod(execute_rowcount)
+
+        async def execute_many(sql_query: str, params: Iterable[tuple] = (),
+                               batch_size: int = None) -> int:
+            """Execute query for every set of values in one transaction,
+            see `ServiceMeta.execute_many()`.
+            """
+            return await cls.run(sync.execute_many, sql_query, params, batch_size)
+        cls.execute_many = staticmethod(execute_many)
+
+        async def fetch_all(sql_query: str, params: tuple = (), model: type = None) -> list:
+            """Execute query and load all the resulting rows into models,
+            see `ServiceMeta.fetch_all()`.
+            """
+            return await cls.run(sync.fetch_all, sql_query, params, model,
+                                 read=_is_select(sql_query))
+        cls.fetch_all = staticmethod(fetch_all)
+
+        async def fetch_one(sql_query: str, params: tuple = (), model: type = None):
+            """Execute query and load the first resulting row into model,
+            see `ServiceMeta.fetch_one()`.
+            """
+            return await cls.run(sync.fetch_one, sql_query, params, model,
+                                 read=_is_select(sql_query))
+        cls.fetch_one = staticmethod(fetch_one)
+
+        async def fetch_value(sql_query: str, params: tuple = ()):
+            """Execute query and return the first value of the first
+            resulting row, see `ServiceMeta.fetch_value()`.
+            """
+            rows = await execute(sql_query, params)
+            return rows[0][0] if rows else None
+        cls.fetch_value = staticmethod(fetch_value)
+
+    @staticmethod
+    def __generate_iterate(cls, name, bases, dct):
+        sync = cls.sync
+        current = cls._transaction
+        reading = cls._reading
+        transaction_state = cls._transaction_state
+        reader_state = cls._reader_state
+        turns = cls._turns
+        fetch_size = dct.get('FETCH_SIZE', 500)
+
+        def take(rows, count):
+            return list(itertools.islice(rows, count))
+
+        def acquire(pool):
+            # Tables are created by a connection which may write
+            sync.ensure_schema()
+            return pool.acquire()
+
+        async def iterate(sql_query: str, params: tuple = (),
+                          batch_size: int = None) -> AsyncIterator[Tuple]:
+            """Execute query and yield the resulting rows one by one.
+
+            Every batch of `batch_size` rows (`FETCH_SIZE` of the
+            service by default) is fetched by a worker, the other
+            requests are served between the batches. The connection
+            is held until the iteration is over or the generator
+            is closed, and the queries of the task meanwhile reuse
+            it (only the reading ones reuse a read-only connection).
+
+            Arguments:
+                sql_query -- SQL text or `Statement` generated by DAO.
+                params -- values bound to `?` placeholders of SQL text.
+                batch_size -- number of rows fetched at once.
+            """
+            if batch_size is None:
+                batch_size = fetch_size
+            loop = asyncio.get_running_loop()
+            read = _is_select(sql_query)
+            pinned = None
+            state = transaction_state()
+            if state is None and read:
+                state = reader_state()
+            if state is None:
+                pool, variable = sync.pool, current
+                if read and sync.read_pool is not None:
+                    pool, variable = sync.read_pool, reading
+                loop_turns = turns()
+                places = await loop_turns.take(read, hold=True)
+                try:
+                    connection = await cls.run(acquire, pool, pin=False)
+                except BaseException:
+                    loop_turns.give_back(places)
+                    raise
+                # Bound to the task for the queries between the batches
+                state = TransactionState(connection)
+                previous = variable.get()
+                pinned = (asyncio.current_task(), state)
+                variable.set(pinned)
+            rows = sync.iterate(sql_query, params, batch_size)
+            try:
+                while True:
+                    batch = await cls.run(take, rows, batch_size, read=read)
+                    if not batch:
+                        break
+                    for row in batch:
+                        yield row
+            finally:
+                try:
+                    # Not with `run()`, a shielded coroutine runs in
+                    # a task of its own which does not own the connection
+                    await asyncio.shield(loop.run_in_executor(
+                        cls.executor, _bound, sync, state, rows.close))
+                finally:
+                    if pinned is not None:
+                        # Closed by another task the generator leaves it be
+                        if variable.get() is pinned:
+                            variable.set(previous)
+                        releasing = loop.run_in_executor(
+                            cls.executor, pool.release, connection)
+                        releasing.add_done_callback(
+                            lambda _: loop_turns.give_back(places))
+                        await asyncio.shield(releasing)
+        cls.iterate = staticmethod(iterate)
+
+
+def _is_select(sql_query) -> bool:
+    return isinstance(sql_query, Statement) and sql_query.is_select
+
+
+def _call_soon(loop, callback):
+    """Call the callback in the loop from a worker, unless the loop is closed."""
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        # Nobody waits for the turns of a closed loop
+        pass
+
+
+def _bound(sync, state, function, *args):
+    with sync.bind(state):
+        return function(*args)
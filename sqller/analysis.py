@@ -0,0 +1,256 @@
+import argparse
+import importlib
+import sqlite3
+import string
+import types
+from typing import Iterable, List, Set
+
+from .query import CompiledQuery, PositionalQuery
+
+
+def indexed_columns(model: type) -> Set[str]:
+    """Columns of the model a lookup by equality can use an index for
+
+    These are the primary key and the unique fields, the fields
+    with `index=True` and the first columns of the `INDEXES` of the
+    model. Partial indexes are left out since whether they apply
+    depends on the rest of the query.
+
+    Arguments:
+        model {type} -- model class.
+
+    Returns:
+        set -- names of the columns.
+    """
+    columns = set()
+    for field in model.FIELDS:
+        postfix = (field.postfix or '').upper()
+        if field.unique or 'PRIMARY KEY' in postfix or 'UNIQUE' in postfix:
+            columns.add(field.name)
+    for index in model.indexes:
+        if index.where is None:
+            columns.add(index.columns[0])
+    return columns
+
+
+def unindexed_queries(dao: type) -> List[str]:
+    """Custom queries of the DAO which look the rows up without index
+
+    A name-derived query is reported when none of the columns in
+    its WHERE clause is the first column of an index, so SQLite has
+    to scan the whole table. Queries provided as SQL text are not
+    analysed, see `check_query_plans` for them.
+
+    Arguments:
+        dao {type} -- DAO class.
+
+    Returns:
+        list -- names of the custom queries, e.g.
+            `['sql_find_all_by_username']`.
+    """
+    columns = indexed_columns(dao.MODEL)
+    return [
+        attr_name
+        for attr_name, query in dao.custom_queries.items()
+        if isinstance(query, CompiledQuery)
+        and _filter_keys(dao.MODEL, query)
+        and not columns & _filter_keys(dao.MODEL, query)
+    ]
+
+
+def _filter_keys(model: type, query: CompiledQuery) -> Set[str]:
+    """Keys of the query compared with the columns, without
+    the other keyword arguments like `limit`.
+    """
+    return {key for key in query.keys if key in model.fields_by_name}
+
+
+class QueryPlanIssue:
+    """Query of a DAO with inefficient plan found by `check_query_plans`.
+
+    `problem` is `'full scan'`, `'temp b-tree'` or `'error'` if the
+    plan of the query could not be built, and `detail` is the line of
+    `EXPLAIN QUERY PLAN` output or the error message.
+    """
+    __slots__ = ('name', 'sql', 'problem', 'detail')
+
+    def __init__(self, name: str, sql: str, problem: str, detail: str):
+        self.name = name
+        self.sql = sql
+        self.problem = problem
+        self.detail = detail
+
+    def __repr__(self):
+        return f"QueryPlanIssue({self.name!r}, {self.problem!r}, {self.detail!r})"
+
+
+def _sample_value(dtype: str):
+    dtype = dtype.lower()
+    if 'int' in dtype:
+        return 1
+    if 'char' in dtype or 'text' in dtype or 'clob' in dtype:
+        return ''
+    if 'real' in dtype or 'floa' in dtype or 'doub' in dtype:
+        return 0.0
+    if 'blob' in dtype:
+        return b''
+    return 1
+
+
+def _positional_arguments_count(query: str) -> int:
+    # Arguments are formatted into the query one by one,
+    # as many times as there are replacement fields left
+    count = 0
+    while count < 64 and any(
+            field is not None for _, field, _, _ in string.Formatter().parse(query)):
+        query = query.format('?')
+        count += 1
+    return count
+
+
+def _dao_statements(dao: type) -> list:
+    """Statements of the generated queries of the DAO built with
+    sample values, as triples of the query name, the statement or
+    the error raised building it and whether the query filters the
+    rows, `None` if only its parameters tell that.
+    """
+    model = dao.MODEL
+    obj = model(**{
+        field.name: _sample_value(field.dtype) for field in model.FIELDS})
+    calls = [
+        ('get_one', (1,)),
+        ('find_all', ()),
+        ('find_page_after', (1, 10)),
+        ('exists', (obj,)),
+        ('save', (obj,)),
+        ('save_if_not_exists', (obj,)),
+        ('upsert', (obj,)),
+        ('update', (obj,)),
+        ('delete_by_id', (1,)),
+        ('delete_by_ids', ([1, 2],)),
+    ]
+    for field in model.FIELDS:
+        referenced_column = field.referenced_column()
+        if field.relation is not None and referenced_column is not None:
+            referenced = types.SimpleNamespace(**{referenced_column[1]: 1})
+            calls.append((f"load_{field.relation}", ([obj],)))
+            calls.append((f"load_for_{field.relation}", ([referenced],)))
+    statements = [
+        (f"{dao.__name__}.{attr_name}", getattr(dao, attr_name), args, None)
+        for attr_name, args in calls if hasattr(dao, attr_name)
+    ]
+    for attr_name, query in dao.custom_queries.items():
+        if isinstance(query, CompiledQuery):
+            kwargs = {
+                key: _sample_value(model.fields_by_name[key].dtype)
+                if key in model.fields_by_name else 10
+                for key in query.keys
+            }
+            statements.append((query.name, query.statement, (kwargs,),
+                               bool(_filter_keys(model, query))))
+        elif isinstance(query, PositionalQuery):
+            args = (None,) * _positional_arguments_count(query.query)
+            statements.append((query.name, query.statement, (args,), None))
+
+    built = []
+    for name, function, args, filtered in statements:
+        try:
+            built.append((name, function(*args), filtered))
+        except Exception as e:
+            built.append((name, e, filtered))
+    return built
+
+
+def check_query_plans(daos: Iterable[type], models: Iterable[type] = None) -> List[QueryPlanIssue]:
+    """Find the DAO queries which scan whole tables or sort in temporary B-trees
+
+    The tables of the models are created with their indexes in
+    a scratch in-memory database, and every generated query of the
+    DAOs, including the custom queries, is explained there with
+    sample values. Queries without conditions on the columns, like
+    `find_all` or `find_all_order_by_id_limit`, read the whole table
+    by design and are not reported for scans.
+
+    Arguments:
+        daos {Iterable[type]} -- DAO classes.
+        models {Iterable[type]} -- models of the tables the queries
+            use, e.g. `MODELS` of the service (models of the DAOs).
+
+    Returns:
+        list -- `QueryPlanIssue` of every problem found.
+    """
+    daos = list(daos)
+    if models is None:
+        models = []
+    models = list(models) + [
+        dao.MODEL for dao in daos if dao.MODEL not in models]
+
+    issues = []
+    connection = sqlite3.connect(':memory:')
+    try:
+        for model in models:
+            connection.execute(model.sql_create_table_if_not_exists())
+            for sql_query in model.sql_create_indexes():
+                connection.execute(sql_query)
+
+        for dao in daos:
+            for name, statement, filtered in _dao_statements(dao):
+                if isinstance(statement, Exception):
+                    issues.append(QueryPlanIssue(name, None, 'error', str(statement)))
+                    continue
+                sql_query, params = statement
+                if filtered is None:
+                    filtered = bool(params)
+                try:
+                    plan = connection.execute(
+                        f"EXPLAIN QUERY PLAN {sql_query}", params).fetchall()
+                except sqlite3.Error as e:
+                    issues.append(QueryPlanIssue(name, sql_query, 'error', str(e)))
+                    continue
+                for row in plan:
+                    detail = row[-1]
+                    if (detail.startswith('SCAN ') and filtered
+                            and 'VIRTUAL TABLE' not in detail
+                            and 'CONSTANT ROW' not in detail):
+                        issues.append(QueryPlanIssue(name, sql_query, 'full scan', detail))
+                    elif detail.startswith('USE TEMP B-TREE'):
+                        issues.append(QueryPlanIssue(name, sql_query, 'temp b-tree', detail))
+    finally:
+        connection.close()
+    return issues
+
+
+def main(argv: List[str] = None) -> int:
+    """Report the query plan issues of the DAOs of the modules.
+
+    The DAOs and the models of the services found in the modules
+    are checked with `check_query_plans`, the exit status is 1 if
+    there are issues, so that the check can run before deploy:
+
+        python -m sqller myapp.dao myapp.service
+    """
+    from .metaclasses import DAOMeta, ServiceMeta
+
+    parser = argparse.ArgumentParser(
+        prog='python -m sqller',
+        description="Check query plans of the DAOs of the modules.")
+    parser.add_argument('modules', nargs='+', help="modules with DAOs and services")
+    args = parser.parse_args(argv)
+
+    daos = []
+    models = []
+    for module_name in args.modules:
+        module = importlib.import_module(module_name)
+        for attr in vars(module).values():
+            if isinstance(attr, DAOMeta) and attr not in daos:
+                daos.append(attr)
+            elif isinstance(attr, ServiceMeta):
+                models.extend(m for m in attr.MODELS if m not in models)
+
+    issues = check_query_plans(daos, models)
+    for issue in issues:
+        print(f"{issue.name}: {issue.problem}: {issue.detail}")
+        if issue.sql is not None:
+            print(f"    {' '.join(issue.sql.split())}")
+    return 1 if issues else 0
+
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RowCache:
+    """LRU cache of query results keyed by the primary key.
+
+    Assigned to `CACHE` of a DAO, it is consulted by the services
+    before running `get_one` and is invalidated by the DAO update
+    and delete queries. Entries expire after `ttl` seconds if it
+    is given, and the least recently used entry is evicted when
+    there are more than `maxsize` of them.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        if maxsize < 1:
+            raise ValueError("Cache size should be a positive number.")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Cached value of the key or None if there is no such entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Counters of the cache usage."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class IdentityMap:
+    """Model objects loaded in a session of a service.
+
+    Objects are kept by `(MODEL.NAME, id)`, so loading a row of the
+    same table with the same id returns the object loaded first,
+    even if it has been changed since. Partial models and models
+    without `id` field are not kept. Used by one thread, which is
+    why there is no lock.
+    """
+    __slots__ = ('objects', '_id_indexes')
+
+    def __init__(self):
+        self.objects = {}
+        # Position of `id` in the rows of every model, None if
+        # the objects of the model are not kept
+        self._id_indexes = {}
+
+    def _id_index(self, model: type):
+        try:
+            return self._id_indexes[model]
+        except KeyError:
+            index = None
+            if getattr(model, 'PARTIAL_OF', None) is None:
+                names = [field.name for field in model.FIELDS]
+                if 'id' in names:
+                    index = names.index('id')
+            self._id_indexes[model] = index
+            return index
+
+    def get(self, model: type, id):
+        """Kept object of the model with the id or None."""
+        if self._id_index(model) is None:
+            return None
+        obj = self.objects.get((model.NAME, id))
+        return obj if type(obj) is model else None
+
+    def load(self, model: type, row: tuple):
+        """Kept object with the id of the row, otherwise the new
+        object of the row, which is kept from now on."""
+        index = self._id_index(model)
+        if index is None:
+            return model.from_row(row)
+        key = (model.NAME, row[index])
+        obj = self.objects.get(key)
+        if obj is None or type(obj) is not model:
+            obj = self.objects[key] = model.from_row(row)
+        return obj
+
+    def evict(self, ids):
+        """Forget the objects with the ids in all the tables,
+        or all the objects if `ids` is True."""
+        if ids is True:
+            self.objects.clear()
+            return
+        names = {name for name, _ in self.objects}
+        for id in ids:
+            for name in names:
+                self.objects.pop((name, id), None)
+
+    def clear(self):
+        self.objects.clear()
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __contains__(self, key):
+        return key in self.objects
@@ -8,3 +8,7 @@ class SQLError(Exception):
 
 class CustomSQLBuildError(SQLError):
     pass
+
+
+class ConnectionPoolError(SQLError):
+    pass
@@ -0,0 +1,173 @@
+import bisect
+import functools
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, List
+
+logger = logging.getLogger('sqller')
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+    float('inf'),
+)
+
+# Quoted identifiers are kept, string and number literals are matched
+_LITERALS = re.compile(
+    r'("(?:[^"]|"")*")'
+    r"|'(?:[^']|'')*'"
+    r"|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"
+)
+_PLACEHOLDER_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+@functools.lru_cache(maxsize=1024)
+def query_pattern(sql: str) -> str:
+    """SQL text with the literal values replaced by `?`, the name
+    the queries written by hand are reported under.
+
+    Lists of values become a single `?`, so the queries which differ
+    only in the values share the name, e.g. `SELECT * FROM chats
+    WHERE id IN (?)` for `... WHERE id IN (1, 2, 3)`.
+    """
+    pattern = _LITERALS.sub(lambda match: match.group(1) or '?', sql)
+    return _PLACEHOLDER_LISTS.sub('?', pattern)
+
+
+class QueryEvent:
+    """Query executed by a service, passed to the hooks.
+
+    `name` is the name of the DAO method which generated the query,
+    e.g. `ChatDAO.get_one` or `ChatDAO.sql_exists`, and for the queries
+    written by hand their `query_pattern()`, the SQL text without the
+    literal values. `rows` is the number of
+    the selected rows, or of the modified ones if nothing is selected.
+    `elapsed` and `rows` are set before `after_execute` is called, as
+    well as `error` if the query raised.
+    """
+    __slots__ = ('service', 'name', 'sql', 'params',
+                 'rows', 'elapsed', 'error')
+
+    def __init__(self, service: type, name: str, sql: str, params=()):
+        self.service = service
+        self.name = name
+        self.sql = sql
+        self.params = params
+        self.rows = 0
+        self.elapsed = 0.0
+        self.error = None
+
+    def __repr__(self):
+        return f"QueryEvent({self.name!r}, rows={self.rows}, elapsed={self.elapsed:.6f})"
+
+
+class _QueryStatsEntry:
+    __slots__ = ('count', 'errors', 'rows', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket the percentile falls into."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+
+class QueryStats:
+    """Hook of the services aggregating the query timings by name.
+
+    Keeps the number of executions, errors and rows, and a latency
+    histogram for every query name. Queries taking `slow_threshold`
+    seconds or longer are logged as warnings to the `sqller` logger
+    and the last `slow_log_size` of them are kept in `slow_queries`.
+
+        stats = QueryStats(slow_threshold=0.1)
+        ChatService.add_hook(stats)
+        ...
+        stats.snapshot()['ChatDAO.get_one']['p95']
+    """
+
+    def __init__(self, slow_threshold: float = None, slow_log_size: int = 100):
+        self.slow_threshold = slow_threshold
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def after_execute(self, event: QueryEvent):
+        elapsed = event.elapsed
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, elapsed)
+        with self._lock:
+            entry = self._entries.get(event.name)
+            if entry is None:
+                entry = self._entries[event.name] = _QueryStatsEntry()
+            entry.count += 1
+            entry.rows += event.rows
+            entry.total += elapsed
+            if elapsed > entry.max:
+                entry.max = elapsed
+            entry.buckets[bucket] += 1
+            if event.error is not None:
+                entry.errors += 1
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.slow_queries.append(
+                (time.time(), event.name, event.sql, elapsed))
+            logger.warning("Slow query %s took %.3f s: %s",
+                           event.name, elapsed, event.sql)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Statistics of every query name.
+
+        Returns:
+            dict -- name of the query mapped to dict with `count`,
+                `errors`, `rows`, `total`, `mean`, `max`, `p50`,
+                `p95` and `p99` latencies in seconds and `histogram`,
+                the list of pairs of bucket upper bound and count.
+        """
+        with self._lock:
+            return {
+                name: {
+                    'count': entry.count,
+                    'errors': entry.errors,
+                    'rows': entry.rows,
+                    'total': entry.total,
+                    'mean': entry.total / entry.count,
+                    'max': entry.max,
+                    'p50': entry.percentile(0.5),
+                    'p95': entry.percentile(0.95),
+                    'p99': entry.percentile(0.99),
+                    'histogram': list(zip(LATENCY_BUCKETS, entry.buckets)),
+                }
+                for name, entry in self._entries.items()
+            }
+
+    def slowest(self, count: int = 10) -> List[tuple]:
+        """Names of the queries with the largest total time.
+
+        Returns:
+            list -- pairs of query name and total time in seconds.
+        """
+        with self._lock:
+            totals = [(name, entry.total) for name, entry in self._entries.items()]
+        return sorted(totals, key=lambda total: total[1], reverse=True)[:count]
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+        self.slow_queries.clear()
@@ -1,8 +1,99 @@
+import atexit
+import functools
+import itertools
+import json
+import operator
+import os
 import sqlite3
-from typing import Iterable, Tuple
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Tuple
 
-from .exceptions import ConventionViolationError, CustomSQLBuildError
-from .utils import CustomQuery, Field, is_empty_function
+from .cache import IdentityMap
+from .exceptions import ConnectionPoolError, ConventionViolationError
+from .instrumentation import QueryEvent, logger, query_pattern
+from .parallel import id_ranges, scan_partition
+from .pool import ConnectionPool, TransactionState
+from .query import PositionalQuery, parse_custom_query
+from .statement import SQLText, Statement
+from .utils import (CustomQuery, Field, Index, LazyAttribute, Reference, compile_function,
+                    is_empty_function, is_plain_names, sql_literal, sql_text)
+
+def _filter_conditions(model: type, filters: dict, text: bool = False) -> Tuple[str, list]:
+    """WHERE clause comparing the columns with the values of the filters
+
+    None is compared with `IS NULL` and a list, tuple or set of values
+    with `IN`. In the placeholder form the values of `IN` are bound as
+    one JSON array, so the SQL does not depend on their number.
+
+    Arguments:
+        model {type} -- model of the table.
+        filters {dict} -- names of the fields and their values.
+        text {bool} -- write the values into SQL instead of `?`.
+
+    Raises:
+        ConventionViolationError -- the model has no such field.
+
+    Returns:
+        tuple -- WHERE clause (empty without filters) and the values.
+    """
+    conditions = []
+    params = []
+    for column, value in filters.items():
+        field = model.fields_by_name.get(column)
+        if field is None:
+            raise ConventionViolationError(
+                f"Model {model.__name__} has no field `{column}`.")
+        if value is None:
+            conditions.append(f"{column} IS NULL")
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            if text:
+                values = ', '.join([sql_literal(v, field.dtype) for v in value])
+                conditions.append(f"{column} IN ({values})")
+            else:
+                conditions.append(f"{column} IN (SELECT value FROM json_each(?))")
+                params.append(json.dumps(list(value)))
+        elif text:
+            conditions.append(f"{column} = {sql_literal(value, field.dtype)}")
+        else:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if not conditions:
+        return '', params
+    return "\nWHERE " + " AND ".join(conditions), params
+
+
+def _selected_columns(model: type, columns) -> str:
+    """Columns of SELECT in the text form of the queries."""
+    if columns is None:
+        return '*'
+    model.partial(*columns)
+    return ', '.join(columns)
+
+
+class _Projections:
+    """SQL of a query selecting the given columns, built once per
+    tuple of the columns along with the partial model of the rows.
+    An empty tuple selects all the fields of the model.
+    """
+
+    def __init__(self, model: type, make_query):
+        self.model = model
+        self.make_query = make_query
+        self.queries = {}
+
+    def get(self, columns) -> Tuple[str, type]:
+        columns = tuple(columns)
+        projection = self.queries.get(columns)
+        if projection is None:
+            if columns:
+                selected, result_model = columns, self.model.partial(*columns)
+            else:
+                selected, result_model = [f.name for f in self.model.FIELDS], self.model
+            projection = (self.make_query(', '.join(selected)), result_model)
+            self.queries[columns] = projection
+        return projection
 
 
 class ModelMeta(type):
@@ -14,9 +105,49 @@ class ModelMeta(type):
     Requires class of the metaclass to have defined:
         - `NAME` - name of the database table.
         - `FIELDS` - list of fields in the table.
+
+    Optionally the class may define:
+        - `INDEXES` - list of `Index` of the table.
+
+    A class attribute with the name of a field, e.g. `type = 'usual'`,
+    is the default value of the field in the constructor, the rest
+    of the fields are None by default.
+
+    Objects loaded from rows keep the loaded values to tell which
+    fields have been changed since, see `changed_fields()`. Fields
+    with `relation` get an attribute for the referenced object,
+    which is set by the relationship loaders of DAO.
     """
     def __new__(cls, name, bases, dct):
+        defaults = {}
+        if 'FIELDS' in dct:
+            names = {field.name for field in dct['FIELDS']}
+            for field in dct['FIELDS']:
+                if field.name not in dct:
+                    continue
+                if hasattr(type(dct[field.name]), '__get__'):
+                    raise ConventionViolationError(
+                        f"Field {field.name} of {name} is also a method or a descriptor.")
+                # Slots of the fields cannot have class-level values
+                defaults[field.name] = dct.pop(field.name)
+            for field in dct['FIELDS']:
+                if field.relation is None or field.relation not in names:
+                    continue
+                if not field._default_relation:
+                    raise ConventionViolationError(
+                        f"Relation {field.relation} of {field.name} "
+                        f"has the name of a field of {name}.")
+                # `chat` is a column itself, there is no default relation
+                field.relation = None
+        if 'FIELDS' in dct and '__slots__' not in dct:
+            dct['__slots__'] = tuple([
+                field.name for field in dct['FIELDS']
+            ]) + tuple([
+                field.relation for field in dct['FIELDS']
+                if field.relation is not None and field.relation not in dct
+            ]) + ('_loaded',)
         c = type.__new__(cls, name, bases, dct)
+        c.field_defaults = defaults
 
         generators = ModelMeta.__get_all_generators()
         for g in generators:
@@ -24,14 +155,16 @@ class ModelMeta(type):
         return c
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def __get_all_generators():
+        # The generators are found once, not for every class
         generators = []
         for attr_name in ModelMeta.__dict__:
             attr = ModelMeta.__dict__[attr_name]
             if isinstance(attr, staticmethod):
                 if '__generate' in attr.__func__.__name__ and attr.__func__.__code__.co_argcount == 4:
                     generators.append(attr.__func__)
-        return generators
+        return tuple(generators)
 
     @staticmethod
     def __generate_create_table_if_not_exists(cls, name, bases, dct):
@@ -49,16 +182,118 @@ class ModelMeta(type):
         setattr(cls, 'sql_create_table_if_not_exists',
                 sql_create_table_if_not_exists)
 
+    @staticmethod
+    def __generate_create_indexes(cls, name, bases, dct):
+        if not 'FIELDS' in dct or not 'NAME' in dct:
+            raise ConventionViolationError
+
+        indexes = [Index(field.name) for field in dct['FIELDS'] if field.index]
+        indexes += list(dct.get('INDEXES', []))
+        field_names = {field.name for field in dct['FIELDS']}
+        for index in indexes:
+            if not set(index.columns) <= field_names:
+                raise ConventionViolationError(
+                    f"Index of {name} refers to unknown columns {index.columns}.")
+        cls.indexes = indexes
+
+        @staticmethod
+        def sql_create_indexes() -> List[str]:
+            return [index.sql_create(dct['NAME']) for index in indexes]
+        cls.sql_create_indexes = sql_create_indexes
+
     @staticmethod
     def __generate_all_arguments_constructor(cls, name, bases, dct):
         if not 'FIELDS' in dct:
             raise ConventionViolationError
 
-        def init(self, *args, **kwargs):
-            for field in dct['FIELDS']:
-                value = kwargs.get(field.name, None)
-                setattr(self, field.name, value)
-        cls.__init__ = init
+        names = [field.name for field in dct['FIELDS']]
+        defaults = cls.field_defaults
+
+        def build():
+            if is_plain_names(names) and not {'self', 'args', 'kwargs'} & set(names):
+                source = "def init(self, *args, "
+                source += "".join(
+                    f"{name}=defaults[{name!r}], " if name in defaults else f"{name}=None, "
+                    for name in names)
+                source += "**kwargs):\n"
+                source += "".join(f"    self.{name} = {name}\n" for name in names)
+                source += "    pass\n"
+                return compile_function('init', source, {'defaults': defaults})
+
+            def init(self, *args, **kwargs):
+                for field in dct['FIELDS']:
+                    value = kwargs.get(field.name, defaults.get(field.name))
+                    setattr(self, field.name, value)
+            return init
+        # Compiled on the first construction of an object
+        cls.__init__ = LazyAttribute(cls, '__init__', build)
+
+    @staticmethod
+    def __generate_row_factory(cls, name, bases, dct):
+        if not 'FIELDS' in dct:
+            raise ConventionViolationError
+
+        names = [field.name for field in dct['FIELDS']]
+        # Models with their own `__slots__` may have no place for the
+        # loaded values, their objects are never considered unchanged
+        tracked = '_loaded' in dct.get('__slots__', ('_loaded',))
+
+        def build():
+            if is_plain_names(names) and names:
+                source = "def from_row(row):\n"
+                source += "    obj = new(cls)\n"
+                source += "    " + ", ".join(f"obj.{name}" for name in names) + ", = row\n"
+                if tracked:
+                    source += "    obj._loaded = row\n"
+                source += "    return obj\n"
+                from_row = compile_function(
+                    'from_row', source, {'new': object.__new__, 'cls': cls})
+            else:
+                def from_row(row):
+                    obj = object.__new__(cls)
+                    for name, value in zip(names, row):
+                        setattr(obj, name, value)
+                    if tracked:
+                        obj._loaded = row
+                    return obj
+            from_row.__doc__ = "Create object from row with values of `FIELDS` in their order."
+            return staticmethod(from_row)
+        # Compiled on the first load of a row
+        cls.from_row = LazyAttribute(cls, 'from_row', build)
+
+    @staticmethod
+    def __generate_changed_fields(cls, name, bases, dct):
+        if not 'FIELDS' in dct:
+            raise ConventionViolationError
+
+        names = tuple([field.name for field in dct['FIELDS']])
+
+        def changed_fields(self) -> Tuple[str, ...]:
+            """Names of the fields changed since the object was loaded
+            or marked clean, in the order of `FIELDS`.
+
+            All the fields of an object which was created rather than
+            loaded are considered changed. Fields set to `...` never
+            are, just like for `update()` of DAO.
+            """
+            loaded = getattr(self, '_loaded', None)
+            if loaded is None:
+                return tuple([
+                    name for name in names if getattr(self, name) is not ...
+                ])
+            changed = []
+            for name, old in zip(names, loaded):
+                value = getattr(self, name)
+                if value is not old and value is not ... and value != old:
+                    changed.append(name)
+            return tuple(changed)
+        cls.changed_fields = changed_fields
+
+        def mark_clean(self):
+            """Consider the current values of the fields saved, e.g.
+            after the object is inserted or updated."""
+            self._loaded = tuple([getattr(self, name) for name in names])
+        cls.mark_clean = mark_clean
 
     @staticmethod
     def __generate_reference(cls, name, bases, dct):
@@ -67,28 +302,119 @@ class ModelMeta(type):
 
         @staticmethod
         def reference(name: str):
-            field = [f for f in dct['FIELDS'] if f.name == name][0]
-            return f"{dct['NAME']}({field.name})"
+            field = cls.fields_by_name[name]
+            return Reference(f"{dct['NAME']}({field.name})", cls)
         cls.reference = reference
 
+    @staticmethod
+    def __generate_fields_by_name(cls, name, bases, dct):
+        if not 'FIELDS' in dct:
+            raise ConventionViolationError
+
+        cls.fields_by_name = {field.name: field for field in dct['FIELDS']}
+
+    @staticmethod
+    def __generate_partial(cls, name, bases, dct):
+        if not 'FIELDS' in dct or not 'NAME' in dct:
+            raise ConventionViolationError
+
+        names = tuple([field.name for field in dct['FIELDS']])
+        # Partial model for every tuple of the columns
+        partials = {}
+
+        @staticmethod
+        def partial(*columns: str) -> type:
+            """Model with only the given fields of this model.
+
+            Objects of the partial model have slots only for the
+            selected columns, so loading them costs less than loading
+            the whole rows. The partial models are created once per
+            set of columns, the model itself is returned for all of its
+            fields in their order.
+
+            Raises:
+                ConventionViolationError -- the model has no such field.
+            """
+            model = partials.get(columns)
+            if model is None:
+                if columns == names:
+                    return cls
+                unknown = [c for c in columns if c not in cls.fields_by_name]
+                if unknown or not columns:
+                    raise ConventionViolationError(
+                        f"Model {name} has no fields {unknown}.")
+                model = ModelMeta(f"{name}Partial", (), {
+                    '__module__': cls.__module__,
+                    '__qualname__': f"{cls.__qualname__}.partial({', '.join(columns)})",
+                    'NAME': dct['NAME'],
+                    'FIELDS': [cls.fields_by_name[c] for c in columns],
+                    'PARTIAL_OF': cls,
+                })
+                partials[columns] = model
+            return model
+        cls.partial = partial
+
 
 class DAOMeta(type):
+    """Metaclass for the data access objects.
+    Generates queries to the table of the model.
+
+    Every query is generated in two forms. `sql_<query>` returns
+    text of the query with the values written into it, while
+    `<query>` returns `Statement` with `?` placeholders and the
+    values to bind, e.g. `sql_get_one(1)` and `get_one(1)`.
+
+    Requires class of the metaclass to have defined:
+        - `MODEL` - model of the table.
+
+    Optionally the class may define:
+        - `CACHE` - `RowCache` for the results of `get_one`.
+          The cached rows are invalidated by the update and delete
+          queries of the DAO: on execution for the prepared form,
+          on generation for the `sql_` form.
+        - `UPSERT_KEY` - columns of the unique constraint `upsert`
+          resolves conflicts on (each unique field, or `id`).
+    """
     def __new__(cls, name, bases, dct):
         c = type.__new__(cls, name, bases, dct)
         generators = DAOMeta.__get_all_generators()
         for g in generators:
             g(c, name, bases, dct)
+        DAOMeta.__name_sql_queries(c, name, dct)
         return c
 
     @staticmethod
+    def __name_sql_queries(cls, name, dct):
+        # Text of the generated queries is named after the DAO method,
+        # so that the services can tell the queries apart
+        def named_factory(function, statement_name):
+            text_class = SQLText.named(statement_name)
+
+            @staticmethod
+            @functools.wraps(function)
+            def named(*args, **kwargs):
+                return text_class(function(*args, **kwargs))
+            return named
+
+        for attr_name, attr in list(cls.__dict__.items()):
+            # The text of the custom queries is named by their factories
+            if (attr_name.startswith('sql_') and isinstance(attr, staticmethod)
+                    and attr_name not in dct):
+                # Wrapped on first access
+                setattr(cls, attr_name, LazyAttribute(cls, attr_name, functools.partial(
+                    named_factory, attr.__func__, f"{name}.{attr_name}")))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
     def __get_all_generators():
+        # The generators are found once, not for every class
         generators = []
         for attr_name in DAOMeta.__dict__:
             attr = DAOMeta.__dict__[attr_name]
             if isinstance(attr, staticmethod):
                 if '__generate' in attr.__func__.__name__ and attr.__func__.__code__.co_argcount == 4:
                     generators.append(attr.__func__)
-        return generators
+        return tuple(generators)
 
     @staticmethod
     def __generate_get_one(cls, name, bases, dct):
@@ -99,20 +425,101 @@ class DAOMeta(type):
             raise RuntimeError(
                 "Model should have `id` field for DAOMeta generation.")
 
+        model = dct['MODEL']
+
         @staticmethod
-        def sql_get_one(id: int) -> str:
-            sql_query = f"SELECT * FROM {dct['MODEL'].NAME}\nWHERE id = {id}\nLIMIT 1;"
+        def sql_get_one(id: int, columns: Tuple[str] = None) -> str:
+            sql_query = f"SELECT {_selected_columns(model, columns)} " \
+                f"FROM {model.NAME}\nWHERE id = {id}\nLIMIT 1;"
             return sql_query
         cls.sql_get_one = sql_get_one
 
+        def make_query(columns):
+            return f"SELECT {columns} FROM {model.NAME}\nWHERE id = ?\nLIMIT 1;"
+        sql_query = make_query(', '.join([f.name for f in model.FIELDS]))
+        projections = _Projections(model, make_query)
+        statement_name = f"{name}.get_one"
+
+        cache = dct.get('CACHE')
+
+        @staticmethod
+        def get_one(id: int, columns: Tuple[str] = None) -> Statement:
+            """Object with the id, or only its `columns` loaded into
+            the partial model, which are not cached.
+            """
+            if columns is None:
+                return Statement(sql_query, (id,), statement_name, model,
+                                 cache=cache, cache_key=id)
+            projected_query, partial = projections.get(columns)
+            return Statement(projected_query, (id,), statement_name, partial)
+        cls.get_one = get_one
+
     @staticmethod
     def __generate_find_all(cls, name, bases, dct):
+        model = dct['MODEL']
+
         @staticmethod
-        def sql_find_all() -> str:
-            sql_query = f"SELECT * FROM {dct['MODEL'].NAME};"
+        def sql_find_all(columns: Tuple[str] = None) -> str:
+            sql_query = f"SELECT {_selected_columns(model, columns)} FROM {model.NAME};"
             return sql_query
         cls.sql_find_all = sql_find_all
 
+        def make_query(columns):
+            return f"SELECT {columns} FROM {model.NAME};"
+        statement = Statement(
+            make_query(', '.join([f.name for f in model.FIELDS])), (),
+            f"{name}.find_all", model)
+        projections = _Projections(model, make_query)
+
+        @staticmethod
+        def find_all(columns: Tuple[str] = None) -> Statement:
+            if columns is None:
+                return statement
+            projected_query, partial = projections.get(columns)
+            return Statement(projected_query, (), statement.name, partial)
+        cls.find_all = find_all
+
+    @staticmethod
+    def __generate_find_page_after(cls, name, bases, dct):
+        model = dct['MODEL']
+
+        @staticmethod
+        def sql_find_page_after(id: int = None, limit: int = 100,
+                                columns: Tuple[str] = None) -> str:
+            sql_query = f"SELECT {_selected_columns(model, columns)} FROM {model.NAME}\n"
+            if id is not None:
+                sql_query += f"WHERE id > {int(id)}\n"
+            sql_query += f"ORDER BY id\nLIMIT {int(limit)};"
+            return sql_query
+        cls.sql_find_page_after = sql_find_page_after
+
+        def make_first_page_query(columns):
+            return f"SELECT {columns} FROM {model.NAME}\nORDER BY id\nLIMIT ?;"
+
+        def make_next_page_query(columns):
+            return f"SELECT {columns} FROM {model.NAME}\n" \
+                "WHERE id > ?\nORDER BY id\nLIMIT ?;"
+        first_page_projections = _Projections(model, make_first_page_query)
+        next_page_projections = _Projections(model, make_next_page_query)
+        statement_name = f"{name}.find_page_after"
+
+        @staticmethod
+        def find_page_after(id: int = None, limit: int = 100,
+                            columns: Tuple[str] = None) -> Statement:
+            """Page of `limit` objects following the object with the id
+            in the order of the primary key, or the first page if the id
+            is None. The query reads only the rows of the page, however
+            far the page is.
+            """
+            if columns is None:
+                columns = ()
+            if id is None:
+                sql_query, result_model = first_page_projections.get(columns)
+                return Statement(sql_query, (limit,), statement_name, result_model)
+            sql_query, result_model = next_page_projections.get(columns)
+            return Statement(sql_query, (id, limit), statement_name, result_model)
+        cls.find_page_after = find_page_after
+
     @staticmethod
     def __generate_save(cls, name, bases, dct):
         @staticmethod
@@ -122,12 +529,63 @@ class DAOMeta(type):
             for field in dct['MODEL'].FIELDS:
                 if getattr(obj, field.name) != None and field.name != 'id':
                     sql_query_start += f'{field.name},'
-                    sql_query_end += f'{getattr(obj, field.name)},' if field.dtype != 'text' else f"'{getattr(obj, field.name)}',"
+                    sql_query_end += sql_literal(getattr(obj, field.name), field.dtype) + ','
             sql_query = sql_query_start[:-1] + \
                 ')' + '\n' + sql_query_end[:-1] + ')'
             return sql_query
         cls.sql_save = sql_save
 
+        fields = [f.name for f in dct['MODEL'].FIELDS if f.name != 'id']
+        statement_name = f"{name}.save"
+        # Query for every set of the inserted columns
+        sql_queries = {}
+
+        def insert_query(columns: Tuple[str]) -> str:
+            sql_query = sql_queries.get(columns)
+            if sql_query is None:
+                if columns:
+                    sql_query = f"INSERT INTO {dct['MODEL'].NAME}({','.join(columns)})" + \
+                        f"\nVALUES ({','.join('?' * len(columns))})"
+                else:
+                    sql_query = f"INSERT INTO {dct['MODEL'].NAME} DEFAULT VALUES"
+                sql_queries[columns] = sql_query
+            return sql_query
+
+        @staticmethod
+        def save(obj: dct['MODEL']) -> Statement:
+            columns = []
+            params = []
+            for field in fields:
+                value = getattr(obj, field)
+                if value is not None:
+                    columns.append(field)
+                    params.append(value)
+            columns = tuple(columns)
+            return Statement(insert_query(columns), tuple(params), statement_name)
+        cls.save = save
+
+        many_statement_name = f"{name}.save_many"
+
+        @staticmethod
+        def save_many(objs: Iterable[dct['MODEL']]) -> Statement:
+            """Insert statement for `ServiceMeta.execute_many`.
+
+            All the objects are inserted with one query, so the
+            columns set in any of the objects are inserted for
+            every object, with NULL where the value is None.
+            """
+            objs = list(objs)
+            columns = tuple([
+                field for field in fields
+                if any(getattr(obj, field) is not None for obj in objs)
+            ])
+            params = [
+                tuple([getattr(obj, column) for column in columns])
+                for obj in objs
+            ]
+            return Statement(insert_query(columns), params, many_statement_name)
+        cls.save_many = save_many
+
     @staticmethod
     def __generate_exists(cls, name, bases, dct):
         @staticmethod
@@ -140,125 +598,482 @@ class DAOMeta(type):
                         sql_query += " AND "
                     else:
                         sql_query += " WHERE "
-                    sql_value = f"{getattr(obj, field.name)}" if field.dtype != 'text' else f"'{getattr(obj, field.name)}'"
+                    sql_value = sql_literal(getattr(obj, field.name), field.dtype)
                     sql_query += f"{field.name} = {sql_value}"
                     i += 1
             sql_query += ";"
             return sql_query
         cls.sql_exists = sql_exists
 
+        fields = [f.name for f in dct['MODEL'].FIELDS if f.name != 'id']
+        statement_name = f"{name}.exists"
+        # Query for every set of the compared columns
+        sql_queries = {}
+
+        @staticmethod
+        def exists(obj: dct['MODEL']) -> Statement:
+            columns = []
+            params = []
+            for field in fields:
+                value = getattr(obj, field)
+                if value is not None:
+                    columns.append(field)
+                    params.append(value)
+            columns = tuple(columns)
+            sql_query = sql_queries.get(columns)
+            if sql_query is None:
+                sql_query = f"SELECT EXISTS(SELECT 1 FROM {dct['MODEL'].NAME}"
+                if columns:
+                    sql_query += " WHERE " + \
+                        " AND ".join(f"{column} = ?" for column in columns)
+                sql_query += " LIMIT 1);"
+                sql_queries[columns] = sql_query
+            return Statement(sql_query, tuple(params), statement_name)
+        cls.exists = exists
+
+    @staticmethod
+    def __generate_upsert(cls, name, bases, dct):
+        model = dct['MODEL']
+        cache = dct.get('CACHE')
+        fields = [f.name for f in model.FIELDS]
+        if 'UPSERT_KEY' in dct:
+            conflict_targets = [tuple(dct['UPSERT_KEY'])]
+        else:
+            conflict_targets = [(f.name,) for f in model.FIELDS if f.unique]
+            if not conflict_targets:
+                conflict_targets = [('id',)]
+        conflict_columns = {column for target in conflict_targets for column in target}
+        statement_name = f"{name}.upsert"
+        # Query for every set of the inserted columns
+        sql_queries = {}
+
+        @staticmethod
+        def upsert(obj: dct['MODEL'], update: bool = True) -> Statement:
+            """Insert the object, or on conflict with the existing row
+            by `UPSERT_KEY` of the DAO (the unique fields or `id` by
+            default) update the row with the values of the object, or
+            keep it as it is if `update` is False.
+            """
+            columns = []
+            params = []
+            for field in fields:
+                value = getattr(obj, field)
+                if value is not None:
+                    columns.append(field)
+                    params.append(value)
+            columns = tuple(columns)
+            sql_query = sql_queries.get((columns, update))
+            if sql_query is None and not columns:
+                # There is nothing to update, and UPSERT is not
+                # allowed with DEFAULT VALUES
+                sql_query = f"INSERT OR IGNORE INTO {model.NAME} DEFAULT VALUES"
+                sql_queries[(columns, update)] = sql_query
+            if sql_query is None:
+                sql_query = f"INSERT INTO {model.NAME}({','.join(columns)})" + \
+                    f"\nVALUES ({','.join('?' * len(columns))})"
+                updated_columns = [
+                    column for column in columns
+                    if column not in conflict_columns and column != 'id'
+                ]
+                for target in conflict_targets:
+                    sql_query += f"\nON CONFLICT({','.join(target)}) "
+                    if update and updated_columns:
+                        sql_query += "DO UPDATE SET " + ", ".join(
+                            f"{column}=excluded.{column}" for column in updated_columns)
+                    else:
+                        sql_query += "DO NOTHING"
+                sql_queries[(columns, update)] = sql_query
+            if update:
+                # Also forgets the objects of the identity map
+                return Statement(sql_query, tuple(params), statement_name,
+                                 cache=cache, invalidate=True)
+            return Statement(sql_query, tuple(params), statement_name)
+        cls.upsert = upsert
+
+        @staticmethod
+        def sql_upsert(obj: dct['MODEL'], update: bool = True) -> str:
+            if update and cache is not None:
+                cache.clear()
+            return sql_text(*upsert(obj, update))
+        cls.sql_upsert = sql_upsert
+
+    @staticmethod
+    def __generate_save_if_not_exists(cls, name, bases, dct):
+        model = dct['MODEL']
+        fields = [f.name for f in model.FIELDS if f.name != 'id']
+        statement_name = f"{name}.save_if_not_exists"
+        # Query for every set of the inserted columns
+        sql_queries = {}
+
+        @staticmethod
+        def save_if_not_exists(obj: dct['MODEL']) -> Statement:
+            """Insert the object unless there is a row with the same
+            values of the fields set in the object, like `exists`
+            and `save` do together, but with one query.
+            """
+            columns = []
+            params = []
+            for field in fields:
+                value = getattr(obj, field)
+                if value is not None:
+                    columns.append(field)
+                    params.append(value)
+            columns = tuple(columns)
+            sql_query = sql_queries.get(columns)
+            if sql_query is None:
+                if columns:
+                    sql_query = f"INSERT INTO {model.NAME}({','.join(columns)})" + \
+                        f"\nSELECT {','.join('?' * len(columns))}" + \
+                        f"\nWHERE NOT EXISTS(SELECT 1 FROM {model.NAME} WHERE " + \
+                        " AND ".join(f"{column} = ?" for column in columns) + ")"
+                else:
+                    sql_query = f"INSERT INTO {model.NAME}(id)\nSELECT NULL" + \
+                        f"\nWHERE NOT EXISTS(SELECT 1 FROM {model.NAME})"
+                sql_queries[columns] = sql_query
+            return Statement(sql_query, tuple(params) * 2, statement_name)
+        cls.save_if_not_exists = save_if_not_exists
+
+        @staticmethod
+        def sql_save_if_not_exists(obj: dct['MODEL']) -> str:
+            return sql_text(*save_if_not_exists(obj))
+        cls.sql_save_if_not_exists = sql_save_if_not_exists
+
     @staticmethod
     def __generate_custom_queries(cls, name, bases, dct):
+        cls.custom_queries = {}
         for attr_name in dct:
             if isinstance(dct[attr_name], CustomQuery):
+                if attr_name.startswith('sql_'):
+                    statement_attr_name = attr_name[4:]
+                else:
+                    statement_attr_name = 'prepared_' + attr_name
+                statement_name = f"{name}.{statement_attr_name}"
+
                 if dct[attr_name].query is None and attr_name.startswith('sql_'):
-                    keys = []
-                    sql_query_template = ''
-                    lexems = attr_name[4:].split('_')
-                    sep = ' '
-                    final_user_lex = ''
-
-                    def complete_custom_injection():
-                        nonlocal sql_query_template, final_user_lex
-                        if len(final_user_lex) != 0:
-                            sql_query_template += f"{final_user_lex}"
-                            correspondent_fields = [f for f in dct['MODEL'].FIELDS if f.name == final_user_lex]
-                            if len(correspondent_fields) == 0:
-                                raise CustomSQLBuildError
-                            correspondent_field = correspondent_fields[0]
-                            if correspondent_field.dtype == 'text':
-                                sql_query_template += f" = '{{{final_user_lex}}}' "
-                            else:
-                                sql_query_template += f" = {{{final_user_lex}}} "
-                            keys.append(final_user_lex)
-                            final_user_lex = ''
-
-                    for i, lex in enumerate(lexems):
-                        if lex == 'select' or lex == 'find':
-                            sep = ','
-                            complete_custom_injection()
-                            sql_query_template += 'SELECT '
-                        elif lex == 'all':
-                            sep = ' '
-                            complete_custom_injection()
-                            if lexems[0].upper() != 'DELETE':
-                                sql_query_template += '*' + sep
-                                sql_query_template += f"FROM {dct['MODEL'].NAME}" + sep
-                        elif lex == 'by':
-                            sep = ' '
-                            complete_custom_injection()
-                            sql_query_template += 'WHERE' + sep
-                        elif lex == 'and':
-                            sep = ' '
-                            complete_custom_injection()
-                            sql_query_template += 'AND' + sep
-                        elif lex == 'delete':
-                            sep = ' '
-                            complete_custom_injection()
-                            sql_query_template += f"DELETE FROM {dct['MODEL'].NAME} "
-                        else:
-                            if len(final_user_lex) != 0:
-                                final_user_lex += '_'
-                            final_user_lex += lex
-
-                    complete_custom_injection()
-                    sql_query_template = sql_query_template.rstrip()
-
-                    def sql_custom_query_factory(sql_query_template, keys):
+                    query = parse_custom_query(
+                        attr_name, dct['MODEL'], statement_name,
+                        cache=dct.get('CACHE'), text_name=f"{name}.{attr_name}")
+
+                    def sql_custom_query_factory(query):
+                        # Compiled into one call, which names the text itself
+                        query.format_text.__name__ = attr_name
+                        query.format_text.__qualname__ = f"{name}.{attr_name}"
+                        return staticmethod(query.format_text)
+
+                    def custom_statement_factory(statement):
+                        @staticmethod
+                        def custom_statement(**kwargs) -> Statement:
+                            return statement(kwargs)
+                        return custom_statement
+                elif dct[attr_name].query is not None:
+                    query = PositionalQuery(
+                        dct[attr_name].query, statement_name)
+
+                    def sql_custom_query_factory(query):
+                        text = query.text
+                        text_class = SQLText.named(f"{name}.{attr_name}")
+
                         @staticmethod
-                        def sql_custom_query(*args, **kwargs):
-                            sql_query = sql_query_template
-                            sql_query = sql_query.format(**kwargs)
-                            return sql_query
+                        def sql_custom_query(*args):
+                            return text_class(text(args))
+                        sql_custom_query.__func__.__name__ = attr_name
+                        sql_custom_query.__func__.__qualname__ = f"{name}.{attr_name}"
                         return sql_custom_query
 
-                    setattr(
-                        cls,
-                        attr_name,
-                        sql_custom_query_factory(
-                            sql_query_template,
-                            keys
-                        )
-                    )
-                elif dct[attr_name].query is not None:
-                    @staticmethod
-                    def sql_custom_query(*args):
-                        sql_query = dct[attr_name].query
-                        for arg in args:
-                            sql_query = sql_query.format(arg)
-                        return sql_query
-                    setattr(cls, attr_name, sql_custom_query)
+                    def custom_statement_factory(statement):
+                        @staticmethod
+                        def custom_statement(*args) -> Statement:
+                            return statement(args)
+                        return custom_statement
                 else:
                     raise ConventionViolationError
 
+                setattr(cls, attr_name,
+                        sql_custom_query_factory(query))
+                setattr(cls, statement_attr_name,
+                        custom_statement_factory(query.statement))
+                cls.custom_queries[attr_name] = query
+
     @staticmethod
     def __generate_update(cls, name, bases, dct):
+        cache = dct.get('CACHE')
+        model = dct['MODEL']
+
+        def changed_columns(obj):
+            columns = obj.changed_fields()
+            if 'id' in columns:
+                columns = tuple([column for column in columns if column != 'id'])
+            return columns
+
         @staticmethod
         def sql_update(obj: dct['MODEL']) -> str:
-            sql_query_start = f"UPDATE {dct['MODEL'].NAME} SET "
-            sql_query_end = f"\nWHERE id="
-            for field in dct['MODEL'].FIELDS:
-                field_value = getattr(obj, field.name)
-                if field_value is not ... and field.name != 'id':
-                    if not sql_query_start.endswith('SET '):
-                        sql_query_start += ', '
-                    sql_query_start += f'{field.name}='
-                    sql_query_start += f'{field_value}' if field.dtype != 'text' else f"'{field_value}'"
-                elif field.name == 'id':
-                    sql_query_end += str(field_value)
-            return sql_query_start + sql_query_end
+            columns = changed_columns(obj)
+            if not columns:
+                return ''
+            sql_query_start = f"UPDATE {model.NAME} SET "
+            sql_query_start += ", ".join(
+                f"{column}=" + sql_literal(getattr(obj, column),
+                                           model.fields_by_name[column].dtype)
+                for column in columns
+            )
+            if cache is not None:
+                cache.invalidate(obj.id)
+            return sql_query_start + f"\nWHERE id={obj.id}"
         cls.sql_update = sql_update
 
+        statement_name = f"{name}.update"
+        # Query for every set of the updated columns
+        sql_queries = {}
+
+        @staticmethod
+        def update(obj: dct['MODEL']) -> Statement:
+            """Update the fields of the object changed since it was
+            loaded, see `changed_fields()` of the model. If none of
+            them were, the statement is empty and services skip it.
+            """
+            columns = changed_columns(obj)
+            if not columns:
+                return Statement('', (), statement_name)
+            params = [getattr(obj, column) for column in columns]
+            params.append(obj.id)
+            sql_query = sql_queries.get(columns)
+            if sql_query is None:
+                sql_query = f"UPDATE {model.NAME} SET " + \
+                    ", ".join(f"{column}=?" for column in columns) + \
+                    "\nWHERE id=?"
+                sql_queries[columns] = sql_query
+            return Statement(sql_query, tuple(params), statement_name,
+                             cache=cache, invalidate=(obj.id,))
+        cls.update = update
+
     @staticmethod
     def __generate_delete_by_id(cls, name, bases, dct):
+        cache = dct.get('CACHE')
+
         @staticmethod
         def sql_delete_by_id(id: int) -> str:
             sql_query = f"DELETE FROM {dct['MODEL'].NAME}\nWHERE id={id}"
+            if cache is not None:
+                cache.invalidate(id)
             return sql_query
         cls.sql_delete_by_id = sql_delete_by_id
 
+        sql_query = f"DELETE FROM {dct['MODEL'].NAME}\nWHERE id=?"
+        statement_name = f"{name}.delete_by_id"
+
+        @staticmethod
+        def delete_by_id(id: int) -> Statement:
+            return Statement(sql_query, (id,), statement_name,
+                             cache=cache, invalidate=(id,))
+        cls.delete_by_id = delete_by_id
+
+    @staticmethod
+    def __generate_update_where(cls, name, bases, dct):
+        model = dct['MODEL']
+        cache = dct.get('CACHE')
+
+        def set_clause(values, text):
+            assignments = []
+            params = []
+            for column, value in values.items():
+                field = model.fields_by_name.get(column)
+                if field is None:
+                    raise ConventionViolationError(
+                        f"Model {model.__name__} has no field `{column}`.")
+                if text:
+                    assignments.append(f"{column}={sql_literal(value, field.dtype)}")
+                else:
+                    assignments.append(f"{column}=?")
+                    params.append(value)
+            if not assignments:
+                raise ValueError("No values to update.")
+            return ", ".join(assignments), params
+
+        @staticmethod
+        def sql_update_where(values: dict, **filters) -> str:
+            assignments, _ = set_clause(values, text=True)
+            where, _ = _filter_conditions(model, filters, text=True)
+            if cache is not None:
+                cache.clear()
+            return f"UPDATE {model.NAME} SET {assignments}{where}"
+        cls.sql_update_where = sql_update_where
+
+        statement_name = f"{name}.update_where"
+
+        @staticmethod
+        def update_where(values: dict, **filters) -> Statement:
+            """Set the values of the fields of all the rows matching
+            the filters in one statement, e.g.
+            `update_where({'type': 'group'}, chat_id=[1, 2, 3])`.
+            Without filters all the rows are updated.
+            """
+            assignments, params = set_clause(values, text=False)
+            where, filter_params = _filter_conditions(model, filters)
+            return Statement(f"UPDATE {model.NAME} SET {assignments}{where}",
+                             tuple(params + filter_params), statement_name,
+                             cache=cache, invalidate=True)
+        cls.update_where = update_where
+
+    @staticmethod
+    def __generate_delete_where(cls, name, bases, dct):
+        model = dct['MODEL']
+        cache = dct.get('CACHE')
+
+        @staticmethod
+        def sql_delete_where(**filters) -> str:
+            where, _ = _filter_conditions(model, filters, text=True)
+            if cache is not None:
+                cache.clear()
+            return f"DELETE FROM {model.NAME}{where}"
+        cls.sql_delete_where = sql_delete_where
+
+        statement_name = f"{name}.delete_where"
+
+        @staticmethod
+        def delete_where(**filters) -> Statement:
+            """Delete all the rows matching the filters in one
+            statement, e.g. `delete_where(type='group', username=None)`.
+            Without filters all the rows are deleted.
+            """
+            where, params = _filter_conditions(model, filters)
+            return Statement(f"DELETE FROM {model.NAME}{where}", tuple(params),
+                             statement_name, cache=cache, invalidate=True)
+        cls.delete_where = delete_where
+
+    @staticmethod
+    def __generate_delete_by_ids(cls, name, bases, dct):
+        model = dct['MODEL']
+        cache = dct.get('CACHE')
+
+        @staticmethod
+        def sql_delete_by_ids(ids: Iterable[int]) -> str:
+            ids = list(ids)
+            if cache is not None:
+                for id in ids:
+                    cache.invalidate(id)
+            return f"DELETE FROM {model.NAME}\n" \
+                f"WHERE id IN ({', '.join([str(int(id)) for id in ids])})"
+        cls.sql_delete_by_ids = sql_delete_by_ids
+
+        sql_query = f"DELETE FROM {model.NAME}\n" \
+            "WHERE id IN (SELECT value FROM json_each(?))"
+        statement_name = f"{name}.delete_by_ids"
+
+        @staticmethod
+        def delete_by_ids(ids: Iterable[int]) -> Statement:
+            """Delete the rows with the ids in one statement, however
+            many of them there are.
+            """
+            ids = list(ids)
+            return Statement(sql_query, (json.dumps(ids),), statement_name,
+                             cache=cache, invalidate=tuple(ids))
+        cls.delete_by_ids = delete_by_ids
+
+    @staticmethod
+    def __generate_relations(cls, name, bases, dct):
+        model = dct['MODEL']
+
+        def keys(objects, attribute):
+            """Distinct values of the attribute, except None."""
+            return list(dict.fromkeys([
+                value for value in map(operator.attrgetter(attribute), objects)
+                if value is not None
+            ]))
+
+        def make_loaders(field, table, column):
+            relation = field.relation
+            load_name = f"{name}.load_{relation}"
+            load_for_name = f"{name}.load_for_{relation}"
+            columns = ', '.join([f.name for f in model.FIELDS])
+            load_for_query = f"SELECT {columns} FROM {model.NAME}\n" \
+                f"WHERE {field.name} IN (SELECT value FROM json_each(?))\n" \
+                "ORDER BY id"
+            get_field = operator.attrgetter(field.name)
+            get_column = operator.attrgetter(column)
+            # A model may reference its own table before it is defined
+            referenced = field.model if field.model is not None else model
+            load_query = f"SELECT {', '.join([f.name for f in referenced.FIELDS])} " \
+                f"FROM {table}\nWHERE {column} IN (SELECT value FROM json_each(?))"
+
+            def load(objects: Iterable) -> Statement:
+                """Load the objects referenced by `{field}` of the objects
+                with one query and set them to `{relation}` of the objects
+                (None if there is no such object).
+                """
+                objects = list(objects)
+
+                def attach(referenced_objects):
+                    by_key = {get_column(obj): obj for obj in referenced_objects}
+                    for obj in objects:
+                        setattr(obj, relation, by_key.get(get_field(obj)))
+
+                values = keys(objects, field.name)
+                if not values:
+                    return Statement('', (), load_name, referenced, attach=attach)
+                return Statement(load_query, (json.dumps(values),), load_name,
+                                 referenced, attach=attach)
+            load.__doc__ = load.__doc__.format(field=field.name, relation=relation)
+
+            def load_for(objects: Iterable) -> Statement:
+                """Load the objects of this DAO which reference the given
+                objects by `{field}` with one query, and set the given
+                objects to `{relation}` of the loaded ones.
+                """
+                objects = list(objects)
+
+                def attach(loaded_objects):
+                    by_key = {get_column(obj): obj for obj in objects}
+                    for obj in loaded_objects:
+                        setattr(obj, relation, by_key.get(get_field(obj)))
+
+                values = keys(objects, column)
+                if not values:
+                    return Statement('', (), load_for_name, model, attach=attach)
+                return Statement(load_for_query, (json.dumps(values),), load_for_name,
+                                 model, attach=attach)
+            load_for.__doc__ = load_for.__doc__.format(field=field.name, relation=relation)
+            return load, load_for
+
+        for field in model.FIELDS:
+            referenced_column = field.referenced_column()
+            if field.relation is None or referenced_column is None:
+                continue
+            if field.model is None and referenced_column[0] != model.NAME:
+                raise ConventionViolationError(
+                    f"Model referenced by {field.name} is not known, "
+                    "use `reference()` of the model or pass it as `model`.")
+            load, load_for = make_loaders(field, *referenced_column)
+            setattr(cls, f"load_{field.relation}", staticmethod(load))
+            setattr(cls, f"load_for_{field.relation}", staticmethod(load_for))
+
 
 class ServiceMeta(type):
+    """Metaclass for the services.
+    Generates connection management and query execution
+    on top of a pool of connections to the service database.
+
+    Requires class of the metaclass to have defined:
+        - `DB_PATH` - path to the database file.
+        - `MODELS` - list of models stored in the database.
+
+    Optionally the class may define:
+        - `POOL_SIZE` - maximum number of open connections (5).
+        - `POOL_TIMEOUT` - seconds to wait for a free connection
+          when the pool is exhausted (wait forever).
+        - `STATEMENT_CACHE_SIZE` - number of compiled statements
+          cached by every connection (128).
+        - `PRAGMAS` - dict of pragmas set on every connection, e.g.
+          `HIGH_THROUGHPUT_PRAGMAS` (SQLite defaults).
+        - `HOOKS` - list of hooks called on every query, e.g.
+          `QueryStats`, see `add_hook()`.
+        - `BATCH_SIZE` - number of rows in one `executemany` call
+          of `execute_many()` (1000).
+        - `FETCH_SIZE` - number of rows fetched at once by
+          `iterate()` (500).
+        - `READERS` - number of read-only connections the SELECT
+          statements of DAOs are run on, the other queries use the
+          connections of `POOL_SIZE` (0, all the queries share them).
+    """
     def __new__(cls, name, bases, dct):
         c = type.__new__(cls, name, bases, dct)
 
@@ -268,61 +1083,766 @@ class ServiceMeta(type):
         return c
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def __get_all_generators():
+        # The generators are found once, not for every class
         generators = []
         for attr_name in ServiceMeta.__dict__:
             attr = ServiceMeta.__dict__[attr_name]
             if isinstance(attr, staticmethod):
                 if '__generate' in attr.__func__.__name__ and attr.__func__.__code__.co_argcount == 4:
                     generators.append(attr.__func__)
-        return generators
+        return tuple(generators)
+
+    @staticmethod
+    def __generate_pool(cls, name, bases, dct):
+        if not 'DB_PATH' in dct or not 'MODELS' in dct:
+            raise ConventionViolationError
+
+        pool = ConnectionPool(
+            dct['DB_PATH'],
+            size=dct.get('POOL_SIZE', 5),
+            timeout=dct.get('POOL_TIMEOUT', None),
+            cached_statements=dct.get('STATEMENT_CACHE_SIZE', 128),
+            pragmas=dct.get('PRAGMAS')
+        )
+        atexit.register(pool.close)
+        cls.pool = pool
+
+        read_pool = None
+        if dct.get('READERS'):
+            read_pool = ConnectionPool(
+                dct['DB_PATH'],
+                size=dct['READERS'],
+                timeout=dct.get('POOL_TIMEOUT', None),
+                cached_statements=dct.get('STATEMENT_CACHE_SIZE', 128),
+                pragmas=dct.get('PRAGMAS'),
+                read_only=True
+            )
+            atexit.register(read_pool.close)
+        cls.read_pool = read_pool
+
+        @staticmethod
+        def release(connection: sqlite3.Connection):
+            cls.pool.release(connection)
+        cls.release = release
+
+        @staticmethod
+        def close():
+            cls.pool.close()
+            if cls.read_pool is not None:
+                cls.read_pool.close()
+        cls.close = close
+
+    @staticmethod
+    def __generate_transaction(cls, name, bases, dct):
+        # Transaction of the current thread
+        local = threading.local()
+
+        @staticmethod
+        @contextmanager
+        def connection():
+            """Connection of the current transaction if there is one,
+            otherwise a connection taken from the pool for the block.
+            """
+            state = getattr(local, 'state', None)
+            if state is not None:
+                yield state.connection
+            else:
+                with cls.pool.connection() as connection:
+                    yield connection
+        cls.connection = connection
+
+        @staticmethod
+        @contextmanager
+        def read_connection():
+            """Same as `connection()`, but outside of transactions the
+            connection is taken from the read-only pool if there is one.
+            """
+            state = getattr(local, 'state', None)
+            reader = getattr(local, 'reader', None)
+            if state is not None:
+                yield state.connection
+            elif reader is not None:
+                yield reader
+            else:
+                pool = cls.read_pool if cls.read_pool is not None else cls.pool
+                with pool.connection() as connection:
+                    yield connection
+        cls.read_connection = read_connection
+
+        @staticmethod
+        @contextmanager
+        def pinned_connection(statement: Statement = None):
+            """`connection_of()` the statement bound to the current
+            thread for the block, e.g. while `iterate()` reads the rows.
+
+            The queries of the thread inside the block reuse the
+            connection instead of taking another one from the pool,
+            which may be exhausted by the blocks the thread is in. A
+            read-only connection is reused by the reading queries only.
+            """
+            state = getattr(local, 'state', None)
+            if state is not None:
+                yield state.connection
+                return
+            if statement is not None and statement.is_select and cls.read_pool is not None:
+                reader = getattr(local, 'reader', None)
+                if reader is not None:
+                    yield reader
+                    return
+                with cls.read_pool.connection() as reader:
+                    local.reader = reader
+                    try:
+                        yield reader
+                    finally:
+                        # The generator may be closed by another thread
+                        if getattr(local, 'reader', None) is reader:
+                            local.reader = None
+                return
+            with cls.pool.connection() as connection:
+                pinned = local.state = TransactionState(connection)
+                try:
+                    yield connection
+                finally:
+                    if getattr(local, 'state', None) is pinned:
+                        local.state = None
+        cls.pinned_connection = pinned_connection
+
+        @staticmethod
+        def connection_of(statement: Statement):
+            """`read_connection()` for the SELECT statements of DAOs,
+            `connection()` for the rest of the queries."""
+            if statement is not None and statement.is_select:
+                return read_connection()
+            return connection()
+        cls.connection_of = connection_of
+
+        def forget_rolled_back():
+            # The loaded objects may hold the rolled back values
+            identity_map = cls.identity_map()
+            if identity_map is not None:
+                identity_map.clear()
+
+        @staticmethod
+        @contextmanager
+        def transaction(immediate: bool = False):
+            """Run the queries of the block in one transaction.
+
+            All the queries of the current thread inside the block
+            use the same connection and are committed on exit from
+            the block, or rolled back if it raises. A nested block
+            is a savepoint inside the outer transaction.
+
+            Arguments:
+                immediate {bool} -- take the write lock of the
+                    database at the start of the transaction.
+            """
+            state = getattr(local, 'state', None)
+            if state is None or state.depth == 0:
+                cls.ensure_schema()
+                pinned = state is not None
+                connection = state.connection if pinned else cls.pool.acquire()
+                transaction_state = TransactionState(connection, depth=1)
+                try:
+                    connection.execute(
+                        'BEGIN IMMEDIATE' if immediate else 'BEGIN')
+                    local.state = transaction_state
+                    try:
+                        yield connection
+                    except BaseException:
+                        # An interrupted query may have rolled it back
+                        if connection.in_transaction:
+                            connection.execute('ROLLBACK')
+                        forget_rolled_back()
+                        raise
+                    connection.execute('COMMIT')
+                finally:
+                    local.state = state
+                    if not pinned:
+                        cls.pool.release(connection)
+                for callback in transaction_state.callbacks:
+                    callback()
+            else:
+                connection = state.connection
+                depth = state.depth
+                savepoint = f"sqller_savepoint_{depth}"
+                connection.execute(f"SAVEPOINT {savepoint}")
+                state.depth = depth + 1
+                try:
+                    try:
+                        yield connection
+                    except BaseException:
+                        if connection.in_transaction:
+                            connection.execute(f"ROLLBACK TO {savepoint}")
+                        forget_rolled_back()
+                        raise
+                    finally:
+                        if connection.in_transaction:
+                            connection.execute(f"RELEASE {savepoint}")
+                finally:
+                    state.depth = depth
+        cls.transaction = transaction
+
+        @staticmethod
+        def in_transaction() -> bool:
+            """Whether the current thread is inside `transaction()`."""
+            state = getattr(local, 'state', None)
+            return state is not None and state.depth != 0
+        cls.in_transaction = in_transaction
+
+        @staticmethod
+        def after_commit(callback):
+            """Call the callback after the current transaction is
+            committed, or right away if there is no transaction.
+            The callback is dropped if the transaction is rolled back.
+            """
+            state = getattr(local, 'state', None)
+            if state is not None and state.depth != 0:
+                state.callbacks.append(callback)
+            else:
+                callback()
+        cls.after_commit = after_commit
+
+        @staticmethod
+        def transaction_state() -> TransactionState:
+            """Connection bound to the current thread, if any."""
+            return getattr(local, 'state', None)
+        cls.transaction_state = transaction_state
+
+        @staticmethod
+        @contextmanager
+        def bind(state: TransactionState):
+            """Bind the connection state to the current thread for
+            the block, e.g. to continue a transaction of another
+            thread. None unbinds the current state.
+            """
+            previous = getattr(local, 'state', None)
+            local.state = state
+            try:
+                yield
+            finally:
+                local.state = previous
+        cls.bind = bind
+
+    @staticmethod
+    def __generate_session(cls, name, bases, dct):
+        # Identity map of the current thread
+        local = threading.local()
+
+        @staticmethod
+        @contextmanager
+        def session():
+            """Keep the models loaded by the thread inside the block
+            in an identity map, see `IdentityMap`.
+
+            `fetch_one()` and `fetch_all()` return the object loaded
+            before for the same row instead of a new one, and `get_one`
+            of DAO is not queried again for the loaded objects. The
+            objects are forgotten when the rows are updated or deleted
+            by the DAO queries, and all of them on rollback of a
+            transaction and on exit from the block.
+            A nested block shares the map of the outer one.
+            """
+            identity_map = getattr(local, 'identity_map', None)
+            if identity_map is not None:
+                yield identity_map
+                return
+            identity_map = local.identity_map = IdentityMap()
+            try:
+                yield identity_map
+            finally:
+                local.identity_map = None
+                identity_map.clear()
+        cls.session = session
+
+        @staticmethod
+        def identity_map() -> IdentityMap:
+            """Identity map of the current session, if any."""
+            return getattr(local, 'identity_map', None)
+        cls.identity_map = identity_map
+
+    @staticmethod
+    def __generate_hooks(cls, name, bases, dct):
+        hooks = list(dct.get('HOOKS', ()))
+        # Bound methods of the hooks, called on every query
+        before_execute = []
+        after_execute = []
+
+        def collect():
+            before_execute[:] = [
+                hook.before_execute for hook in hooks
+                if hasattr(hook, 'before_execute')
+            ]
+            after_execute[:] = [
+                hook.after_execute for hook in hooks
+                if hasattr(hook, 'after_execute')
+            ]
+            cls.hooks = tuple(hooks)
+        collect()
+
+        @staticmethod
+        def add_hook(hook):
+            """Add hook called on every query of the service.
+
+            The hook is an object with `before_execute(event)` and/or
+            `after_execute(event)` methods taking `QueryEvent`, e.g.
+            `QueryStats`. Exceptions of the hooks are logged and do
+            not affect the queries.
+            """
+            hooks.append(hook)
+            collect()
+        cls.add_hook = add_hook
+
+        @staticmethod
+        def remove_hook(hook):
+            hooks.remove(hook)
+            collect()
+        cls.remove_hook = remove_hook
+
+        def call_hooks(callbacks, event):
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception("Hook of %s failed on %s", name, event.name)
+
+        def start_event(sql_query, params, statement=None):
+            """Event of the query if there are hooks, otherwise None."""
+            if not before_execute and not after_execute:
+                return None
+            if statement is not None and statement.name is not None:
+                query_name = statement.name
+            else:
+                # Not the text itself, which differs for every value
+                query_name = getattr(sql_query, 'name', None) or query_pattern(sql_query)
+            event = QueryEvent(cls, query_name, sql_query, params)
+            call_hooks(before_execute, event)
+            return event
+        cls._start_event = staticmethod(start_event)
+
+        def finish_event(event):
+            call_hooks(after_execute, event)
+        cls._finish_event = staticmethod(finish_event)
+
+    @staticmethod
+    def __generate_schema(cls, name, bases, dct):
+        schema_lock = threading.Lock()
+        schema_ready = False
+
+        @staticmethod
+        def ensure_schema(force: bool = False):
+            """Create the tables of `MODELS` in the service database.
+
+            The tables and their indexes are created if they do not
+            exist once per service, so the call is cheap after the
+            first one. Pass `force` to run the creation scripts
+            again anyway.
+            """
+            nonlocal schema_ready
+            if schema_ready and not force:
+                return
+            with schema_lock:
+                if schema_ready and not force:
+                    return
+                with cls.connection() as connection:
+                    for model in dct['MODELS']:
+                        connection.execute(
+                            model.sql_create_table_if_not_exists())
+                        for sql_query in model.sql_create_indexes():
+                            connection.execute(sql_query)
+                schema_ready = True
+        cls.ensure_schema = ensure_schema
+
+        @staticmethod
+        def migrate():
+            """Bring the service database up to date with `MODELS`.
+
+            Creates the missing tables, adds columns for the fields
+            which are missing in the existing tables and creates the
+            missing indexes.
+            """
+            nonlocal schema_ready
+            with schema_lock:
+                with cls.connection() as connection:
+                    for model in dct['MODELS']:
+                        connection.execute(
+                            model.sql_create_table_if_not_exists())
+                        columns = {
+                            row[1] for row in connection.execute(
+                                f"PRAGMA table_info({model.NAME})")
+                        }
+                        for field in model.FIELDS:
+                            if field.name not in columns:
+                                connection.execute(
+                                    f"ALTER TABLE {model.NAME} ADD COLUMN "
+                                    f"{field.sql_column_description()}")
+                        for sql_query in model.sql_create_indexes():
+                            connection.execute(sql_query)
+                schema_ready = True
+        cls.migrate = migrate
 
     @staticmethod
     def __generate_connect(cls, name, bases, dct):
         @staticmethod
         def connect():
+            """Take a connection from the service pool.
+
+            The connection is in autocommit mode, use `BEGIN` or
+            `transaction()` to group the queries. The connection
+            should be given back with `release()`, closing or dropping
+            it frees its place in the pool as well. Returns `None` if
+            the database cannot be opened or all the connections are
+            in use, after waiting `POOL_TIMEOUT` seconds if it is set.
+            """
             connection = None
             try:
-                connection = sqlite3.connect(dct['DB_PATH'])
-            except sqlite3.Error as e:
-                print(e)
-            if connection is not None:
-                try:
-                    cursor = connection.cursor()
-                    for table in dct['MODELS']:
-                        cursor.execute(
-                            table.sql_create_table_if_not_exists())
-                except sqlite3.Error as e:
-                    print(e)
+                cls.ensure_schema()
+                connection = cls.pool.acquire(block=cls.pool.timeout is not None)
+            except (sqlite3.Error, ConnectionPoolError):
+                logger.exception("Cannot connect to %s", dct['DB_PATH'])
             return connection
         cls.connect = connect
 
     @staticmethod
     def __generate_execute(cls, name, bases, dct):
+        start_event = cls._start_event
+        finish_event = cls._finish_event
+        connection_of = cls.connection_of
+
+        def update_cache(statement, result):
+            cache = statement.cache
+            if statement.cache_key is not None:
+                # Uncommitted rows of a transaction are not cached
+                if result and not cls.in_transaction():
+                    cache.set(statement.cache_key, list(result))
+            elif statement.invalidate is not None:
+                def invalidate():
+                    if statement.invalidate is True:
+                        cache.clear()
+                    else:
+                        for key in statement.invalidate:
+                            cache.invalidate(key)
+                # Again after commit in case the old rows
+                # were cached by the other threads meanwhile
+                invalidate()
+                cls.after_commit(invalidate)
+
+        def run(sql_query, params, statement):
+            """Resulting rows and the number of modified rows."""
+            if not sql_query:
+                # Nothing to do, e.g. update of an unchanged object
+                return [], 0
+            cls.ensure_schema()
+            event = start_event(sql_query, params, statement)
+            if event is not None:
+                start = time.perf_counter()
+            try:
+                with connection_of(statement) as connection:
+                    cursor = connection.cursor()
+                    cursor.execute(sql_query, params)
+                    result = cursor.fetchall()
+            except BaseException as e:
+                if event is not None:
+                    event.error = e
+                raise
+            finally:
+                if event is not None:
+                    event.elapsed = time.perf_counter() - start
+                    if event.error is None:
+                        event.rows = len(result) or max(cursor.rowcount, 0)
+                    finish_event(event)
+            if statement is not None:
+                if statement.cache is not None:
+                    update_cache(statement, result)
+                if statement.invalidate is not None:
+                    identity_map = cls.identity_map()
+                    if identity_map is not None:
+                        identity_map.evict(statement.invalidate)
+            return result, cursor.rowcount
+
         @staticmethod
-        def execute(sql_query: str) -> Iterable[Tuple]:
-            # =======================
-            # Connect to the database
-            # =======================
-            connection = None
+        def execute(sql_query: str, params: tuple = ()) -> Iterable[Tuple]:
+            """Execute query and fetch all the resulting rows.
+
+            Arguments:
+                sql_query -- SQL text or `Statement` generated by DAO.
+                params -- values bound to `?` placeholders of SQL text.
+            """
+            statement = None
+            if isinstance(sql_query, Statement):
+                statement = sql_query
+                sql_query, params = statement.sql, statement.params
+                if statement.cache is not None and statement.cache_key is not None:
+                    rows = statement.cache.get(statement.cache_key)
+                    if rows is not None:
+                        return list(rows)
+            return run(sql_query, params, statement)[0]
+
+        cls.execute = execute
+
+        @staticmethod
+        def execute_rowcount(sql_query: str, params: tuple = ()) -> int:
+            """Execute query and return the number of the rows it
+            inserted, updated or deleted, e.g. for `update_where()`,
+            `delete_where()` and `delete_by_ids()` of DAO.
+
+            Arguments:
+                sql_query -- SQL text or `Statement` generated by DAO.
+                params -- values bound to `?` placeholders of SQL text.
+            """
+            statement = None
+            if isinstance(sql_query, Statement):
+                statement = sql_query
+                sql_query, params = statement.sql, statement.params
+            return run(sql_query, params, statement)[1]
+        cls.execute_rowcount = execute_rowcount
+
+    @staticmethod
+    def __generate_fetch(cls, name, bases, dct):
+        def get_model(sql_query, model):
+            if model is None and isinstance(sql_query, Statement):
+                model = sql_query.model
+            if model is None:
+                raise ValueError("Model of the selected rows is unknown.")
+            return model
+
+        @staticmethod
+        def fetch_all(sql_query: str, params: tuple = (), model: type = None) -> list:
+            """Execute query and load all the resulting rows into models.
+
+            Arguments:
+                sql_query -- SQL text or `Statement` generated by DAO.
+                params -- values bound to `?` placeholders of SQL text.
+                model -- model of the rows, taken from the statement
+                    by default. The rows should contain the values of
+                    all the fields of the model in the order of `FIELDS`.
+            """
+            model = get_model(sql_query, model)
+            rows = cls.execute(sql_query, params)
+            identity_map = cls.identity_map()
+            if identity_map is not None:
+                objects = [identity_map.load(model, row) for row in rows]
+            else:
+                objects = list(map(model.from_row, rows))
+            if isinstance(sql_query, Statement) and sql_query.attach is not None:
+                sql_query.attach(objects)
+            return objects
+        cls.fetch_all = fetch_all
+
+        @staticmethod
+        def fetch_one(sql_query: str, params: tuple = (), model: type = None):
+            """Execute query and load the first resulting row into model.
+
+            Same as `fetch_all()`, but returns only the first object
+            or None if there are no rows.
+            """
+            model = get_model(sql_query, model)
+            identity_map = cls.identity_map()
+            if identity_map is None:
+                rows = cls.execute(sql_query, params)
+                return model.from_row(rows[0]) if rows else None
+            if isinstance(sql_query, Statement) and sql_query.cache_key is not None:
+                # `get_one` of the object loaded in the session
+                obj = identity_map.get(model, sql_query.cache_key)
+                if obj is not None:
+                    return obj
+            rows = cls.execute(sql_query, params)
+            return identity_map.load(model, rows[0]) if rows else None
+        cls.fetch_one = fetch_one
+
+        @staticmethod
+        def fetch_value(sql_query: str, params: tuple = ()):
+            """Execute query and return the first value of the first
+            resulting row or None if there are no rows, e.g. the result
+            of `count_by_type` custom query.
+            """
+            rows = cls.execute(sql_query, params)
+            return rows[0][0] if rows else None
+        cls.fetch_value = fetch_value
+
+    @staticmethod
+    def __generate_iterate(cls, name, bases, dct):
+        start_event = cls._start_event
+        finish_event = cls._finish_event
+
+        @staticmethod
+        def iterate(sql_query: str, params: tuple = (),
+                    batch_size: int = None) -> Iterator[Tuple]:
+            """Execute query and yield the resulting rows one by one.
+
+            The rows are fetched in batches of `batch_size` rows
+            (`FETCH_SIZE` of the service by default), so only one
+            batch is kept in memory. The connection is held until
+            the iteration is over or the generator is closed, and
+            the queries of the thread meanwhile reuse it, see
+            `pinned_connection()`.
+
+            Arguments:
+                sql_query -- SQL text or `Statement` generated by DAO.
+                params -- values bound to `?` placeholders of SQL text.
+                batch_size -- number of rows fetched at once.
+            """
+            statement = None
+            if isinstance(sql_query, Statement):
+                statement = sql_query
+                sql_query, params = statement.sql, statement.params
+            if batch_size is None:
+                batch_size = dct.get('FETCH_SIZE', 500)
+            cls.ensure_schema()
+            event = start_event(sql_query, params, statement)
+            if event is None:
+                with cls.pinned_connection(statement) as connection:
+                    cursor = connection.cursor()
+                    try:
+                        cursor.execute(sql_query, params)
+                        while True:
+                            rows = cursor.fetchmany(batch_size)
+                            if not rows:
+                                break
+                            yield from rows
+                    finally:
+                        cursor.close()
+                return
+
+            # Only the time spent in SQLite is counted,
+            # not the processing of the rows in between
+            start = time.perf_counter()
+            try:
+                with cls.pinned_connection(statement) as connection:
+                    cursor = connection.cursor()
+                    try:
+                        cursor.execute(sql_query, params)
+                        while True:
+                            rows = cursor.fetchmany(batch_size)
+                            event.elapsed += time.perf_counter() - start
+                            if not rows:
+                                break
+                            event.rows += len(rows)
+                            yield from rows
+                            start = time.perf_counter()
+                    finally:
+                        cursor.close()
+            except BaseException as e:
+                if not isinstance(e, GeneratorExit):
+                    event.error = e
+                raise
+            finally:
+                finish_event(event)
+        cls.iterate = iterate
+
+    @staticmethod
+    def __generate_execute_many(cls, name, bases, dct):
+        start_event = cls._start_event
+        finish_event = cls._finish_event
+
+        @staticmethod
+        def execute_many(sql_query: str, params: Iterable[tuple] = (),
+                         batch_size: int = None) -> int:
+            """Execute query for every set of values in one transaction.
+
+            The values are passed to `executemany` in batches of
+            `batch_size` (`BATCH_SIZE` of the service by default).
+
+            Arguments:
+                sql_query -- SQL text or `Statement` generated by DAO,
+                    e.g. `ChatDAO.save_many(chats)`.
+                params -- sets of values bound to `?` placeholders.
+                batch_size -- number of value sets in one batch.
+
+            Returns:
+                int -- number of inserted or modified rows.
+            """
+            statement = None
+            if isinstance(sql_query, Statement):
+                statement = sql_query
+                sql_query, params = statement.sql, statement.params
+            if batch_size is None:
+                batch_size = dct.get('BATCH_SIZE', 1000)
+            event = start_event(sql_query, params, statement)
+            if event is not None:
+                start = time.perf_counter()
+            rowcount = 0
             try:
-                connection = sqlite3.connect(dct['DB_PATH'])
-            except sqlite3.Error as e:
-                print(e)
-            if connection is not None:
-                cursor = connection.cursor()
-                for table in dct['MODELS']:
-                    cursor.execute(
-                        table.sql_create_table_if_not_exists())
-                cursor.fetchall()
-
-            # =====================
-            # Execute the sql query
-            # =====================
-            cursor = connection.cursor()
-            cursor.execute(sql_query)
-            result = cursor.fetchall()
-            connection.commit()
-            return result
-
-        cls.execute = execute
\ No newline at end of file
+                with cls.transaction() as connection:
+                    cursor = connection.cursor()
+                    params = iter(params)
+                    while True:
+                        batch = list(itertools.islice(params, batch_size))
+                        if not batch:
+                            break
+                        cursor.executemany(sql_query, batch)
+                        rowcount += cursor.rowcount
+            except BaseException as e:
+                if event is not None:
+                    event.error = e
+                raise
+            finally:
+                if event is not None:
+                    event.elapsed = time.perf_counter() - start
+                    event.rows = rowcount
+                    finish_event(event)
+            return rowcount
+        cls.execute_many = execute_many
+
+    @staticmethod
+    def __generate_scan_partitioned(cls, name, bases, dct):
+        db_path = dct['DB_PATH']
+
+        @staticmethod
+        def scan_partitioned(model: type, function=None, partitions: int = None,
+                             processes: int = None, **filters) -> list:
+            """Select the rows of the model table in several processes.
+
+            The ids of the rows matching the filters (see
+            `update_where()` of DAO) are split into `partitions`
+            ranges, which are selected in parallel by `processes`
+            processes (the number of CPUs by default) on read-only
+            connections, and the results are merged in the order of
+            the ids. The database should not be in memory.
+
+            Arguments:
+                model -- model of the table, may be a partial model.
+                function -- picklable function called in the processes
+                    with the rows of every range, e.g. to aggregate them
+                    instead of sending all the rows back.
+                partitions -- number of the id ranges, `processes`
+                    by default.
+
+            Returns:
+                list -- objects of the model in the order of the ids,
+                    or the results of the function for every range.
+            """
+            if db_path == ':memory:':
+                raise ValueError("In-memory database cannot be read by other processes.")
+            processes = processes or os.cpu_count() or 1
+            # Partial models are filtered by any field of the table
+            where, params = _filter_conditions(
+                getattr(model, 'PARTIAL_OF', None) or model, filters)
+            table = model.NAME
+            rows = cls.execute(Statement(
+                f"SELECT min(id), max(id) FROM {table}{where}", tuple(params)))
+            first, last = rows[0]
+            if first is None:
+                return []
+            ranges = id_ranges(first, last, partitions or processes)
+
+            # Imported here, multiprocessing is slow to import
+            from concurrent.futures import ProcessPoolExecutor
+
+            columns = ', '.join([field.name for field in model.FIELDS])
+            conditions = f"{where} AND" if where else "\nWHERE"
+            sql_query = f"SELECT {columns} FROM {table}{conditions} " \
+                "id >= ? AND id < ?\nORDER BY id"
+            with ProcessPoolExecutor(max_workers=min(processes, len(ranges))) as executor:
+                results = list(executor.map(
+                    scan_partition,
+                    itertools.repeat(db_path),
+                    itertools.repeat(sql_query),
+                    [tuple(params) + bounds for bounds in ranges],
+                    itertools.repeat(function)
+                ))
+            if function is not None:
+                return results
+            return [model.from_row(row) for rows in results for row in rows]
+        cls.scan_partitioned = scan_partitioned
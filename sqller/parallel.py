@@ -0,0 +1,32 @@
+import sqlite3
+from typing import List, Tuple
+
+from .pool import read_only_uri
+
+
+def id_ranges(first: int, last: int, partitions: int) -> List[Tuple[int, int]]:
+    """Split ids from `first` to `last` into at most `partitions`
+    ranges of the same length, as pairs of the first id and the id
+    after the last one.
+    """
+    if partitions < 1:
+        raise ValueError("Number of partitions should be a positive number.")
+    length = (last - first) // partitions + 1
+    return [
+        (start, min(start + length, last + 1))
+        for start in range(first, last + 1, length)
+    ]
+
+
+def scan_partition(db_path: str, sql_query: str, params: tuple, function=None):
+    """Rows of the query run on a new read-only connection to the
+    database, or the result of the function called with them.
+    Runs in the processes of `scan_partitioned()` of the services.
+    """
+    connection = sqlite3.connect(read_only_uri(db_path), uri=True)
+    try:
+        connection.execute("PRAGMA query_only = ON")
+        rows = connection.execute(sql_query, params).fetchall()
+    finally:
+        connection.close()
+    return rows if function is None else function(rows)
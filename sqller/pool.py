@@ -0,0 +1,294 @@
+import pathlib
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from .exceptions import ConnectionPoolError
+
+_PRAGMA_VALUE = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+# Seconds between the checks for the connections dropped by
+# their users while waiting for a released one
+_RECLAIM_INTERVAL = 0.1
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections to a single database.
+
+    Connections are opened lazily, up to `size` of them, and are
+    handed out one at a time, so a connection is never used by two
+    threads simultaneously. Released connections are reused by the
+    next `acquire()` instead of reopening the database file.
+    Every connection is set up with `pragmas` once, when it is opened.
+
+    Connections of a `read_only` pool are opened with `mode=ro` and
+    `query_only`, so they fail on any attempt to write.
+
+    A connection closed by its user instead of being released frees
+    its place in the pool, the next `acquire()` opens a new one.
+    So does a connection which its user dropped without releasing.
+    """
+
+    def __init__(self, db_path: str, size: int = 5, timeout: float = None,
+                 cached_statements: int = 128, pragmas: dict = None,
+                 read_only: bool = False):
+        # Every connection to ':memory:' is a separate database,
+        # so an in-memory pool can only ever hold one connection.
+        if db_path == ':memory:':
+            if read_only:
+                raise ValueError("In-memory database cannot be opened read-only.")
+            size = 1
+        if size < 1:
+            raise ValueError("Pool size should be a positive number.")
+        self.db_path = db_path
+        self.read_only = read_only
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.pragmas = self._check_pragmas(pragmas or {})
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        # Connections handed out and not released yet
+        self._in_use = set()
+        self._closed = False
+
+    @staticmethod
+    def _check_pragmas(pragmas: dict) -> list:
+        for name, value in pragmas.items():
+            if not name.isidentifier():
+                raise ValueError(f"Invalid pragma name {name!r}.")
+            if isinstance(value, bool) or not _PRAGMA_VALUE.match(str(value)):
+                raise ValueError(f"Invalid value {value!r} of pragma {name}.")
+        # The busy timeout goes first, so that the other
+        # pragmas wait for the locks they need as well
+        return sorted(pragmas.items(), key=lambda item: item[0] != 'busy_timeout')
+
+    def _open(self) -> sqlite3.Connection:
+        database = self.db_path
+        if self.read_only:
+            database = read_only_uri(database)
+        connection = sqlite3.connect(
+            database,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            # Transactions are managed explicitly by the services
+            isolation_level=None,
+            uri=self.read_only
+        )
+        try:
+            for name, value in self.pragmas:
+                # Journal mode is kept in the database file,
+                # it is set by the connections which may write
+                if self.read_only and name == 'journal_mode':
+                    continue
+                connection.execute(f"PRAGMA {name} = {value}").fetchall()
+            if self.read_only:
+                connection.execute("PRAGMA query_only = ON")
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def acquire(self, block: bool = True) -> sqlite3.Connection:
+        """Take a connection from the pool.
+
+        Opens a new connection if the pool is not full yet,
+        otherwise waits up to `timeout` seconds for a connection
+        to be released.
+
+        Arguments:
+            block {bool} -- wait for a connection if the pool is
+                exhausted, otherwise raise right away.
+
+        Raises:
+            ConnectionPoolError -- the pool is closed or exhausted.
+        """
+        if self._closed:
+            raise ConnectionPoolError("Connection pool is closed.")
+        deadline = None
+        while True:
+            connection = self._take_idle()
+            if connection is not None:
+                return connection
+
+            with self._lock:
+                if self._opened >= self.size:
+                    self._reclaim_closed()
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    connection = self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+                with self._lock:
+                    self._in_use.add(connection)
+                return connection
+
+            if not block:
+                raise ConnectionPoolError(
+                    f"All {self.size} connections to {self.db_path} are in use.")
+            # Wakes up now and then to reclaim the dropped connections
+            wait = _RECLAIM_INTERVAL
+            if self.timeout is not None:
+                if deadline is None:
+                    deadline = time.monotonic() + self.timeout
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise ConnectionPoolError(
+                        f"No connection to {self.db_path} was released "
+                        f"within {self.timeout} seconds.")
+            connection = self._take_idle(timeout=wait)
+            if connection is not None:
+                return connection
+
+    def _take_idle(self, timeout: float = None):
+        """Idle connection which is still open, `None` if there is none.
+        Waits for a released one up to `timeout` seconds if it is given.
+        """
+        while True:
+            try:
+                if timeout is not None:
+                    connection = self._idle.get(timeout=timeout)
+                else:
+                    connection = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            if _is_closed(connection):
+                # Closed by the user after it was released
+                with self._lock:
+                    self._opened -= 1
+                # Its place may be taken by a new one
+                timeout = None
+                continue
+            with self._lock:
+                self._in_use.add(connection)
+            return connection
+
+    def _reclaim_closed(self):
+        # Connections closed or dropped by the users without
+        # `release()`, called with the lock taken
+        for connection in _dropped(self._in_use):
+            # Nobody can use it anymore
+            connection.close()
+        closed = [c for c in self._in_use if _is_closed(c)]
+        for connection in closed:
+            self._in_use.remove(connection)
+            self._opened -= 1
+
+    def release(self, connection: sqlite3.Connection):
+        """Return a connection taken with `acquire()` to the pool.
+
+        A connection which is already closed only frees its place.
+
+        Raises:
+            ConnectionPoolError -- the connection is not taken from
+                the pool or is released already.
+        """
+        with self._lock:
+            taken = connection in self._in_use
+            self._in_use.discard(connection)
+        if _is_closed(connection):
+            if taken:
+                with self._lock:
+                    self._opened -= 1
+            return
+        if not taken:
+            # Put to the idle ones twice it would be handed out twice
+            raise ConnectionPoolError(
+                "Connection is not taken from the pool or is released already.")
+        if connection.in_transaction:
+            connection.rollback()
+        if self._closed:
+            self._discard(connection)
+        else:
+            self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        """Context manager acquiring and releasing a connection."""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        """Close all the idle connections and reject new acquires.
+
+        Connections which are in use at the moment are closed
+        as soon as they are released.
+        """
+        self._closed = True
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+    def _discard(self, connection: sqlite3.Connection):
+        with self._lock:
+            self._opened -= 1
+        connection.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+
+def _is_closed(connection: sqlite3.Connection) -> bool:
+    try:
+        connection.total_changes
+    except sqlite3.ProgrammingError:
+        return True
+    return False
+
+
+def _dropped(connections: set) -> list:
+    """Connections of the set nothing else refers to.
+
+    A connection is referred to by its statement cache as well, so
+    a dropped connection is freed only by the garbage collector.
+    """
+    return [c for c in connections if sys.getrefcount(c) <= _UNREFERENCED]
+
+
+def _count_unreferenced() -> int:
+    # Counted the same way `_dropped()` counts the references
+    connections = {sqlite3.connect(':memory:')}
+    counts = [sys.getrefcount(c) for c in connections]
+    connections.pop().close()
+    return counts[0]
+
+
+_UNREFERENCED = _count_unreferenced()
+
+
+def read_only_uri(db_path: str) -> str:
+    """URI opening the database file read-only."""
+    return pathlib.Path(db_path).absolute().as_uri() + '?mode=ro'
+
+
+class TransactionState:
+    """Connection bound to a thread by the services.
+
+    `depth` is the number of nested `transaction()` blocks open on
+    the connection and `callbacks` are called after the outermost
+    of them is committed. A state with zero depth only pins the
+    connection, so the queries do not take one from the pool.
+    """
+    __slots__ = ('connection', 'depth', 'callbacks')
+
+    def __init__(self, connection: sqlite3.Connection, depth: int = 0):
+        self.connection = connection
+        self.depth = depth
+        self.callbacks = []
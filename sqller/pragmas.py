@@ -0,0 +1,20 @@
+# Concurrent readers and writers of a database file: WAL journal,
+# fsync only at checkpoints, 64 MiB of page cache, 256 MiB of
+# memory-mapped I/O and temporary tables kept in memory. Writers
+# wait up to 5 seconds for a lock instead of failing with
+# "database is locked".
+HIGH_THROUGHPUT_PRAGMAS = {
+    'busy_timeout': 5000,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+# WAL journal for concurrency, but every commit is synced to disk.
+DURABLE_PRAGMAS = {
+    'busy_timeout': 5000,
+    'journal_mode': 'WAL',
+    'synchronous': 'FULL',
+}
@@ -0,0 +1,421 @@
+import operator
+import re
+from typing import Callable, Tuple
+
+from .exceptions import CustomSQLBuildError
+from .statement import SQLText, Statement
+from .utils import compile_function
+
+
+def make_binder(keys: tuple) -> Callable:
+    """Function taking the values of the keys from the arguments
+
+    Arguments:
+        keys {tuple} -- keys of keyword arguments or indexes of
+            positional arguments in the order of the placeholders.
+
+    Returns:
+        function -- function returning tuple of the values.
+    """
+    if len(keys) == 0:
+        return lambda arguments: ()
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda arguments: (arguments[key],)
+    return operator.itemgetter(*keys)
+
+
+def make_formatter(template: str, keys: tuple, text_keys: tuple,
+                   text_class: type = str, cache=None) -> Callable:
+    """Function writing the values of the keyword arguments into the template
+
+    The values of the text keys are escaped in place, so the call
+    is one `format()` of the template. Positional arguments are
+    ignored, as they always were by the name-derived queries.
+
+    Arguments:
+        template {str} -- format template with positional fields.
+        keys {tuple} -- keys of keyword arguments in the order of
+            the fields of the template.
+        text_keys {tuple} -- whether the value of the key is text.
+        text_class {type} -- class of the text, e.g. made with
+            `SQLText.named()`.
+        cache -- cache cleared before the text is made, if any.
+
+    Returns:
+        function -- function returning the formatted text.
+    """
+    values = [
+        # None is written as 'None' either way
+        f"str(arguments[{key!r}]).replace(\"'\", \"''\")" if is_text
+        else f"arguments[{key!r}]"
+        for key, is_text in zip(keys, text_keys)
+    ]
+    source = "def format_text(*args, **arguments):\n"
+    if cache is not None:
+        source += "    cache.clear()\n"
+    source += f"    return text_class(format({', '.join(values)}))\n"
+    return compile_function('format_text', source, {
+        'format': template.format, 'text_class': text_class, 'cache': cache})
+
+
+class CompiledQuery:
+    """Custom query parsed from the name of DAO attribute.
+
+    The name is parsed once, when the DAO class is created, into SQL
+    with `?` placeholders, a format template of the SQL text and the
+    order in which the keyword arguments are bound, so the call of
+    the query only collects the values of the arguments.
+    """
+
+    def __init__(self, name: str, model: type, sql: str, template: str,
+                 keys: Tuple[str], text_keys: Tuple[bool],
+                 delete: bool = False, cache=None, text_name: str = None):
+        self.name = name
+        self.model = model
+        self.delete = delete
+        # Cache of the DAO, cleared by the delete queries
+        self.cache = cache
+        self.sql = sql
+        self.template = template
+        self.keys = keys
+        self._bind = make_binder(keys)
+        # `sql_` query of DAO, called with the keyword arguments
+        self.format_text = make_formatter(
+            template, keys, text_keys, SQLText.named(text_name),
+            cache if delete else None)
+
+    def statement(self, kwargs: dict) -> Statement:
+        if self.delete:
+            return Statement(self.sql, self._bind(kwargs), self.name,
+                             cache=self.cache, invalidate=True)
+        return Statement(self.sql, self._bind(kwargs), self.name, self.model)
+
+    def text(self, kwargs: dict) -> str:
+        return self.format_text(**kwargs)
+
+
+# Aggregate functions a custom query may start with
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
+
+# Place of the selected columns of aggregate queries, which are
+# known only after `group_by` is parsed
+_SELECTED = '\x00'
+
+
+def parse_custom_query(attr_name: str, model: type, name: str,
+                       cache=None, text_name: str = None) -> CompiledQuery:
+    """Parse name of the custom query into SQL.
+
+    The name consists of the lexemes separated with `_`, e.g.
+    `sql_find_all_by_username_and_type`. The keywords are `select`
+    and `find` followed by `all` or the selected fields, e.g.
+    `sql_select_username_and_type_by_id`, `by`, `and`, `delete`,
+    `after` and `before`
+    (comparison `>` and `<` of the next field instead of `=`, for
+    keyset pagination), `order_by` followed by the fields and their
+    `asc` or `desc`, and `limit`, which is either followed by the
+    number of rows or takes the `limit` keyword argument. The rest
+    are the names of the fields of the model, e.g.
+    `sql_find_all_by_type_after_id_order_by_id_limit`.
+
+    Instead of `select` the name may start with the aggregates of
+    `AGGREGATES` followed by the field and joined with `and`, e.g.
+    `sql_count_by_type` or `sql_count_and_max_chat_id_by_type`, and
+    `group_by` followed by the fields selects them along with the
+    aggregates of every group, e.g. `sql_sum_chat_id_group_by_type`.
+
+    Arguments:
+        attr_name {str} -- name of the DAO attribute with `sql_` prefix.
+        model {type} -- model of the DAO.
+        name {str} -- name of the query reported by the statements.
+        cache {RowCache} -- cache of the DAO cleared by delete queries.
+        text_name {str} -- name of the query reported by the SQL text.
+
+    Raises:
+        CustomSQLBuildError -- the name refers to unknown field.
+
+    Returns:
+        CompiledQuery -- compiled query.
+    """
+    lexems = attr_name[4:].split('_')
+    columns = ', '.join([f.name for f in model.FIELDS])
+    keys = []
+    text_keys = []
+    sql_query_template = ''
+    sql_query = ''
+    final_user_lex = ''
+    comparison = '='
+    has_where = False
+    # Selected columns while they are parsed
+    projection = None
+    selected = None
+    # Columns of ORDER BY while the ordering lexemes are parsed
+    order_by = None
+    # Selected aggregates while they are parsed, and the function
+    # of the one which is parsed
+    aggregates = None
+    aggregate = None
+    selected_aggregates = None
+    # Columns of GROUP BY while they are parsed, and all of them
+    group_by = None
+    grouped = []
+
+    def get_field(field_name):
+        field = model.fields_by_name.get(field_name)
+        if field is None:
+            raise CustomSQLBuildError(
+                f"Model {model.__name__} has no field `{field_name}` "
+                f"used in `{attr_name}`.")
+        return field
+
+    def complete_aggregate():
+        nonlocal aggregate, final_user_lex
+        if aggregate is None:
+            return
+        if len(final_user_lex) != 0:
+            get_field(final_user_lex)
+            aggregates.append(f"{aggregate}({final_user_lex})")
+        elif aggregate == 'count':
+            aggregates.append('count(*)')
+        else:
+            raise CustomSQLBuildError(
+                f"No field of `{aggregate}` in `{attr_name}`.")
+        aggregate = None
+        final_user_lex = ''
+
+    def complete_custom_injection():
+        nonlocal sql_query_template, sql_query, final_user_lex, comparison
+        complete_aggregate()
+        if len(final_user_lex) != 0:
+            field = get_field(final_user_lex)
+            if projection is not None:
+                projection.append(final_user_lex)
+                final_user_lex = ''
+                return
+            if group_by is not None:
+                group_by.append(final_user_lex)
+                final_user_lex = ''
+                return
+            if order_by is not None:
+                order_by.append(final_user_lex)
+                final_user_lex = ''
+                return
+            if field.dtype == 'text':
+                sql_query_template += f"{final_user_lex} {comparison} '{{{len(keys)}}}' "
+            else:
+                sql_query_template += f"{final_user_lex} {comparison} {{{len(keys)}}} "
+            sql_query += f"{final_user_lex} {comparison} ? "
+            keys.append(final_user_lex)
+            text_keys.append(field.dtype == 'text')
+            final_user_lex = ''
+            comparison = '='
+
+    def complete_projection():
+        nonlocal projection, selected, aggregates, selected_aggregates
+        complete_custom_injection()
+        if projection is not None:
+            if not projection:
+                raise CustomSQLBuildError(
+                    f"No fields to select in `{attr_name}`.")
+            add_keyword(f"{', '.join(projection)} FROM {model.NAME} ")
+            selected = tuple(projection)
+            projection = None
+        if aggregates is not None:
+            if not aggregates:
+                raise CustomSQLBuildError(
+                    f"No aggregates to select in `{attr_name}`.")
+            add_keyword(f"{_SELECTED}FROM {model.NAME} ")
+            selected_aggregates = aggregates
+            aggregates = None
+
+    def complete_group_by():
+        nonlocal group_by
+        complete_projection()
+        if group_by is not None:
+            if not group_by:
+                raise CustomSQLBuildError(
+                    f"No fields to group by in `{attr_name}`.")
+            add_keyword(f"GROUP BY {', '.join(group_by)} ")
+            grouped.extend(group_by)
+            group_by = None
+
+    def complete_order_by():
+        nonlocal order_by
+        complete_group_by()
+        if order_by is not None:
+            if not order_by:
+                raise CustomSQLBuildError(
+                    f"No fields to order by in `{attr_name}`.")
+            add_keyword(f"ORDER BY {', '.join(order_by)} ")
+            order_by = None
+
+    def add_keyword(sql_keyword):
+        nonlocal sql_query_template, sql_query
+        sql_query_template += sql_keyword
+        sql_query += sql_keyword
+
+    i = 0
+    while i < len(lexems):
+        lex = lexems[i]
+        next_lex = lexems[i + 1] if i + 1 < len(lexems) else None
+        if lex == 'select' or lex == 'find':
+            complete_custom_injection()
+            add_keyword('SELECT ')
+            if next_lex != 'all':
+                projection = []
+        elif lex in AGGREGATES and (
+                i == 0 or aggregates is not None and lexems[i - 1] == 'and'):
+            if i == 0:
+                add_keyword('SELECT ')
+                aggregates = []
+            aggregate = lex
+        elif lex == 'all' and aggregates is not None:
+            # `count_all` is `count`
+            pass
+        elif lex == 'all':
+            complete_custom_injection()
+            if lexems[0].upper() != 'DELETE':
+                sql_query_template += '* '
+                sql_query += columns + ' '
+                add_keyword(f"FROM {model.NAME} ")
+        elif lex == 'group' and next_lex == 'by':
+            complete_projection()
+            group_by = []
+            i += 1
+        elif lex == 'order' and next_lex == 'by':
+            complete_group_by()
+            order_by = []
+            i += 1
+        elif lex == 'by':
+            complete_projection()
+            add_keyword('WHERE ')
+            has_where = True
+        elif lex == 'and':
+            complete_custom_injection()
+            if order_by is None and projection is None and \
+                    group_by is None and aggregates is None:
+                add_keyword('AND ')
+        elif lex in ('asc', 'desc') and order_by is not None:
+            complete_custom_injection()
+            if not order_by:
+                raise CustomSQLBuildError(
+                    f"`{lex}` without field to order by in `{attr_name}`.")
+            order_by[-1] += f" {lex.upper()}"
+        elif lex in ('after', 'before') and order_by is None:
+            complete_projection()
+            if not sql_query.endswith(('WHERE ', 'AND ')):
+                add_keyword('AND ' if has_where else 'WHERE ')
+                has_where = True
+            comparison = '>' if lex == 'after' else '<'
+        elif lex == 'limit':
+            complete_order_by()
+            if next_lex is not None and next_lex.isdigit():
+                add_keyword(f"LIMIT {int(next_lex)} ")
+                i += 1
+            else:
+                sql_query_template += f"LIMIT {{{len(keys)}}} "
+                sql_query += "LIMIT ? "
+                keys.append('limit')
+                text_keys.append(False)
+        elif lex == 'delete':
+            complete_custom_injection()
+            add_keyword(f"DELETE FROM {model.NAME} ")
+        else:
+            if len(final_user_lex) != 0:
+                final_user_lex += '_'
+            final_user_lex += lex
+        i += 1
+    complete_order_by()
+    if selected_aggregates is not None:
+        selected_columns = ', '.join(grouped + selected_aggregates) + ' '
+        sql_query = sql_query.replace(_SELECTED, selected_columns)
+        sql_query_template = sql_query_template.replace(_SELECTED, selected_columns)
+
+    if lexems[0] not in ('select', 'find'):
+        result_model = None
+    elif selected is not None:
+        result_model = model.partial(*selected)
+    else:
+        result_model = model
+
+    return CompiledQuery(
+        name=name,
+        model=result_model,
+        sql=sql_query.rstrip(),
+        template=sql_query_template.rstrip(),
+        keys=tuple(keys),
+        text_keys=tuple(text_keys),
+        delete=lexems[0] == 'delete',
+        cache=cache,
+        text_name=text_name
+    )
+
+
+_MARKER = '\x00{}\x00'
+_MARKER_PATTERN = re.compile("'\x00(\\d+)\x00'|\x00(\\d+)\x00")
+
+
+class PositionalQuery:
+    """Custom query provided by user as `CustomQuery(query)`.
+
+    The query is formatted with the arguments one by one, so the
+    arguments go to `{}`, `{{}}`, `{{{{}}}}`... in the order of their
+    nesting. The query is compiled once per number of arguments into
+    a template formatted in one call and SQL with `?` placeholders.
+    """
+
+    def __init__(self, query: str, name: str):
+        self.query = query
+        self.name = name
+        self._compiled = {}
+
+    def compile(self, count: int) -> Tuple:
+        """Compile the query for the number of arguments.
+
+        Both `{}` and `'{}'` become `?` in the placeholder form.
+
+        Returns:
+            tuple -- format template of the text, placeholder SQL,
+                function binding the arguments in the order of the
+                placeholders and the error raised for the placeholder
+                form if it cannot be built.
+        """
+        compiled = self._compiled.get(count)
+        if compiled is not None:
+            return compiled
+
+        marked_query = self.query
+        for i in range(count):
+            marked_query = marked_query.format(_MARKER.format(i))
+
+        template = marked_query.replace('{', '{{').replace('}', '}}')
+        template = re.sub('\x00(\\d+)\x00', r'{\1}', template)
+
+        order = []
+        literal_error = None
+
+        def replace(match):
+            nonlocal literal_error
+            if marked_query.count("'", 0, match.start()) % 2 != 0:
+                literal_error = CustomSQLBuildError(
+                    f"Argument is a part of a string literal in {self.query!r}.")
+            index = match.group(1) if match.group(1) is not None else match.group(2)
+            order.append(int(index))
+            return '?'
+        sql_query = _MARKER_PATTERN.sub(replace, marked_query)
+
+        compiled = (template, sql_query, make_binder(tuple(order)), literal_error)
+        self._compiled[count] = compiled
+        return compiled
+
+    def statement(self, args: tuple) -> Statement:
+        compiled = self._compiled.get(len(args)) or self.compile(len(args))
+        _, sql_query, bind, literal_error = compiled
+        if literal_error is not None:
+            raise literal_error
+        return Statement(sql_query, bind(args), self.name)
+
+    def text(self, args: tuple) -> str:
+        compiled = self._compiled.get(len(args)) or self.compile(len(args))
+        return compiled[0].format(*args)
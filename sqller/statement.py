@@ -0,0 +1,81 @@
+class Statement:
+    """SQL query with `?` placeholders and the values bound to them.
+
+    The SQL text of a statement generated by a DAO does not depend
+    on the values, so SQLite reuses the compiled statement from the
+    connection statement cache instead of parsing the query again.
+
+    Unpacks as `(sql, params)`:
+
+        sql, params = ChatDAO.get_one(1)
+        cursor.execute(*ChatDAO.get_one(1))
+    """
+    __slots__ = ('sql', 'params', 'name', 'model',
+                 'cache', 'cache_key', 'invalidate', 'attach')
+
+    def __init__(self, sql: str, params: tuple = (), name: str = None,
+                 model: type = None, cache=None, cache_key=None,
+                 invalidate=None, attach=None):
+        self.sql = sql
+        self.params = params
+        self.name = name
+        # Model the selected rows are loaded into
+        self.model = model
+        # `RowCache` of the DAO with the result stored by `cache_key`,
+        # and the keys of the cached results the statement makes stale
+        # (True if any of them). `cache_key` is the id of the object
+        # selected by `get_one`, which is looked up in identity maps
+        self.cache = cache
+        self.cache_key = cache_key
+        self.invalidate = invalidate
+        # Function called with the objects loaded by `fetch_all()`,
+        # e.g. to attach them to the objects they are related to
+        self.attach = attach
+
+    @property
+    def is_select(self) -> bool:
+        """Whether the statement only selects rows, so that it may
+        run on a read-only connection."""
+        return self.sql.startswith('SELECT')
+
+    def __iter__(self):
+        yield self.sql
+        yield self.params
+
+    def __eq__(self, other):
+        if isinstance(other, Statement):
+            other = (other.sql, other.params)
+        if isinstance(other, tuple):
+            return (self.sql, self.params) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Statement({self.sql!r}, {self.params!r})"
+
+
+class SQLText(str):
+    """SQL text generated by a DAO, e.g. by `ChatDAO.sql_exists`.
+
+    It is the plain text of the query, which also carries the name
+    of the DAO method the services report it under.
+    """
+    name = None
+
+    def __new__(cls, sql: str, name: str = None):
+        text = str.__new__(cls, sql)
+        text.name = name
+        return text
+
+    def __reduce__(self):
+        return SQLText, (str(self), self.name)
+
+    @classmethod
+    def named(cls, name: str) -> type:
+        """Class of the texts of the query with the name, which are
+        created faster than with `SQLText(sql, name)` as they take
+        the name from the class.
+        """
+        return type(cls.__name__, (cls,), {
+            '__slots__': (), 'name': name, '__new__': str.__new__})
@@ -1,16 +1,54 @@
+import keyword
+import re
+from typing import Iterable, Optional, Tuple
+
 
 class CustomQuery:
     def __init__(self, query: str = None):
         self.query = query
 
 
+class Reference(str):
+    """Text of a reference, e.g. `chats(id)`, made by `reference()`
+    of the model, which keeps the referenced model as well.
+    """
+    def __new__(cls, text: str, model: type = None):
+        reference = super().__new__(cls, text)
+        reference.model = model
+        return reference
+
+
 class Field:
-    def __init__(self, name: str, dtype: str, postfix: str = None, prefix: str = None, reference: str = None):
+    def __init__(self, name: str, dtype: str, postfix: str = None, prefix: str = None, reference: str = None,
+                 unique: bool = False, index: bool = False, relation: str = None, model: type = None):
         self.name = name
         self.dtype = dtype
         self.postfix = postfix
         self.prefix = prefix
         self.reference = reference
+        self.unique = unique
+        self.index = index
+        # Referenced model, the one of `Chat.reference('id')` by default
+        if model is None:
+            model = getattr(reference, 'model', None)
+        self.model = model
+        # Attribute the referenced object is loaded into,
+        # `chat` for `chat_id` by default
+        self._default_relation = relation is None and model is not None and name.endswith('_id')
+        if self._default_relation:
+            relation = name[:-len('_id')]
+        self.relation = relation
+
+    def referenced_column(self) -> Optional[Tuple[str, str]]:
+        """Table and column of the reference, e.g. `('chats', 'id')`
+        for `chats(id)`, or None if the field is not a reference.
+        """
+        if self.reference is None:
+            return None
+        match = re.match(r"\s*(\w+)\s*\(\s*(\w+)\s*\)", self.reference)
+        if match is None:
+            return None
+        return match.group(1), match.group(2)
 
     def sql_description(self) -> str:
         """Field description used in creation script
@@ -22,10 +60,142 @@ class Field:
         sql_field += f"{self.name} {self.dtype}"
         if self.postfix is not None:
             sql_field += f" {self.postfix}"
+        if self.unique:
+            sql_field += " UNIQUE"
         if self.reference is not None:
             sql_field += f",\nFOREIGN KEY ({self.name}) REFERENCES {self.reference}"
         return sql_field
 
+    def sql_column_description(self) -> str:
+        """Field description used to add the column to existing table
+
+        Returns:
+            str -- column definition for `ALTER TABLE ... ADD COLUMN`.
+        """
+        sql_field = f"{self.name} {self.dtype}"
+        if self.postfix is not None:
+            sql_field += f" {self.postfix}"
+        if self.reference is not None:
+            sql_field += f" REFERENCES {self.reference}"
+        return sql_field
+
+
+class Index:
+    def __init__(self, *columns: str, unique: bool = False, where: str = None, name: str = None):
+        """Index of the table declared in `INDEXES` of the model
+
+        Arguments:
+            columns {str} -- indexed columns, several for composite index.
+            unique {bool} -- whether the index is unique.
+            where {str} -- condition of partial index.
+            name {str} -- name of the index, generated by default.
+        """
+        if not columns:
+            raise ValueError("Index should have at least one column.")
+        self.columns = columns
+        self.unique = unique
+        self.where = where
+        self.name = name
+
+    def sql_create(self, table: str) -> str:
+        """Index creation script
+
+        Arguments:
+            table {str} -- name of the indexed table.
+
+        Returns:
+            str -- creation script of the index.
+        """
+        name = self.name
+        if name is None:
+            name = f"ix_{table}_{'_'.join(self.columns)}"
+        sql_query = "CREATE UNIQUE INDEX" if self.unique else "CREATE INDEX"
+        sql_query += f" IF NOT EXISTS {name} ON {table}({', '.join(self.columns)})"
+        if self.where is not None:
+            sql_query += f" WHERE {self.where}"
+        return sql_query
+
+
+class LazyAttribute:
+    """Class attribute built on first access.
+
+    Generated methods which are costly to build, e.g. compiled from
+    source, are set to the class as lazy attributes, so that defining
+    the class does not pay for the methods it never uses. On first
+    access the attribute is built and replaces the descriptor in the
+    class it was set to.
+    """
+    __slots__ = ('owner', 'name', 'build')
+
+    def __init__(self, owner: type, name: str, build):
+        self.owner = owner
+        self.name = name
+        self.build = build
+
+    def __get__(self, obj, owner=None):
+        setattr(self.owner, self.name, self.build())
+        if obj is None:
+            return getattr(owner if owner is not None else self.owner, self.name)
+        return getattr(obj, self.name)
+
+
+def sql_literal(value, dtype: str) -> str:
+    """Value written into SQL text of the query
+
+    Arguments:
+        value -- value of the field.
+        dtype {str} -- SQL type of the field.
+
+    Returns:
+        str -- SQL literal with the value.
+    """
+    if value is None:
+        return 'NULL'
+    if dtype == 'text':
+        return "'" + str(value).replace("'", "''") + "'"
+    return f"{value}"
+
+
+def sql_text(sql_query: str, params: tuple) -> str:
+    """SQL text of the query with the values written in place of `?`
+
+    Arguments:
+        sql_query {str} -- query with `?` placeholders.
+        params {tuple} -- values of the placeholders.
+
+    Returns:
+        str -- SQL text of the query.
+    """
+    parts = sql_query.split('?')
+    sql_text_query = parts[0]
+    for value, part in zip(params, parts[1:]):
+        sql_text_query += sql_literal(value, 'text' if isinstance(value, str) else None)
+        sql_text_query += part
+    return sql_text_query
+
+
+def compile_function(name: str, source: str, namespace: dict):
+    """Compile source code of generated function
+
+    Arguments:
+        name {str} -- name of the function defined in the source.
+        source {str} -- source code of the function.
+        namespace {dict} -- global names used by the function.
+
+    Returns:
+        function -- compiled function.
+    """
+    exec(source, namespace)
+    return namespace[name]
+
+
+def is_plain_names(names: Iterable[str]) -> bool:
+    """Whether the names may be used as Python identifiers in generated code"""
+    return all(
+        name.isidentifier() and not keyword.iskeyword(name)
+        for name in names
+    )
+
 
 def is_empty_function(func):
     def empty_func():
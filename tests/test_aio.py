@@ -0,0 +1,291 @@
+import asyncio
+import sqlite3
+import time
+
+import sqller as utils
+import pytest
+
+from test_service import create_chat_model
+
+
+def create_async_chat_service(db_path, **options):
+    Chat = create_chat_model()
+    dct = dict(DB_PATH=str(db_path), MODELS=[Chat])
+    dct.update(options)
+    return utils.AsyncServiceMeta('ChatService', (), dct)
+
+
+# Counts to `x` without touching tables, long enough to be cancelled
+LONG_QUERY = """
+WITH RECURSIVE numbers(x) AS (
+    SELECT 1 UNION ALL SELECT x + 1 FROM numbers WHERE x < 100000000
+)
+SELECT count(*) FROM numbers
+"""
+
+
+class TestAsyncService:
+    def test_service_creation_convention_violation(self):
+        with pytest.raises(utils.ConventionViolationError):
+            class ChatService(metaclass=utils.AsyncServiceMeta):
+                MODELS = []
+
+    def test_execute(self, tmp_path):
+        ChatService = create_async_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        async def main():
+            await ChatService.execute(ChatDAO.save(Chat(type='usual')))
+            await ChatService.execute_many(ChatDAO.save_many(
+                [Chat(type='group'), Chat(type='channel')]))
+            chat = await ChatService.fetch_one(ChatDAO.get_one(2))
+            chats = await ChatService.fetch_all(ChatDAO.find_all())
+            rows = await ChatService.execute(
+                "SELECT count(*) FROM chats WHERE type = ?", ('usual',))
+            unchanged = await ChatService.execute_rowcount(ChatDAO.update(chat))
+            await ChatService.close()
+            return chat, chats, rows, unchanged
+
+        chat, chats, rows, unchanged = asyncio.run(main())
+        assert chat.type == 'group'
+        assert unchanged == 0
+        assert [c.type for c in chats] == ['usual', 'group', 'channel']
+        assert rows == [(1,)]
+
+    def test_concurrent_execute(self, tmp_path):
+        ChatService = create_async_chat_service(
+            tmp_path / 'db.sqlite3', WORKERS=4)
+
+        async def insert(i):
+            await ChatService.execute(
+                "INSERT INTO chats(username) VALUES (?)", (f'user{i}',))
+
+        async def main():
+            await asyncio.gather(*[insert(i) for i in range(50)])
+            return await ChatService.execute("SELECT count(*) FROM chats")
+
+        assert asyncio.run(main()) == [(50,)]
+
+    def test_transaction(self, tmp_path):
+        ChatService = create_async_chat_service(
+            tmp_path / 'db.sqlite3', WORKERS=2)
+
+        async def count():
+            rows = await ChatService.execute("SELECT count(*) FROM chats")
+            return rows[0][0]
+
+        async def main():
+            counts = []
+            async with ChatService.transaction():
+                assert ChatService.in_transaction()
+                await ChatService.execute(
+                    "INSERT INTO chats(type) VALUES ('usual')")
+                # Another task does not see the uncommitted row
+                counts.append(await asyncio.create_task(count()))
+                counts.append(await count())
+            assert not ChatService.in_transaction()
+            counts.append(await count())
+            return counts
+
+        assert asyncio.run(main()) == [0, 1, 1]
+
+    def test_transaction_rollback(self, tmp_path):
+        ChatService = create_async_chat_service(tmp_path / 'db.sqlite3')
+
+        async def main():
+            with pytest.raises(ValueError):
+                async with ChatService.transaction():
+                    await ChatService.execute(
+                        "INSERT INTO chats(type) VALUES ('usual')")
+                    async with ChatService.transaction():
+                        await ChatService.execute(
+                            "INSERT INTO chats(type) VALUES ('group')")
+                    raise ValueError
+            return await ChatService.execute("SELECT count(*) FROM chats")
+
+        assert asyncio.run(main()) == [(0,)]
+
+    def test_transaction_savepoint(self, tmp_path):
+        ChatService = create_async_chat_service(tmp_path / 'db.sqlite3')
+
+        async def main():
+            async with ChatService.transaction():
+                await ChatService.execute(
+                    "INSERT INTO chats(type) VALUES ('usual')")
+                with pytest.raises(ValueError):
+                    async with ChatService.transaction():
+                        await ChatService.execute(
+                            "INSERT INTO chats(type) VALUES ('group')")
+                        raise ValueError
+            return await ChatService.execute("SELECT type FROM chats")
+
+        assert asyncio.run(main()) == [('usual',)]
+
+    def test_iterate(self, tmp_path):
+        ChatService = create_async_chat_service(
+            tmp_path / 'db.sqlite3', FETCH_SIZE=3, POOL_SIZE=2, POOL_TIMEOUT=1)
+
+        async def main():
+            await ChatService.execute_many(
+                "INSERT INTO chats(type) VALUES (?)", [('usual',)] * 10)
+            ids = [row[0] async for row in ChatService.iterate(
+                "SELECT id FROM chats ORDER BY id")]
+            async with ChatService.transaction():
+                await ChatService.execute(
+                    "INSERT INTO chats(type) VALUES ('group')")
+                groups = [row async for row in ChatService.iterate(
+                    "SELECT id FROM chats WHERE type = 'group'")]
+            return ids, groups
+
+        ids, groups = asyncio.run(main())
+        assert ids == list(range(1, 11))
+        assert groups == [(11,)]
+
+    def test_cancel_running_query(self, tmp_path):
+        ChatService = create_async_chat_service(tmp_path / 'db.sqlite3')
+
+        async def main():
+            task = asyncio.create_task(ChatService.execute(LONG_QUERY))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            start = time.perf_counter()
+            rows = await ChatService.execute("SELECT 1")
+            return rows, time.perf_counter() - start
+
+        rows, elapsed = asyncio.run(main())
+        assert rows == [(1,)]
+        assert elapsed < 1
+
+    def test_cancel_queued_query(self, tmp_path):
+        ChatService = create_async_chat_service(tmp_path / 'db.sqlite3')
+
+        async def main():
+            running = asyncio.create_task(ChatService.execute(LONG_QUERY))
+            queued = asyncio.create_task(ChatService.execute(
+                "INSERT INTO chats(type) VALUES ('usual')"))
+            await asyncio.sleep(0.1)
+            queued.cancel()
+            running.cancel()
+            await asyncio.gather(running, queued, return_exceptions=True)
+            return await ChatService.execute("SELECT count(*) FROM chats")
+
+        assert asyncio.run(main()) == [(0,)]
+
+    def test_cancel_transaction(self, tmp_path):
+        ChatService = create_async_chat_service(tmp_path / 'db.sqlite3')
+
+        async def insert():
+            async with ChatService.transaction():
+                await ChatService.execute(
+                    "INSERT INTO chats(type) VALUES ('usual')")
+                await ChatService.execute(LONG_QUERY)
+
+        async def main():
+            task = asyncio.create_task(insert())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            return await ChatService.execute("SELECT count(*) FROM chats")
+
+        assert asyncio.run(main()) == [(0,)]
+
+    def test_overlapping_transactions(self, tmp_path):
+        # More transactions than connections, which would block
+        # the only worker on the pool or on the database lock
+        ChatService = create_async_chat_service(
+            tmp_path / 'db.sqlite3', POOL_SIZE=2, POOL_TIMEOUT=1,
+            PRAGMAS={'busy_timeout': 100})
+
+        async def insert(type):
+            async with ChatService.transaction():
+                await ChatService.execute(
+                    "INSERT INTO chats(type) VALUES (?)", (type,))
+                await asyncio.sleep(0.01)
+                await ChatService.execute(
+                    "INSERT INTO chats(type) VALUES (?)", (type,))
+
+        async def main():
+            await asyncio.gather(
+                insert('usual'), insert('group'), insert('channel'),
+                ChatService.execute("SELECT count(*) FROM chats"))
+            return await ChatService.execute(
+                "SELECT type, count(*) FROM chats GROUP BY type ORDER BY type")
+
+        assert asyncio.run(main()) == [('channel', 2), ('group', 2), ('usual', 2)]
+
+    def test_exhausted_pool(self, tmp_path):
+        ChatService = create_async_chat_service(
+            tmp_path / 'db.sqlite3', POOL_SIZE=1, POOL_TIMEOUT=1)
+
+        async def main():
+            await ChatService.execute_many(
+                "INSERT INTO chats(type) VALUES (?)", [('usual',), ('group',)])
+            rows = ChatService.iterate("SELECT type FROM chats", batch_size=1)
+            first = await rows.__anext__()
+            # Waits for the connection of the iteration in the event loop
+            task = asyncio.create_task(
+                ChatService.execute("SELECT count(*) FROM chats"))
+            await asyncio.sleep(0.05)
+            assert not task.done()
+            rest = [row async for row in rows]
+            return [first] + rest, await task
+
+        assert asyncio.run(main()) == ([('usual',), ('group',)], [(2,)])
+
+    def test_queries_inside_iterate(self):
+        ChatService = create_async_chat_service(':memory:', FETCH_SIZE=1)
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        async def main():
+            await ChatService.execute_many(ChatDAO.save_many(
+                [Chat(type='usual'), Chat(type='group')]))
+            types = []
+            async for row in ChatService.iterate(ChatDAO.find_all()):
+                chat = await ChatService.fetch_one(ChatDAO.get_one(row[0]))
+                types.append(chat.type)
+                async with ChatService.transaction():
+                    await ChatService.execute(
+                        "UPDATE chats SET username = 'seen' WHERE id = ?", row[:1])
+            usernames = await ChatService.execute("SELECT username FROM chats")
+            return types, usernames
+
+        result = asyncio.run(asyncio.wait_for(main(), 5))
+        assert result == (['usual', 'group'], [('seen',)] * 2)
+
+    def test_sync_service(self, tmp_path):
+        ChatService = create_async_chat_service(tmp_path / 'db.sqlite3')
+        ChatService.sync.execute("INSERT INTO chats(type) VALUES ('usual')")
+
+        assert asyncio.run(ChatService.execute(
+            "SELECT type FROM chats")) == [('usual',)]
+        with pytest.raises(sqlite3.OperationalError):
+            asyncio.run(ChatService.execute("SELECT * FROM missing"))
+
+    def test_readers(self, tmp_path):
+        ChatService = create_async_chat_service(
+            tmp_path / 'db.sqlite3', READERS=1, POOL_TIMEOUT=0.01)
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        async def main():
+            await ChatService.execute(ChatDAO.save(Chat(type='usual')))
+            chat = await ChatService.fetch_one(ChatDAO.get_one(1))
+            reader = ChatService.sync.read_pool.acquire()
+            with pytest.raises(utils.ConnectionPoolError):
+                await ChatService.fetch_all(ChatDAO.find_all())
+            ChatService.sync.read_pool.release(reader)
+            await ChatService.close()
+            return chat
+
+        assert asyncio.run(main()).type == 'usual'
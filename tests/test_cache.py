@@ -0,0 +1,107 @@
+import time
+
+import sqller as utils
+
+from test_service import create_chat_model, create_chat_service
+
+
+class TestRowCache:
+    def test_cache_lru(self):
+        cache = utils.RowCache(maxsize=2)
+        cache.set(1, 'first')
+        cache.set(2, 'second')
+        assert cache.get(1) == 'first'
+        cache.set(3, 'third')
+
+        assert cache.get(2) is None
+        assert cache.get(3) == 'third'
+        assert cache.stats() == {
+            'hits': 2, 'misses': 1, 'evictions': 1, 'size': 2}
+
+    def test_cache_ttl(self):
+        cache = utils.RowCache(ttl=0.01)
+        cache.set(1, 'first')
+        assert cache.get(1) == 'first'
+        time.sleep(0.02)
+
+        assert cache.get(1) is None
+        assert len(cache) == 0
+
+
+class TestIdentityMap:
+    def test_identity_map(self):
+        Chat = create_chat_model()
+        identity_map = utils.IdentityMap()
+
+        chat = identity_map.load(Chat, (1, 'usual', None, None, 'voilalex'))
+        assert identity_map.load(Chat, (1, 'group', None, None, 'sqller')) is chat
+        assert chat.type == 'usual'
+        assert identity_map.get(Chat, 1) is chat
+        assert identity_map.get(Chat.partial('id', 'type'), 1) is None
+
+        UsernameChat = Chat.partial('id', 'username')
+        assert identity_map.load(UsernameChat, (1, 'sqller')).username == 'sqller'
+        assert len(identity_map) == 1
+
+        identity_map.evict([2])
+        assert identity_map.get(Chat, 1) is chat
+        identity_map.evict([1])
+        assert identity_map.get(Chat, 1) is None
+
+
+class TestDAOCache:
+    def create_dao(self, ChatService):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = ChatService.MODELS[0]
+            CACHE = utils.RowCache()
+            sql_delete_by_type = utils.CustomQuery()
+        return ChatDAO
+
+    def test_get_one_cached(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatDAO = self.create_dao(ChatService)
+        ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+
+        assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'usual'
+        ChatService.execute("UPDATE chats SET type = 'group'")
+        assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'usual'
+        assert ChatService.fetch_one(ChatDAO.get_one(2)) is None
+        assert ChatDAO.CACHE.stats() == {
+            'hits': 1, 'misses': 2, 'evictions': 0, 'size': 1}
+
+    def test_cache_invalidated(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatDAO = self.create_dao(ChatService)
+        Chat = ChatService.MODELS[0]
+        ChatService.execute_many(ChatDAO.save_many(
+            [Chat(type='usual'), Chat(type='group')]))
+
+        chat = ChatService.fetch_one(ChatDAO.get_one(1))
+        chat.type = 'channel'
+        ChatService.execute(ChatDAO.update(chat))
+        assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'channel'
+
+        ChatService.execute(ChatDAO.delete_by_id(1))
+        assert ChatService.fetch_one(ChatDAO.get_one(1)) is None
+
+        ChatService.fetch_one(ChatDAO.get_one(2))
+        ChatService.execute(ChatDAO.delete_by_type(type='group'))
+        assert ChatService.fetch_one(ChatDAO.get_one(2)) is None
+
+    def test_cache_invalidated_by_sql_text(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatDAO = self.create_dao(ChatService)
+        ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+
+        ChatService.execute(ChatDAO.get_one(1))
+        ChatService.execute(ChatDAO.sql_delete_by_id(1))
+        assert ChatService.execute(ChatDAO.get_one(1)) == []
+
+    def test_cache_in_transaction(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatDAO = self.create_dao(ChatService)
+
+        with ChatService.transaction():
+            ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+            assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'usual'
+            assert len(ChatDAO.CACHE) == 0
@@ -3,6 +3,8 @@ import sqller
 import sqller as utils
 import pytest
 
+from test_service import create_chat_model
+
 
 class TestDatabaseUtils:
     def test_model_creation_convetion_violation_fields(self):
@@ -347,3 +349,779 @@ class TestDatabaseUtils:
             MODEL = Chat
 
         assert ChatDAO.sql_delete_by_id(1) == 'DELETE FROM chats\nWHERE id=1'
+
+    def test_dao_sql_save_quotes(self):
+        class Chat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="type", dtype="text"),
+                utils.Field(name="last_name", dtype="text")
+            ]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_find_all_by_last_name = utils.CustomQuery()
+
+        obj = Chat(type='usual', last_name="O'Neil")
+
+        assert ChatDAO.sql_save(
+            obj) == "INSERT INTO chats(type,last_name)\nVALUES ('usual','O''Neil')"
+        assert ChatDAO.sql_find_all_by_last_name(
+            last_name="O'Neil") == "SELECT * FROM chats WHERE last_name = 'O''Neil'"
+
+
+class TestDAOStatements:
+    def test_dao_get_one(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = create_chat_model()
+
+        statement = ChatDAO.get_one(0)
+        assert statement == (
+            'SELECT id, type, last_name, first_name, username FROM chats'
+            '\nWHERE id = ?\nLIMIT 1;', (0,))
+        assert statement.name == 'ChatDAO.get_one'
+        assert ChatDAO.get_one(1).sql is statement.sql
+
+    def test_dao_find_all(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = create_chat_model()
+
+        assert ChatDAO.find_all() == (
+            'SELECT id, type, last_name, first_name, username FROM chats;', ())
+
+    def test_dao_save(self):
+        Chat = create_chat_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        sql, params = ChatDAO.save(Chat(type='usual', username="O'Neil"))
+        assert sql == "INSERT INTO chats(type,username)\nVALUES (?,?)"
+        assert params == ('usual', "O'Neil")
+        assert ChatDAO.save(Chat(type='group', username='voilalex')).sql is sql
+        assert ChatDAO.save(Chat()).sql == "INSERT INTO chats DEFAULT VALUES"
+
+    def test_dao_save_many(self):
+        Chat = create_chat_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        statement = ChatDAO.save_many([
+            Chat(type='usual', username='voilalex'),
+            Chat(type='group', last_name='Vouk')
+        ])
+        assert statement == (
+            "INSERT INTO chats(type,last_name,username)\nVALUES (?,?,?)",
+            [('usual', None, 'voilalex'), ('group', 'Vouk', None)])
+
+    def test_dao_exists(self):
+        Chat = create_chat_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        assert ChatDAO.exists(Chat(type='usual', last_name='Vouk')) == (
+            "SELECT EXISTS(SELECT 1 FROM chats "
+            "WHERE type = ? AND last_name = ? LIMIT 1);",
+            ('usual', 'Vouk'))
+
+    def test_dao_update(self):
+        Chat = create_chat_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        obj = Chat(id=0, type='usual')
+        obj.last_name = obj.first_name = obj.username = ...
+        assert ChatDAO.update(obj) == (
+            "UPDATE chats SET type=?\nWHERE id=?", ('usual', 0))
+
+    def test_dao_update_changed_fields(self):
+        Chat = create_chat_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        obj = Chat.from_row((1, 'usual', 'Vouk', 'Ilya', 'voilalex'))
+        assert obj.changed_fields() == ()
+        assert ChatDAO.update(obj) == ('', ())
+        assert ChatDAO.sql_update(obj) == ''
+
+        obj.username = 'vouk'
+        obj.type = 'usual'
+        assert obj.changed_fields() == ('username',)
+        assert ChatDAO.update(obj) == (
+            "UPDATE chats SET username=?\nWHERE id=?", ('vouk', 1))
+        assert ChatDAO.sql_update(obj) == "UPDATE chats SET username='vouk'\nWHERE id=1"
+
+        obj.mark_clean()
+        assert ChatDAO.update(obj) == ('', ())
+
+    def test_dao_delete_by_id(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = create_chat_model()
+
+        assert ChatDAO.delete_by_id(1) == ('DELETE FROM chats\nWHERE id=?', (1,))
+
+    def test_dao_custom_query_anonymous(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = create_chat_model()
+            sql_delete_by_type = utils.CustomQuery()
+            sql_find_all_by_last_name_and_first_name = utils.CustomQuery()
+
+        assert ChatDAO.delete_by_type(type='usual') == (
+            "DELETE FROM chats WHERE type = ?", ('usual',))
+        assert ChatDAO.find_all_by_last_name_and_first_name(
+            first_name='Ilya',
+            last_name='Vouk'
+        ) == ("SELECT id, type, last_name, first_name, username FROM chats "
+              "WHERE last_name = ? AND first_name = ?", ('Vouk', 'Ilya'))
+
+    def test_dao_custom_query_user_provided(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = create_chat_model()
+            custom_find = utils.CustomQuery(
+                "SELECT * FROM chats WHERE last_name = '{}' AND id > {{}}")
+            custom_find_in_literal = utils.CustomQuery(
+                "SELECT * FROM chats WHERE last_name LIKE '{}%'")
+
+        assert ChatDAO.custom_find('Vouk', 1) == \
+            "SELECT * FROM chats WHERE last_name = 'Vouk' AND id > 1"
+        assert ChatDAO.prepared_custom_find('Vouk', 1) == (
+            "SELECT * FROM chats WHERE last_name = ? AND id > ?", ('Vouk', 1))
+        with pytest.raises(utils.CustomSQLBuildError):
+            ChatDAO.prepared_custom_find_in_literal('Vo')
+
+
+class TestModelHydration:
+    def test_model_slots(self):
+        class Chat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="type", dtype="text")
+            ]
+        obj = Chat(id=0, type='usual')
+
+        assert Chat.__slots__ == ('id', 'type', '_loaded')
+        assert not hasattr(obj, '__dict__')
+        with pytest.raises(AttributeError):
+            obj.username = 'voilalex'
+
+    def test_model_field_defaults(self):
+        class Chat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="type", dtype="text"),
+                utils.Field(name="from", dtype="text")
+            ]
+            type = 'usual'
+            vars()['from'] = 'voilalex'
+
+        assert Chat.__slots__ == ('id', 'type', 'from', '_loaded')
+        assert (Chat(id=1).type, Chat(type='group').type) == ('usual', 'group')
+        assert getattr(Chat(), 'from') == 'voilalex'
+        assert Chat.from_row((1, None, None)).type is None
+
+        with pytest.raises(utils.ConventionViolationError):
+            class Chat(metaclass=utils.ModelMeta):
+                NAME = 'chats'
+                FIELDS = [
+                    utils.Field(name="id", dtype="integer",
+                                postfix="PRIMARY KEY"),
+                    utils.Field(name="type", dtype="text")
+                ]
+
+                @property
+                def type(self):
+                    return 'usual'
+
+    def test_model_from_row(self):
+        class Chat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="type", dtype="text"),
+                utils.Field(name="username", dtype="text")
+            ]
+        obj = Chat.from_row((1, 'usual', 'voilalex'))
+
+        assert isinstance(obj, Chat)
+        assert (obj.id, obj.type, obj.username) == (1, 'usual', 'voilalex')
+
+    def test_model_not_identifier_fields(self):
+        class Chat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="from", dtype="text")
+            ]
+        obj = Chat(**{'id': 1, 'from': 'voilalex'})
+
+        assert getattr(obj, 'from') == 'voilalex'
+        assert getattr(Chat.from_row((2, 'Vouk')), 'from') == 'Vouk'
+
+    def test_model_methods_built_lazily(self):
+        class Chat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="type", dtype="text")
+            ]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        assert not isinstance(Chat.__dict__['from_row'], staticmethod)
+        assert Chat.from_row((1, 'usual')).type == 'usual'
+        assert isinstance(Chat.__dict__['from_row'], staticmethod)
+        assert Chat(id=2).id == 2
+        assert Chat(id=3, type='group').type == 'group'
+
+        assert not isinstance(ChatDAO.__dict__['sql_get_one'], staticmethod)
+        assert ChatDAO.sql_get_one(1).name == 'ChatDAO.sql_get_one'
+        assert isinstance(ChatDAO.__dict__['sql_get_one'], staticmethod)
+
+
+class TestCompiledQueries:
+    def create_model(self):
+        return create_chat_model('type', 'last_name')
+
+    def test_model_fields_by_name(self):
+        Chat = self.create_model()
+
+        assert Chat.fields_by_name['last_name'] is Chat.FIELDS[2]
+
+    def test_dao_custom_queries(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+            sql_find_all_by_last_name_and_id = utils.CustomQuery()
+            custom_find = utils.CustomQuery("SELECT * FROM chats WHERE id = {}")
+
+        query = ChatDAO.custom_queries['sql_find_all_by_last_name_and_id']
+        assert query.keys == ('last_name', 'id')
+        assert query.template == \
+            "SELECT * FROM chats WHERE last_name = '{0}' AND id = {1}"
+        assert ChatDAO.sql_find_all_by_last_name_and_id(
+            id=1, last_name='Vouk') == \
+            "SELECT * FROM chats WHERE last_name = 'Vouk' AND id = 1"
+        assert 'custom_find' in ChatDAO.custom_queries
+
+    def test_dao_custom_query_user_provided_nested(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+            custom_find = utils.CustomQuery(
+                "SELECT * FROM chats WHERE id > {{}} AND type = '{}' AND id < {{{{}}}}")
+
+        assert ChatDAO.custom_find('usual', 1, 10) == \
+            "SELECT * FROM chats WHERE id > 1 AND type = 'usual' AND id < 10"
+        assert ChatDAO.prepared_custom_find('usual', 1, 10) == (
+            "SELECT * FROM chats WHERE id > ? AND type = ? AND id < ?",
+            (1, 'usual', 10))
+        assert ChatDAO.prepared_custom_find('usual') == (
+            "SELECT * FROM chats WHERE id > {} AND type = ? AND id < {{}}",
+            ('usual',))
+
+    def test_dao_aggregate_queries(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+            sql_count_by_type = utils.CustomQuery()
+            sql_count_all = utils.CustomQuery()
+            sql_count_and_max_id_by_type = utils.CustomQuery()
+            sql_sum_id_group_by_type = utils.CustomQuery()
+            sql_count_by_last_name_group_by_type_order_by_type_desc_limit_5 = \
+                utils.CustomQuery()
+
+        assert ChatDAO.sql_count_by_type(type='usual') == \
+            "SELECT count(*) FROM chats WHERE type = 'usual'"
+        statement = ChatDAO.count_by_type(type='usual')
+        assert statement == ("SELECT count(*) FROM chats WHERE type = ?", ('usual',))
+        assert statement.model is None
+        assert ChatDAO.count_all() == ("SELECT count(*) FROM chats", ())
+        assert ChatDAO.count_and_max_id_by_type(type='usual') == (
+            "SELECT count(*), max(id) FROM chats WHERE type = ?", ('usual',))
+        assert ChatDAO.sum_id_group_by_type() == (
+            "SELECT type, sum(id) FROM chats GROUP BY type", ())
+        assert ChatDAO.count_by_last_name_group_by_type_order_by_type_desc_limit_5(
+            last_name='Vouk') == (
+                "SELECT type, count(*) FROM chats WHERE last_name = ? "
+                "GROUP BY type ORDER BY type DESC LIMIT 5", ('Vouk',))
+
+    def test_dao_aggregate_query_errors(self):
+        Chat = self.create_model()
+        for attr_name in ('sql_sum_by_type', 'sql_max_username_by_type',
+                          'sql_count_group_by'):
+            with pytest.raises(utils.CustomSQLBuildError):
+                utils.DAOMeta('ChatDAO', (), {
+                    'MODEL': Chat, attr_name: utils.CustomQuery()})
+
+
+class TestUpsert:
+    def create_model(self):
+        return create_chat_model(
+            'type', 'username', utils.Field(name="chat_id", dtype="integer", unique=True))
+
+    def test_field_unique(self):
+        Chat = self.create_model()
+
+        assert Chat.FIELDS[3].sql_description() == "chat_id integer UNIQUE"
+
+    def test_dao_upsert(self):
+        Chat = self.create_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        obj = Chat(type='usual', username="O'Neil", chat_id=10)
+        assert ChatDAO.upsert(obj) == (
+            "INSERT INTO chats(type,username,chat_id)\nVALUES (?,?,?)"
+            "\nON CONFLICT(chat_id) DO UPDATE SET "
+            "type=excluded.type, username=excluded.username",
+            ('usual', "O'Neil", 10))
+        assert ChatDAO.upsert(obj, update=False).sql == (
+            "INSERT INTO chats(type,username,chat_id)\nVALUES (?,?,?)"
+            "\nON CONFLICT(chat_id) DO NOTHING")
+        assert ChatDAO.sql_upsert(obj, update=False) == (
+            "INSERT INTO chats(type,username,chat_id)\nVALUES ('usual','O''Neil',10)"
+            "\nON CONFLICT(chat_id) DO NOTHING")
+
+    def test_dao_upsert_key(self):
+        Chat = self.create_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            UPSERT_KEY = ('type', 'username')
+
+        assert ChatDAO.upsert(Chat(type='usual', username='voilalex')).sql == (
+            "INSERT INTO chats(type,username)\nVALUES (?,?)"
+            "\nON CONFLICT(type,username) DO NOTHING")
+
+    def test_dao_save_if_not_exists(self):
+        Chat = self.create_model()
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        assert ChatDAO.save_if_not_exists(Chat(type='usual', chat_id=10)) == (
+            "INSERT INTO chats(type,chat_id)\nSELECT ?,?"
+            "\nWHERE NOT EXISTS(SELECT 1 FROM chats WHERE type = ? AND chat_id = ?)",
+            ('usual', 10, 'usual', 10))
+
+
+class TestIndexes:
+    def create_model(self):
+        return create_chat_model(
+            'type',
+            utils.Field(name="username", dtype="text", index=True),
+            'first_name',
+            'last_name',
+            utils.Field(name="chat_id", dtype="integer"),
+            INDEXES=[
+                utils.Index('last_name', 'first_name'),
+                utils.Index('chat_id', unique=True, name='chat_id_unique'),
+                utils.Index('type', where="type IS NOT NULL")
+            ])
+
+    def test_model_sql_create_indexes(self):
+        Chat = self.create_model()
+
+        assert Chat.sql_create_indexes() == [
+            "CREATE INDEX IF NOT EXISTS ix_chats_username ON chats(username)",
+            "CREATE INDEX IF NOT EXISTS ix_chats_last_name_first_name "
+            "ON chats(last_name, first_name)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS chat_id_unique ON chats(chat_id)",
+            "CREATE INDEX IF NOT EXISTS ix_chats_type ON chats(type) "
+            "WHERE type IS NOT NULL"
+        ]
+
+    def test_model_index_unknown_column(self):
+        with pytest.raises(utils.ConventionViolationError):
+            class Chat(metaclass=utils.ModelMeta):
+                NAME = 'chats'
+                FIELDS = [
+                    utils.Field(name="id", dtype="integer",
+                                postfix="PRIMARY KEY")
+                ]
+                INDEXES = [utils.Index('username')]
+
+    def test_unindexed_queries(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+            sql_find_all_by_username = utils.CustomQuery()
+            sql_find_all_by_first_name = utils.CustomQuery()
+            sql_find_all_by_first_name_and_last_name = utils.CustomQuery()
+            sql_delete_by_type = utils.CustomQuery()
+            sql_find_all_by_chat_id = utils.CustomQuery()
+            sql_find_all_order_by_id_limit = utils.CustomQuery()
+            sql_find_all_by_type_order_by_id_limit = utils.CustomQuery()
+            custom_find = utils.CustomQuery("SELECT * FROM chats WHERE type = {}")
+
+        assert utils.unindexed_queries(ChatDAO) == [
+            'sql_find_all_by_first_name',
+            'sql_delete_by_type',
+            'sql_find_all_by_type_order_by_id_limit'
+        ]
+
+
+class TestQueryPlans:
+    def create_dao(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = create_chat_model(
+                'type',
+                utils.Field(name="username", dtype="text", unique=True),
+                utils.Field(name="chat_id", dtype="integer", index=True))
+            sql_find_all_by_type = utils.CustomQuery()
+            sql_find_all_by_chat_id = utils.CustomQuery()
+            sql_delete_by_username = utils.CustomQuery()
+            sql_find_all_order_by_id_limit = utils.CustomQuery()
+            sql_find_all_by_type_limit = utils.CustomQuery()
+            sorted_by_type = utils.CustomQuery(
+                "SELECT * FROM chats WHERE chat_id > {} ORDER BY type")
+            broken = utils.CustomQuery("SELECT * FROM missing WHERE id = {}")
+        return ChatDAO
+
+    def test_check_query_plans(self):
+        ChatDAO = self.create_dao()
+
+        issues = utils.check_query_plans([ChatDAO])
+        assert [(i.name, i.problem) for i in issues] == [
+            ('ChatDAO.find_all_by_type', 'full scan'),
+            ('ChatDAO.find_all_by_type_limit', 'full scan'),
+            ('ChatDAO.prepared_sorted_by_type', 'temp b-tree'),
+            ('ChatDAO.prepared_broken', 'error'),
+        ]
+        assert issues[0].sql.startswith('SELECT id, type, username, chat_id FROM chats')
+        assert issues[0].detail == 'SCAN chats'
+        assert issues[3].detail == 'no such table: missing'
+
+    def test_check_query_plans_cli(self, tmp_path, monkeypatch, capsys):
+        (tmp_path / 'plans_dao.py').write_text(
+            "import sqller\n"
+            "class Chat(metaclass=sqller.ModelMeta):\n"
+            "    NAME = 'chats'\n"
+            "    FIELDS = [sqller.Field('id', 'integer', 'PRIMARY KEY'),\n"
+            "              sqller.Field('type', 'text')]\n"
+            "class ChatDAO(metaclass=sqller.DAOMeta):\n"
+            "    MODEL = Chat\n"
+            "    sql_find_all_by_type = sqller.CustomQuery()\n")
+        monkeypatch.syspath_prepend(str(tmp_path))
+        from sqller.analysis import main
+
+        assert main(['plans_dao']) == 1
+        assert "ChatDAO.find_all_by_type: full scan: SCAN chats\n" \
+            "    SELECT id, type FROM chats WHERE type = ?\n" in capsys.readouterr().out
+
+
+class TestPagination:
+    def create_model(self):
+        return create_chat_model(
+            'type', 'username', utils.Field(name="order_id", dtype="integer"))
+
+    def test_dao_find_page_after(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+
+        assert ChatDAO.find_page_after(None, 10) == (
+            "SELECT id, type, username, order_id FROM chats\n"
+            "ORDER BY id\nLIMIT ?;", (10,))
+        assert ChatDAO.find_page_after(20, 10) == (
+            "SELECT id, type, username, order_id FROM chats\n"
+            "WHERE id > ?\nORDER BY id\nLIMIT ?;", (20, 10))
+        assert ChatDAO.find_page_after(20).model is ChatDAO.MODEL
+        assert ChatDAO.sql_find_page_after(20, 10) == \
+            "SELECT * FROM chats\nWHERE id > 20\nORDER BY id\nLIMIT 10;"
+
+    def test_dao_custom_query_order_by_limit(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+            sql_find_all_by_type_order_by_username_desc_and_id_limit = \
+                utils.CustomQuery()
+            sql_find_all_order_by_id_limit_10 = utils.CustomQuery()
+
+        assert ChatDAO.sql_find_all_by_type_order_by_username_desc_and_id_limit(
+            type='usual', limit=5
+        ) == "SELECT * FROM chats WHERE type = 'usual' " \
+             "ORDER BY username DESC, id LIMIT 5"
+        assert ChatDAO.find_all_by_type_order_by_username_desc_and_id_limit(
+            type='usual', limit=5
+        ) == ("SELECT id, type, username, order_id FROM chats WHERE type = ? "
+              "ORDER BY username DESC, id LIMIT ?", ('usual', 5))
+        assert ChatDAO.sql_find_all_order_by_id_limit_10() == \
+            "SELECT * FROM chats ORDER BY id LIMIT 10"
+
+    def test_dao_custom_query_keyset(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+            sql_find_all_by_type_after_id_order_by_id_limit = utils.CustomQuery()
+            sql_find_all_by_order_id_before_id_order_by_id_desc = utils.CustomQuery()
+
+        assert ChatDAO.find_all_by_type_after_id_order_by_id_limit(
+            type='usual', id=10, limit=5
+        ) == ("SELECT id, type, username, order_id FROM chats "
+              "WHERE type = ? AND id > ? ORDER BY id LIMIT ?", ('usual', 10, 5))
+        assert ChatDAO.sql_find_all_by_order_id_before_id_order_by_id_desc(
+            order_id=1, id=10
+        ) == "SELECT * FROM chats WHERE order_id = 1 AND id < 10 ORDER BY id DESC"
+
+    def test_dao_custom_query_order_by_without_fields(self):
+        with pytest.raises(utils.CustomSQLBuildError):
+            class ChatDAO(metaclass=utils.DAOMeta):
+                MODEL = self.create_model()
+                sql_find_all_order_by_limit = utils.CustomQuery()
+
+
+class TestProjection:
+    def create_model(self):
+        return create_chat_model('type', 'username', 'first_name')
+
+    def test_model_partial(self):
+        Chat = self.create_model()
+        ChatUsername = Chat.partial('id', 'username')
+
+        assert ChatUsername is Chat.partial('id', 'username')
+        assert ChatUsername.__slots__ == ('id', 'username', '_loaded')
+        assert ChatUsername.NAME == 'chats'
+        chat = ChatUsername.from_row((1, 'vouk'))
+        assert (chat.id, chat.username) == (1, 'vouk')
+        with pytest.raises(AttributeError):
+            chat.type
+        assert Chat.partial('id', 'type', 'username', 'first_name') is Chat
+        with pytest.raises(utils.ConventionViolationError):
+            Chat.partial('last_name')
+
+    def test_dao_custom_query_projection(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+            sql_select_username_by_type = utils.CustomQuery()
+            sql_find_id_and_username_after_id_order_by_id_limit = utils.CustomQuery()
+
+        assert ChatDAO.sql_select_username_by_type(type='usual') == \
+            "SELECT username FROM chats WHERE type = 'usual'"
+        statement = ChatDAO.select_username_by_type(type='usual')
+        assert statement == ("SELECT username FROM chats WHERE type = ?", ('usual',))
+        assert statement.model is ChatDAO.MODEL.partial('username')
+        assert ChatDAO.find_id_and_username_after_id_order_by_id_limit(
+            id=10, limit=5
+        ) == ("SELECT id, username FROM chats WHERE id > ? ORDER BY id LIMIT ?",
+              (10, 5))
+
+    def test_dao_custom_query_projection_errors(self):
+        with pytest.raises(utils.CustomSQLBuildError):
+            class ChatDAO(metaclass=utils.DAOMeta):
+                MODEL = self.create_model()
+                sql_select_by_type = utils.CustomQuery()
+        with pytest.raises(utils.CustomSQLBuildError):
+            class ChatDAO(metaclass=utils.DAOMeta):
+                MODEL = self.create_model()
+                sql_select_last_name_by_type = utils.CustomQuery()
+
+    def test_dao_projection(self):
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = self.create_model()
+
+        assert ChatDAO.get_one(1, columns=('username',)) == (
+            "SELECT username FROM chats\nWHERE id = ?\nLIMIT 1;", (1,))
+        assert ChatDAO.get_one(1, columns=('username',)).cache_key is None
+        assert ChatDAO.find_all(columns=('id', 'type')) == (
+            "SELECT id, type FROM chats;", ())
+        assert ChatDAO.find_page_after(10, 5, columns=['username']) == (
+            "SELECT username FROM chats\nWHERE id > ?\nORDER BY id\nLIMIT ?;",
+            (10, 5))
+        assert ChatDAO.find_all(columns=['username']).model.__slots__ == ('username', '_loaded')
+        assert ChatDAO.sql_find_all(columns=('id', 'type')) == \
+            "SELECT id, type FROM chats;"
+        with pytest.raises(utils.ConventionViolationError):
+            ChatDAO.find_all(columns=('last_name',))
+
+
+class TestBulkOperations:
+    def create_dao(self, **options):
+        Chat = create_chat_model(
+            'type', 'username', utils.Field(name="chat_id", dtype="integer"))
+        return utils.DAOMeta('ChatDAO', (), dict(MODEL=Chat, **options))
+
+    def test_dao_update_where(self):
+        ChatDAO = self.create_dao()
+
+        assert ChatDAO.update_where(
+            {'type': 'group', 'chat_id': 1}, username=None, type='usual'
+        ) == ("UPDATE chats SET type=?, chat_id=?\n"
+              "WHERE username IS NULL AND type = ?", ('group', 1, 'usual'))
+        assert ChatDAO.update_where({'type': 'group'}, chat_id=[1, 2]) == (
+            "UPDATE chats SET type=?\n"
+            "WHERE chat_id IN (SELECT value FROM json_each(?))",
+            ('group', '[1, 2]'))
+        assert ChatDAO.sql_update_where(
+            {'type': "O'Neil"}, chat_id=[1, 2], username=None
+        ) == "UPDATE chats SET type='O''Neil'\n" \
+             "WHERE chat_id IN (1, 2) AND username IS NULL"
+        with pytest.raises(utils.ConventionViolationError):
+            ChatDAO.update_where({'last_name': 'Vouk'}, type='usual')
+        with pytest.raises(ValueError):
+            ChatDAO.update_where({}, type='usual')
+
+    def test_dao_delete_where(self):
+        ChatDAO = self.create_dao()
+
+        assert ChatDAO.delete_where(type='usual', username=['a', 'b']) == (
+            "DELETE FROM chats\nWHERE type = ? AND "
+            "username IN (SELECT value FROM json_each(?))",
+            ('usual', '["a", "b"]'))
+        assert ChatDAO.delete_where() == ("DELETE FROM chats", ())
+        assert ChatDAO.sql_delete_where(type='usual') == \
+            "DELETE FROM chats\nWHERE type = 'usual'"
+        with pytest.raises(utils.ConventionViolationError):
+            ChatDAO.delete_where(last_name='Vouk')
+
+    def test_dao_delete_by_ids(self):
+        cache = utils.RowCache()
+        ChatDAO = self.create_dao(CACHE=cache)
+        cache.set(1, [(1,)])
+
+        statement = ChatDAO.delete_by_ids(range(1, 4))
+        assert statement == (
+            "DELETE FROM chats\nWHERE id IN (SELECT value FROM json_each(?))",
+            ('[1, 2, 3]',))
+        assert statement.invalidate == (1, 2, 3)
+        assert ChatDAO.sql_delete_by_ids([1, 2]) == \
+            "DELETE FROM chats\nWHERE id IN (1, 2)"
+        assert cache.get(1) is None
+
+
+class TestRelations:
+    def create_models(self):
+        Chat = create_chat_model('username')
+
+        class Message(metaclass=utils.ModelMeta):
+            NAME = 'messages'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="text", dtype="text"),
+                utils.Field(name="chat_id", dtype="integer",
+                            reference=Chat.reference('id'), index=True)
+            ]
+        return Chat, Message
+
+    def test_model_relation(self):
+        Chat, Message = self.create_models()
+
+        assert Message.fields_by_name['chat_id'].relation == 'chat'
+        assert Message.fields_by_name['chat_id'].referenced_column() == ('chats', 'id')
+        assert Message.__slots__ == ('id', 'text', 'chat_id', 'chat', '_loaded')
+        assert utils.Field(name="owner", dtype="integer",
+                           reference="users(id)").relation is None
+
+    def test_dao_relation_loaders(self):
+        Chat, Message = self.create_models()
+
+        class MessageDAO(metaclass=utils.DAOMeta):
+            MODEL = Message
+
+        messages = [Message(id=i, chat_id=chat_id)
+                    for i, chat_id in enumerate([1, 2, 1, None])]
+        statement = MessageDAO.load_chat(messages)
+        assert statement == (
+            "SELECT id, username FROM chats\n"
+            "WHERE id IN (SELECT value FROM json_each(?))", ('[1, 2]',))
+        assert statement.model is Chat
+        statement.attach([Chat(id=1, username='voilalex')])
+        assert [m.chat and m.chat.username for m in messages] == [
+            'voilalex', None, 'voilalex', None]
+
+        chats = [Chat(id=1), Chat(id=2)]
+        statement = MessageDAO.load_for_chat(chats)
+        assert statement == (
+            "SELECT id, text, chat_id FROM messages\n"
+            "WHERE chat_id IN (SELECT value FROM json_each(?))\n"
+            "ORDER BY id", ('[1, 2]',))
+        assert statement.model is Message
+        assert MessageDAO.load_chat([Message(id=1)]) == ('', ())
+
+    def test_referenced_model_of_the_field(self):
+        Chat, Message = self.create_models()
+
+        # Another model of the same table, e.g. in another service
+        class OtherChat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY")
+            ]
+
+        class MessageDAO(metaclass=utils.DAOMeta):
+            MODEL = Message
+
+        assert Message.fields_by_name['chat_id'].model is Chat
+        assert MessageDAO.load_chat([Message(chat_id=1)]).model is Chat
+
+        class Reply(metaclass=utils.ModelMeta):
+            NAME = 'replies'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="chat_id", dtype="integer",
+                            reference="chats(id)", model=OtherChat),
+                utils.Field(name="reply_to_id", dtype="integer",
+                            reference="replies(id)", relation='reply_to')
+            ]
+
+        class ReplyDAO(metaclass=utils.DAOMeta):
+            MODEL = Reply
+
+        assert ReplyDAO.load_chat([Reply(chat_id=1)]).model is OtherChat
+        assert ReplyDAO.load_reply_to([Reply(reply_to_id=1)]).model is Reply
+
+        class Forward(metaclass=utils.ModelMeta):
+            NAME = 'forwards'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="chat_id", dtype="integer",
+                            reference="chats(id)", relation='chat')
+            ]
+
+        with pytest.raises(utils.ConventionViolationError):
+            class ForwardDAO(metaclass=utils.DAOMeta):
+                MODEL = Forward
+
+    def test_relation_with_field_name(self):
+        Chat, _ = self.create_models()
+
+        class Message(metaclass=utils.ModelMeta):
+            NAME = 'messages'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="chat", dtype="text"),
+                utils.Field(name="chat_id", dtype="integer",
+                            reference=Chat.reference('id'))
+            ]
+
+        class MessageDAO(metaclass=utils.DAOMeta):
+            MODEL = Message
+
+        assert Message.fields_by_name['chat_id'].relation is None
+        assert Message.__slots__ == ('id', 'chat', 'chat_id', '_loaded')
+        assert Message(chat='general', chat_id=1).chat == 'general'
+        assert not hasattr(MessageDAO, 'load_chat')
+
+        with pytest.raises(utils.ConventionViolationError):
+            class Forward(metaclass=utils.ModelMeta):
+                NAME = 'forwards'
+                FIELDS = [
+                    utils.Field(name="id", dtype="integer",
+                                postfix="PRIMARY KEY"),
+                    utils.Field(name="chat", dtype="text"),
+                    utils.Field(name="chat_ref", dtype="integer",
+                                reference=Chat.reference('id'), relation='chat')
+                ]
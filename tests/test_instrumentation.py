@@ -0,0 +1,151 @@
+import logging
+import pickle
+import sqlite3
+
+import sqller as utils
+import pytest
+
+from test_service import create_chat_service
+
+
+class RecordingHook:
+    def __init__(self):
+        self.before = []
+        self.after = []
+
+    def before_execute(self, event):
+        self.before.append(event.name)
+
+    def after_execute(self, event):
+        self.after.append((event.name, event.rows, event.error))
+
+
+def create_chat_dao(ChatService):
+    class ChatDAO(metaclass=utils.DAOMeta):
+        MODEL = ChatService.MODELS[0]
+        sql_find_all_by_type = utils.CustomQuery()
+    return ChatDAO
+
+
+class TestInstrumentation:
+    def test_sql_text_is_named(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatDAO = create_chat_dao(ChatService)
+        Chat = ChatService.MODELS[0]
+
+        sql_query = ChatDAO.sql_exists(Chat(type='usual'))
+        assert sql_query == "SELECT count(*) FROM chats WHERE type = 'usual';"
+        assert sql_query.name == 'ChatDAO.sql_exists'
+        assert ChatDAO.sql_find_all_by_type(
+            type='usual').name == 'ChatDAO.sql_find_all_by_type'
+        assert ChatDAO.sql_exists.__name__ == 'sql_exists'
+        assert ChatDAO.sql_find_all_by_type.__name__ == 'sql_find_all_by_type'
+
+        sql_query = pickle.loads(pickle.dumps(ChatDAO.sql_find_all_by_type(type="O'Neil")))
+        assert sql_query == "SELECT * FROM chats WHERE type = 'O''Neil'"
+        assert sql_query.name == 'ChatDAO.sql_find_all_by_type'
+
+    def test_hooks(self, tmp_path):
+        hook = RecordingHook()
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', HOOKS=[hook])
+        ChatDAO = create_chat_dao(ChatService)
+        Chat = ChatService.MODELS[0]
+
+        ChatService.execute(ChatDAO.save(Chat(type='usual')))
+        ChatService.execute(ChatDAO.sql_exists(Chat(type='usual')))
+        ChatService.execute("SELECT type FROM chats")
+        ChatService.execute_many(ChatDAO.save_many([Chat(type='group')] * 3))
+        assert len(list(ChatService.iterate(ChatDAO.find_all_by_type(type='group')))) == 3
+        with pytest.raises(sqlite3.OperationalError):
+            ChatService.execute("SELECT * FROM missing")
+
+        assert hook.before == [name for name, _, _ in hook.after]
+        assert hook.after[:5] == [
+            ('ChatDAO.save', 1, None),
+            ('ChatDAO.sql_exists', 1, None),
+            ('SELECT type FROM chats', 1, None),
+            ('ChatDAO.save_many', 3, None),
+            ('ChatDAO.find_all_by_type', 3, None),
+        ]
+        assert isinstance(hook.after[5][2], sqlite3.OperationalError)
+
+        ChatService.remove_hook(hook)
+        ChatService.execute("SELECT 1")
+        assert len(hook.after) == 6
+
+    def test_query_stats(self, tmp_path):
+        stats = utils.QueryStats()
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatService.add_hook(stats)
+        ChatDAO = create_chat_dao(ChatService)
+        Chat = ChatService.MODELS[0]
+
+        ChatService.execute_many(ChatDAO.save_many([Chat(type='usual')] * 10))
+        for id in range(1, 11):
+            ChatService.execute(ChatDAO.get_one(id))
+        with pytest.raises(sqlite3.IntegrityError):
+            ChatService.execute(utils.Statement(
+                "INSERT INTO chats(id) VALUES (?)", (1,), 'ChatDAO.save'))
+
+        snapshot = stats.snapshot()
+        assert snapshot['ChatDAO.get_one']['count'] == 10
+        assert snapshot['ChatDAO.get_one']['rows'] == 10
+        assert snapshot['ChatDAO.save_many']['rows'] == 10
+        assert snapshot['ChatDAO.save']['errors'] == 1
+        get_one = snapshot['ChatDAO.get_one']
+        assert 0 < get_one['p50'] <= get_one['p99'] <= get_one['max']
+        assert sum(count for _, count in get_one['histogram']) == 10
+        assert stats.slowest(1)[0][0] in snapshot
+
+        stats.reset()
+        assert stats.snapshot() == {}
+
+    def test_query_stats_names(self, tmp_path):
+        stats = utils.QueryStats()
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', HOOKS=[stats])
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            custom_find = utils.CustomQuery("SELECT * FROM chats WHERE id = {}")
+            sql_custom_get = utils.CustomQuery("SELECT * FROM chats WHERE id = {}")
+
+        for id in range(100):
+            ChatService.execute(ChatDAO.custom_find(id))
+            ChatService.execute(ChatDAO.sql_custom_get(id))
+            ChatService.execute(
+                f"SELECT * FROM chats WHERE username IN ('user{id}', 'chat{id}') "
+                f"AND id > {id}.5 AND \"type\" = 'usual'")
+
+        assert ChatDAO.custom_find(1).name == 'ChatDAO.custom_find'
+        assert ChatDAO.custom_find.__name__ == 'custom_find'
+        assert sorted(stats.snapshot()) == [
+            'ChatDAO.custom_find',
+            'ChatDAO.sql_custom_get',
+            'SELECT * FROM chats WHERE username IN (?) AND id > ? AND "type" = ?',
+        ]
+        assert utils.query_pattern("SELECT t1.x FROM t1 WHERE x = -1e5") == (
+            "SELECT t1.x FROM t1 WHERE x = -?")
+
+    def test_slow_query_log(self, tmp_path, caplog):
+        stats = utils.QueryStats(slow_threshold=0)
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', HOOKS=[stats])
+
+        with caplog.at_level(logging.WARNING, logger='sqller'):
+            ChatService.execute("SELECT count(*) FROM chats")
+
+        assert [query[1] for query in stats.slow_queries] == [
+            "SELECT count(*) FROM chats"]
+        assert "Slow query SELECT count(*) FROM chats" in caplog.text
+
+    def test_failing_hook(self, tmp_path, caplog):
+        class FailingHook:
+            def after_execute(self, event):
+                raise RuntimeError
+
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', HOOKS=[FailingHook()])
+
+        with caplog.at_level(logging.ERROR, logger='sqller'):
+            assert ChatService.execute("SELECT 1") == [(1,)]
+        assert "Hook of ChatService failed on SELECT ?" in caplog.text
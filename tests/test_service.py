@@ -0,0 +1,822 @@
+import sqlite3
+import threading
+
+import sqller as utils
+import pytest
+
+
+def create_chat_model(*fields, **attributes):
+    """Model of `chats` with `id` primary key and the fields, which are
+    `Field`s or names of text fields (type, last_name, first_name and
+    username by default), and the other class attributes.
+    """
+    fields = fields or ('type', 'last_name', 'first_name', 'username')
+    dct = dict(NAME='chats', FIELDS=[
+        utils.Field(name="id", dtype="integer", postfix="PRIMARY KEY")
+    ] + [
+        field if isinstance(field, utils.Field) else utils.Field(name=field, dtype="text")
+        for field in fields
+    ])
+    dct.update(attributes)
+    return utils.ModelMeta('Chat', (), dct)
+
+
+def create_chat_service(db_path, **options):
+    Chat = create_chat_model()
+    dct = dict(DB_PATH=str(db_path), MODELS=[Chat])
+    dct.update(options)
+    return utils.ServiceMeta('ChatService', (), dct)
+
+
+class TestConnectionPool:
+    def test_service_creation_convention_violation(self):
+        with pytest.raises(utils.ConventionViolationError):
+            class ChatService(metaclass=utils.ServiceMeta):
+                MODELS = []
+
+    def test_execute_reuses_connection(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+        connection = ChatService.connect()
+        ChatService.release(connection)
+
+        assert ChatService.execute("SELECT type FROM chats") == [('usual',)]
+        assert ChatService.connect() is connection
+
+    def test_pool_size_is_bounded(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', POOL_SIZE=1, POOL_TIMEOUT=0.01)
+        connection = ChatService.connect()
+        with pytest.raises(utils.ConnectionPoolError):
+            ChatService.pool.acquire()
+        assert ChatService.connect() is None
+        ChatService.release(connection)
+
+    def test_closed_connections_free_the_pool(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', POOL_SIZE=1, POOL_TIMEOUT=0.01)
+        connection = ChatService.connect()
+        connection.close()
+        connection = ChatService.connect()
+        assert connection is not None
+
+        connection.close()
+        ChatService.release(connection)
+        assert ChatService.pool._opened == 0
+
+        connection = ChatService.connect()
+        ChatService.release(connection)
+        connection.close()
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(0,)]
+        assert ChatService.pool._opened == 1
+
+    def test_dropped_connections_free_the_pool(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', POOL_SIZE=2)
+        connections = [ChatService.connect(), ChatService.connect()]
+        assert ChatService.connect() is None
+
+        connections.pop()
+        connection = ChatService.connect()
+        assert connection is not None
+        assert ChatService.pool._opened == 2
+
+        # Waits for the place of the connection dropped meanwhile
+        timer = threading.Timer(0.05, connections.clear)
+        timer.start()
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(0,)]
+        timer.join()
+
+    def test_release_twice(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', POOL_SIZE=2)
+        connection = ChatService.connect()
+        ChatService.release(connection)
+        with pytest.raises(utils.ConnectionPoolError):
+            ChatService.release(connection)
+        with pytest.raises(utils.ConnectionPoolError):
+            ChatService.release(sqlite3.connect(':memory:'))
+
+        first, second = ChatService.connect(), ChatService.connect()
+        assert first is not second
+        assert ChatService.pool._opened == 2
+
+    def test_in_memory_database_is_kept(self):
+        ChatService = create_chat_service(':memory:', POOL_SIZE=3)
+        ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+
+        assert ChatService.pool.size == 1
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(1,)]
+
+    def test_execute_from_threads(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', POOL_SIZE=2)
+
+        def insert():
+            for _ in range(10):
+                ChatService.execute(
+                    "INSERT INTO chats(type) VALUES ('usual')")
+        threads = [threading.Thread(target=insert) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(40,)]
+
+    def test_close(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatService.execute("SELECT 1")
+        ChatService.close()
+
+        assert ChatService.pool.closed
+        with pytest.raises(utils.ConnectionPoolError):
+            ChatService.execute("SELECT 1")
+
+
+class TestReadReplicas:
+    def test_reads_use_read_only_connections(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', READERS=1, POOL_TIMEOUT=0.01,
+            PRAGMAS=utils.HIGH_THROUGHPUT_PRAGMAS)
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        ChatService.execute(ChatDAO.save(Chat(type='usual')))
+        assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'usual'
+
+        reader = ChatService.read_pool.acquire()
+        with pytest.raises(sqlite3.OperationalError):
+            reader.execute("INSERT INTO chats(type) VALUES ('group')")
+        # The only reader is taken, the writes and the queries
+        # inside transactions do not need it
+        with pytest.raises(utils.ConnectionPoolError):
+            ChatService.fetch_all(ChatDAO.find_all())
+        ChatService.execute(ChatDAO.save(Chat(type='group')))
+        with ChatService.transaction():
+            assert len(ChatService.fetch_all(ChatDAO.find_all())) == 2
+        ChatService.read_pool.release(reader)
+
+        assert [c.type for c in ChatService.fetch_all(ChatDAO.find_all())] == [
+            'usual', 'group']
+        ChatService.close()
+        assert ChatService.read_pool.closed
+
+    def test_in_memory_readers(self):
+        with pytest.raises(ValueError):
+            create_chat_service(':memory:', READERS=2)
+
+    def test_scan_partitioned(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        ChatService.execute_many(ChatDAO.save_many([
+            Chat(type='usual' if i % 3 else 'group', username=f'user{i}')
+            for i in range(100)
+        ]))
+
+        chats = ChatService.scan_partitioned(Chat, processes=2, partitions=3)
+        assert [c.username for c in chats] == [f'user{i}' for i in range(100)]
+        UsernameChat = Chat.partial('username')
+        assert [c.username for c in ChatService.scan_partitioned(
+            UsernameChat, processes=2, type='group')] == [
+                f'user{i}' for i in range(0, 100, 3)]
+        assert ChatService.scan_partitioned(
+            Chat, function=len, processes=2, partitions=4) == [25, 25, 25, 25]
+        assert ChatService.scan_partitioned(Chat, type='channel') == []
+
+
+class TestPragmas:
+    def test_pragmas_of_every_connection(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', PRAGMAS=utils.HIGH_THROUGHPUT_PRAGMAS)
+        connections = [ChatService.connect(), ChatService.connect()]
+
+        for connection in connections:
+            assert connection.execute(
+                "PRAGMA journal_mode").fetchall() == [('wal',)]
+            assert connection.execute(
+                "PRAGMA synchronous").fetchall() == [(1,)]
+            assert connection.execute(
+                "PRAGMA busy_timeout").fetchall() == [(5000,)]
+            assert connection.execute(
+                "PRAGMA temp_store").fetchall() == [(2,)]
+            ChatService.release(connection)
+
+    def test_concurrent_writers(self, tmp_path):
+        services = [
+            create_chat_service(tmp_path / 'db.sqlite3',
+                                PRAGMAS=utils.HIGH_THROUGHPUT_PRAGMAS)
+            for _ in range(4)
+        ]
+
+        def insert(ChatService):
+            for _ in range(20):
+                with ChatService.transaction(immediate=True):
+                    ChatService.execute(
+                        "INSERT INTO chats(type) VALUES ('usual')")
+        threads = [
+            threading.Thread(target=insert, args=(ChatService,))
+            for ChatService in services
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert services[0].execute("SELECT count(*) FROM chats") == [(80,)]
+
+    def test_invalid_pragma(self, tmp_path):
+        with pytest.raises(ValueError):
+            create_chat_service(tmp_path / 'db.sqlite3',
+                                PRAGMAS={'cache_size = 1; DROP TABLE chats': 1})
+        with pytest.raises(ValueError):
+            create_chat_service(tmp_path / 'db.sqlite3',
+                                PRAGMAS={'journal_mode': 'WAL; DROP TABLE chats'})
+
+
+class TestSchema:
+    def test_schema_created_once(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatService.execute("SELECT * FROM chats")
+
+        statements = []
+        connection = ChatService.connect()
+        connection.set_trace_callback(statements.append)
+        ChatService.release(connection)
+        ChatService.execute("SELECT * FROM chats")
+
+        assert statements == ["SELECT * FROM chats"]
+
+    def test_schema_created_per_service(self, tmp_path):
+        FirstService = create_chat_service(tmp_path / 'db.sqlite3')
+        FirstService.execute("SELECT * FROM chats")
+        FirstService.close()
+        (tmp_path / 'db.sqlite3').unlink()
+
+        SecondService = create_chat_service(tmp_path / 'db.sqlite3')
+        assert SecondService.execute("SELECT * FROM chats") == []
+        SecondService.execute("DROP TABLE chats")
+        SecondService.ensure_schema()
+        with pytest.raises(sqlite3.OperationalError):
+            SecondService.execute("SELECT * FROM chats")
+        SecondService.ensure_schema(force=True)
+        assert SecondService.execute("SELECT * FROM chats") == []
+
+    def test_migrate_adds_missing_columns(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatService.execute("DROP TABLE chats")
+        ChatService.execute("CREATE TABLE chats(id integer PRIMARY KEY)")
+        ChatService.migrate()
+        ChatService.execute("INSERT INTO chats(username) VALUES ('voilalex')")
+
+        assert ChatService.execute(
+            "SELECT id, type, username FROM chats") == [(1, None, 'voilalex')]
+
+
+class TestStatements:
+    def test_execute_statement(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_find_all_by_last_name = utils.CustomQuery()
+
+        ChatService.execute(ChatDAO.save(Chat(type='usual', last_name="O'Neil")))
+        ChatService.execute("INSERT INTO chats(type) VALUES (?)", ('group',))
+
+        assert ChatService.execute(ChatDAO.get_one(1)) == [
+            (1, 'usual', "O'Neil", None, None)]
+        assert ChatService.execute(ChatDAO.find_all_by_last_name(
+            last_name="O'Neil")) == [(1, 'usual', "O'Neil", None, None)]
+        assert ChatService.execute(
+            ChatDAO.exists(Chat(type='group'))) == [(1,)]
+
+    def test_execute_many(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', BATCH_SIZE=3)
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        chats = [Chat(type='usual', username=f'user{i}') for i in range(10)]
+        assert ChatService.execute_many(ChatDAO.save_many(chats)) == 10
+        assert ChatService.execute_many(
+            "INSERT INTO chats(type) VALUES (?)",
+            (('group',) for _ in range(5)), batch_size=2) == 5
+        assert ChatService.execute(
+            "SELECT type, count(*) FROM chats GROUP BY type") == [
+                ('group', 5), ('usual', 10)]
+
+    def test_execute_many_rollback(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', BATCH_SIZE=2)
+
+        with pytest.raises(sqlite3.IntegrityError):
+            ChatService.execute_many(
+                "INSERT INTO chats(id, type) VALUES (?, ?)",
+                [(1, 'usual'), (2, 'usual'), (3, 'usual'), (1, 'usual')])
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(0,)]
+
+    def test_update_changed_fields(self, tmp_path):
+        class Hook:
+            names = []
+
+            def after_execute(self, event):
+                self.names.append(event.name)
+
+        hook = Hook()
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', HOOKS=[hook])
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        ChatService.execute(ChatDAO.save(Chat(type='usual', username='voilalex')))
+        chat = ChatService.fetch_one(ChatDAO.get_one(1))
+        assert ChatService.execute_rowcount(ChatDAO.update(chat)) == 0
+        assert ChatService.execute(ChatDAO.sql_update(chat)) == []
+
+        # Column changed meanwhile is not overwritten by the stale value
+        ChatService.execute("UPDATE chats SET username = 'vouk'")
+        chat.type = 'group'
+        assert ChatService.execute_rowcount(ChatDAO.update(chat)) == 1
+        assert ChatService.execute(ChatDAO.get_one(1)) == [
+            (1, 'group', None, None, 'vouk')]
+        assert hook.names == [
+            'ChatDAO.save', 'ChatDAO.get_one', 'UPDATE chats SET username = ?',
+            'ChatDAO.update', 'ChatDAO.get_one']
+
+
+class TestTransaction:
+    def test_transaction_commit(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        statements = []
+
+        with ChatService.transaction() as connection:
+            connection.set_trace_callback(statements.append)
+            exists = ChatService.execute(
+                "SELECT count(*) FROM chats WHERE type = ?", ('usual',))[0][0]
+            if not exists:
+                ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+            connection.set_trace_callback(None)
+
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(1,)]
+        assert not any(s in ('COMMIT', 'BEGIN') for s in statements)
+
+    def test_transaction_isolation(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        counts = []
+
+        def count():
+            counts.append(ChatService.execute("SELECT count(*) FROM chats"))
+
+        with ChatService.transaction():
+            ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+            thread = threading.Thread(target=count)
+            thread.start()
+            thread.join()
+
+        assert counts == [[(0,)]]
+
+    def test_transaction_rollback(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+
+        with pytest.raises(ValueError):
+            with ChatService.transaction():
+                ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+                raise ValueError
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(0,)]
+
+    def test_transaction_savepoint(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', POOL_SIZE=1)
+
+        with ChatService.transaction():
+            ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+            with pytest.raises(ValueError):
+                with ChatService.transaction():
+                    ChatService.execute(
+                        "INSERT INTO chats(type) VALUES ('group')")
+                    raise ValueError
+            with ChatService.transaction():
+                ChatService.execute(
+                    "INSERT INTO chats(type) VALUES ('channel')")
+
+        assert ChatService.execute(
+            "SELECT type FROM chats ORDER BY id") == [('usual',), ('channel',)]
+
+    def test_execute_many_in_transaction(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+
+        with pytest.raises(ValueError):
+            with ChatService.transaction():
+                ChatService.execute_many(
+                    "INSERT INTO chats(type) VALUES (?)", [('usual',)] * 3)
+                raise ValueError
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(0,)]
+
+
+class TestIterate:
+    def test_iterate(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', FETCH_SIZE=3)
+        ChatService.execute_many(
+            "INSERT INTO chats(type) VALUES (?)", [('usual',)] * 10)
+
+        rows = ChatService.iterate("SELECT id FROM chats ORDER BY id")
+        assert next(rows) == (1,)
+        assert list(rows) == [(i,) for i in range(2, 11)]
+        assert list(ChatService.iterate(
+            "SELECT id FROM chats WHERE id > ?", (8,), batch_size=1)) == [(9,), (10,)]
+
+    def test_iterate_releases_connection(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', POOL_SIZE=1, POOL_TIMEOUT=0.01)
+        ChatService.execute_many(
+            "INSERT INTO chats(type) VALUES (?)", [('usual',)] * 10)
+
+        rows = ChatService.iterate("SELECT id FROM chats")
+        next(rows)
+        errors = []
+
+        def execute():
+            try:
+                ChatService.execute("SELECT 1")
+            except utils.ConnectionPoolError as e:
+                errors.append(e)
+        thread = threading.Thread(target=execute)
+        thread.start()
+        thread.join()
+        assert len(errors) == 1
+        rows.close()
+        assert ChatService.execute("SELECT 1") == [(1,)]
+
+    def test_queries_inside_iterate(self):
+        # The only connection of the in-memory database
+        # is held by the iteration
+        ChatService = create_chat_service(':memory:', FETCH_SIZE=1)
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        ChatService.execute_many(ChatDAO.save_many(
+            [Chat(type='usual'), Chat(type='group')]))
+        types = []
+        for row in ChatService.iterate(ChatDAO.find_all()):
+            types.append(ChatService.fetch_one(ChatDAO.get_one(row[0])).type)
+            for _ in ChatService.iterate(ChatDAO.find_all()):
+                pass
+            with ChatService.transaction():
+                ChatService.execute(
+                    "UPDATE chats SET username = 'seen' WHERE id = ?", row[:1])
+        assert types == ['usual', 'group']
+        assert ChatService.execute("SELECT username FROM chats") == [('seen',)] * 2
+        assert ChatService.transaction_state() is None
+
+    def test_reads_inside_iterate_on_readers(self, tmp_path):
+        ChatService = create_chat_service(
+            tmp_path / 'db.sqlite3', READERS=1, POOL_TIMEOUT=0.01)
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        ChatService.execute_many(ChatDAO.save_many(
+            [Chat(type='usual'), Chat(type='group')]))
+        for row in ChatService.iterate(ChatDAO.find_all()):
+            assert ChatService.fetch_one(ChatDAO.get_one(row[0])).id == row[0]
+            ChatService.execute(
+                "UPDATE chats SET username = 'seen' WHERE id = ?", row[:1])
+        assert ChatService.execute("SELECT username FROM chats") == [('seen',)] * 2
+
+    def test_iterate_in_transaction(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', POOL_SIZE=1)
+
+        with ChatService.transaction():
+            ChatService.execute("INSERT INTO chats(type) VALUES ('usual')")
+            assert list(ChatService.iterate("SELECT type FROM chats")) == [
+                ('usual',)]
+
+
+class TestFetch:
+    def test_fetch(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_find_all_by_type = utils.CustomQuery()
+
+        ChatService.execute_many(ChatDAO.save_many([
+            Chat(type='usual', username='voilalex'),
+            Chat(type='group', username='sqller')
+        ]))
+
+        chat = ChatService.fetch_one(ChatDAO.get_one(2))
+        assert isinstance(chat, Chat)
+        assert (chat.id, chat.type, chat.username) == (2, 'group', 'sqller')
+        assert ChatService.fetch_one(ChatDAO.get_one(3)) is None
+        assert [c.username for c in ChatService.fetch_all(
+            ChatDAO.find_all())] == ['voilalex', 'sqller']
+        assert [c.id for c in ChatService.fetch_all(
+            ChatDAO.find_all_by_type(type='usual'))] == [1]
+        assert ChatService.fetch_all(
+            "SELECT * FROM chats WHERE id = ?", (1,), model=Chat)[0].id == 1
+        with pytest.raises(ValueError):
+            ChatService.fetch_all("SELECT * FROM chats")
+
+    def test_fetch_aggregates(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_count_by_type = utils.CustomQuery()
+            sql_count_and_max_id_group_by_type = utils.CustomQuery()
+
+        ChatService.execute_many(ChatDAO.save_many(
+            [Chat(type='usual' if i % 3 else 'group') for i in range(10)]))
+
+        assert ChatService.fetch_value(ChatDAO.count_by_type(type='usual')) == 6
+        assert ChatService.fetch_value(ChatDAO.count_by_type(type='channel')) == 0
+        assert ChatService.fetch_value("SELECT id FROM chats WHERE id > 10") is None
+        assert ChatService.execute(ChatDAO.count_and_max_id_group_by_type()) == [
+            ('group', 4, 10), ('usual', 6, 9)]
+
+
+class TestSession:
+    def test_identity_map(self, tmp_path):
+        stats = utils.QueryStats()
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', HOOKS=[stats])
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_find_all_by_type = utils.CustomQuery()
+
+        ChatService.execute_many(ChatDAO.save_many([
+            Chat(type='usual', username='voilalex'),
+            Chat(type='group', username='sqller')
+        ]))
+
+        with ChatService.session() as session:
+            chat = ChatService.fetch_one(ChatDAO.get_one(1))
+            assert ChatService.fetch_one(ChatDAO.get_one(1)) is chat
+            with ChatService.session():
+                assert ChatService.fetch_all(ChatDAO.find_all())[0] is chat
+            assert ChatService.fetch_one(ChatDAO.get_one(1, columns=['username'])) is not chat
+            assert ('chats', 1) in session and len(session) == 2
+
+            ChatService.execute(ChatDAO.delete_by_id(2))
+            assert ('chats', 2) not in session
+            ChatService.execute(ChatDAO.update_where({'type': 'group'}, id=1))
+            assert len(session) == 0
+            assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'group'
+
+        assert ChatService.identity_map() is None and len(session) == 0
+        assert ChatService.fetch_one(ChatDAO.get_one(1)) is not chat
+        assert stats.snapshot()['ChatDAO.get_one']['count'] == 4
+
+    def test_identity_map_without_cache(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_delete_by_type = utils.CustomQuery()
+
+        ChatService.execute_many(ChatDAO.save_many([
+            Chat(type='usual', username='voilalex'),
+            Chat(type='group', username='sqller')
+        ]))
+
+        with ChatService.session() as session:
+            ChatService.fetch_all(ChatDAO.find_all())
+            ChatService.execute(ChatDAO.upsert(Chat(id=1, type='group')))
+            assert ('chats', 1) not in session
+            assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'group'
+
+            ChatService.fetch_all(ChatDAO.find_all())
+            ChatService.execute(ChatDAO.delete_by_type(type='group'))
+            assert len(session) == 0
+            assert ChatService.fetch_one(ChatDAO.get_one(1)) is None
+
+    def test_identity_map_rollback(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        ChatService.execute(ChatDAO.save(Chat(type='usual', username='voilalex')))
+
+        with ChatService.session() as session:
+            with pytest.raises(RuntimeError):
+                with ChatService.transaction():
+                    ChatService.execute(ChatDAO.update_where({'type': 'group'}, id=1))
+                    chat = ChatService.fetch_one(ChatDAO.get_one(1))
+                    assert chat.type == 'group'
+                    raise RuntimeError
+            assert len(session) == 0
+            assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'usual'
+
+            with ChatService.transaction():
+                chat = ChatService.fetch_one(ChatDAO.get_one(1))
+                with pytest.raises(RuntimeError):
+                    with ChatService.transaction():
+                        ChatService.execute(ChatDAO.update_where({'type': 'group'}, id=1))
+                        ChatService.fetch_one(ChatDAO.get_one(1))
+                        raise RuntimeError
+                assert ChatService.fetch_one(ChatDAO.get_one(1)).type == 'usual'
+
+
+class TestRelations:
+    def test_load_related(self, tmp_path):
+        stats = utils.QueryStats()
+        Chat = create_chat_model()
+
+        class Message(metaclass=utils.ModelMeta):
+            NAME = 'messages'
+            FIELDS = [
+                utils.Field(name="id", dtype="integer",
+                            postfix="PRIMARY KEY"),
+                utils.Field(name="text", dtype="text"),
+                utils.Field(name="chat_id", dtype="integer",
+                            reference=Chat.reference('id'), index=True)
+            ]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+
+        class MessageDAO(metaclass=utils.DAOMeta):
+            MODEL = Message
+
+        ChatService = utils.ServiceMeta('ChatService', (), dict(
+            DB_PATH=str(tmp_path / 'db.sqlite3'), MODELS=[Chat, Message],
+            HOOKS=[stats]))
+        ChatService.execute_many(ChatDAO.save_many(
+            [Chat(username=f'user{i}') for i in range(3)]))
+        ChatService.execute_many(MessageDAO.save_many(
+            [Message(text=f'text{i}', chat_id=i % 3 + 1) for i in range(9)]))
+
+        messages = ChatService.fetch_all(MessageDAO.find_all())
+        chats = ChatService.fetch_all(MessageDAO.load_chat(messages))
+        assert len(chats) == 3
+        assert [m.chat.username for m in messages[:4]] == [
+            'user0', 'user1', 'user2', 'user0']
+
+        chats = ChatService.fetch_all(ChatDAO.find_all())
+        messages = ChatService.fetch_all(MessageDAO.load_for_chat(chats[:2]))
+        assert [m.text for m in messages] == [
+            'text0', 'text1', 'text3', 'text4', 'text6', 'text7']
+        assert all(m.chat is chats[m.chat_id - 1] for m in messages)
+
+        snapshot = stats.snapshot()
+        assert snapshot['MessageDAO.load_chat']['count'] == 1
+        assert snapshot['MessageDAO.load_for_chat']['count'] == 1
+
+
+class TestPagination:
+    def test_find_page_after(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_find_all_by_type_after_id_order_by_id_limit = utils.CustomQuery()
+
+        ChatService.execute_many(ChatDAO.save_many([
+            Chat(type='usual' if i % 2 else 'group') for i in range(25)]))
+
+        ids = []
+        page = ChatService.fetch_all(ChatDAO.find_page_after(None, 10))
+        while page:
+            ids.append([chat.id for chat in page])
+            page = ChatService.fetch_all(
+                ChatDAO.find_page_after(page[-1].id, 10))
+        assert ids == [list(range(1, 11)), list(range(11, 21)),
+                       list(range(21, 26))]
+
+        page = ChatService.fetch_all(
+            ChatDAO.find_all_by_type_after_id_order_by_id_limit(
+                type='usual', id=10, limit=3))
+        assert [chat.id for chat in page] == [12, 14, 16]
+
+
+class TestProjection:
+    def test_fetch_partial_models(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            sql_select_username_by_type = utils.CustomQuery()
+
+        ChatService.execute_many(ChatDAO.save_many([
+            Chat(type='usual', username=f'user{i}', first_name='Ilya')
+            for i in range(3)]))
+
+        chats = ChatService.fetch_all(ChatDAO.select_username_by_type(type='usual'))
+        assert [chat.username for chat in chats] == ['user0', 'user1', 'user2']
+        assert not hasattr(chats[0], 'first_name')
+        assert ChatService.execute(ChatDAO.select_username_by_type(
+            type='usual')) == [('user0',), ('user1',), ('user2',)]
+        chat = ChatService.fetch_one(ChatDAO.get_one(2, columns=('id', 'first_name')))
+        assert (chat.id, chat.first_name) == (2, 'Ilya')
+
+
+class TestBulkOperations:
+    def test_execute_rowcount(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        Chat = ChatService.MODELS[0]
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+            CACHE = utils.RowCache()
+
+        ChatService.execute_many(ChatDAO.save_many([
+            Chat(type='usual' if i % 2 else 'group', username=f'user{i}')
+            for i in range(10)]))
+        assert ChatService.fetch_one(ChatDAO.get_one(2)).type == 'usual'
+
+        assert ChatService.execute_rowcount(ChatDAO.update_where(
+            {'type': 'channel'}, type='usual', username=['user1', 'user3'])) == 2
+        assert ChatService.fetch_one(ChatDAO.get_one(2)).type == 'channel'
+        assert ChatService.execute_rowcount(ChatDAO.delete_by_ids(range(1, 6))) == 5
+        assert ChatService.fetch_one(ChatDAO.get_one(2)) is None
+        assert ChatService.execute_rowcount(ChatDAO.delete_where(type='group')) == 2
+        assert ChatService.execute("SELECT username FROM chats") == [
+            ('user5',), ('user7',), ('user9',)]
+
+
+class TestUpsert:
+    def create_service(self, db_path):
+        Chat = create_chat_model(
+            'username', utils.Field(name="chat_id", dtype="integer", unique=True))
+        ChatService = create_chat_service(db_path, MODELS=[Chat])
+
+        class ChatDAO(metaclass=utils.DAOMeta):
+            MODEL = Chat
+        return ChatService, ChatDAO, Chat
+
+    def test_upsert(self, tmp_path):
+        ChatService, ChatDAO, Chat = self.create_service(tmp_path / 'db.sqlite3')
+        ChatService.execute(ChatDAO.upsert(Chat(username='voilalex', chat_id=10)))
+        ChatService.execute(ChatDAO.upsert(Chat(username='Vouk', chat_id=10)))
+        ChatService.execute(
+            ChatDAO.upsert(Chat(username='sqller', chat_id=10), update=False))
+
+        assert ChatService.execute("SELECT * FROM chats") == [(1, 'Vouk', 10)]
+
+    def test_upsert_without_values(self, tmp_path):
+        ChatService, ChatDAO, Chat = self.create_service(tmp_path / 'db.sqlite3')
+        assert ChatDAO.upsert(Chat()) == (
+            "INSERT OR IGNORE INTO chats DEFAULT VALUES", ())
+        ChatService.execute(ChatDAO.upsert(Chat()))
+        ChatService.execute(ChatDAO.upsert(Chat(), update=False))
+
+        assert ChatService.execute("SELECT * FROM chats") == [
+            (1, None, None), (2, None, None)]
+
+    def test_exists_and_save_if_not_exists(self, tmp_path):
+        ChatService, ChatDAO, Chat = self.create_service(tmp_path / 'db.sqlite3')
+        obj = Chat(username='voilalex', chat_id=10)
+
+        assert ChatService.execute(ChatDAO.exists(obj)) == [(0,)]
+        ChatService.execute(ChatDAO.save_if_not_exists(obj))
+        ChatService.execute(ChatDAO.save_if_not_exists(obj))
+        assert ChatService.execute(ChatDAO.exists(obj)) == [(1,)]
+        assert ChatService.execute("SELECT count(*) FROM chats") == [(1,)]
+
+
+class TestIndexes:
+    def test_indexes_created_with_schema(self, tmp_path):
+        Chat = create_chat_model(utils.Field(name="username", dtype="text", index=True))
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3', MODELS=[Chat])
+
+        ChatService.ensure_schema()
+        assert ChatService.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'") == [
+                ('ix_chats_username',)]
+
+    def test_migrate_creates_indexes_on_new_columns(self, tmp_path):
+        ChatService = create_chat_service(tmp_path / 'db.sqlite3')
+        ChatService.ensure_schema()
+
+        class Chat(metaclass=utils.ModelMeta):
+            NAME = 'chats'
+            FIELDS = ChatService.MODELS[0].FIELDS + [
+                utils.Field(name="chat_id", dtype="integer", index=True)]
+        MigratedService = utils.ServiceMeta('MigratedService', (), dict(
+            DB_PATH=str(tmp_path / 'db.sqlite3'), MODELS=[Chat]))
+        MigratedService.migrate()
+
+        assert MigratedService.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'") == [
+                ('ix_chats_chat_id',)]